@@ -1,63 +1,138 @@
-from flask import Flask, request, jsonify
-import sqlite3
+from flask import Flask, Response, request, jsonify
+from api_server import MAX_CONTENT_LENGTH, make_api_server
+from database.history_cache import HistoryCache
+from database.messages import missing_fields
+from database.storage import DEFAULT_LOG_DIRECTORY, SQLiteStore, open_store
+from database.sync import DEFAULT_BATCH_SIZE, encode_batch, export_changes
+from message_feed import MessageFeed, parse_last_event_id
+from profiling import profiler
+import os
 
 app = Flask(__name__)
 DATABASE = 'database/chat_history.db'
+app.config.setdefault('DATABASE', DATABASE)
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# "sqlite" or "log", see database/storage.py
+app.config.setdefault('STORAGE', os.environ.get('CHATAPP_STORAGE', 'sqlite'))
+app.config.setdefault('LOG_DIRECTORY', DEFAULT_LOG_DIRECTORY)
+_stores = {}
+_histories = {}
+
+def get_store():
+    backend = app.config['STORAGE']
+    path = app.config['DATABASE'] if backend == 'sqlite' else app.config['LOG_DIRECTORY']
+    if (backend, path) not in _stores:
+        _stores[(backend, path)] = open_store(backend, path)
+    return _stores[(backend, path)]
+
+def get_history():
+    """Recent-history cache in front of the current store"""
+    store = get_store()
+    if store not in _histories:
+        _histories[store] = HistoryCache(store)
+    return _histories[store]
 
 def get_db():
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
-    return db
+    return get_store().connect()
+
+# One producer serves every /messages/stream client
+feed = MessageFeed(get_store)
 
 @app.route('/messages', methods=['GET'])
+@profiler.timed("api GET /messages")
 def get_messages():
     protocol = request.args.get('protocol')
-    db = get_db()
-    try:
-        if protocol:
-            messages = db.execute(
-                'SELECT * FROM messages WHERE protocol = ? ORDER BY timestamp',
-                [protocol]
-            ).fetchall()
-        else:
-            messages = db.execute(
-                'SELECT * FROM messages ORDER BY timestamp'
-            ).fetchall()
-        return jsonify([dict(msg) for msg in messages])
-    finally:
-        db.close()
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be a positive number'}), 400
+    history = get_history()
+    # Unchanged history costs two index lookups instead of a query and encode
+    version = history.version()
+    if request.if_none_match.contains(version):
+        response = Response(status=304)
+    else:
+        response = jsonify(history.list(protocol, limit))
+    response.set_etag(version)
+    return response
 
 @app.route('/messages', methods=['POST'])
+@profiler.timed("api POST /messages")
 def add_message():
     try:
         data = request.get_json()
         
         # Check for required fields
-        required_fields = ['protocol', 'sender', 'recipient', 'message']
-        missing_fields = [field for field in required_fields if field not in data]
+        missing = missing_fields(data)
         
-        if missing_fields:
+        if missing:
             return jsonify({
                 'error': 'Missing required fields',
-                'missing_fields': missing_fields
+                'missing_fields': missing
             }), 400
 
-        db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute('''
-            INSERT INTO messages (protocol, sender, recipient, message)
-            VALUES (?, ?, ?, ?)
-        ''', [data['protocol'], data['sender'], data['recipient'], data['message']])
-        
-        message_id = cursor.lastrowid
-        db.commit()
-        db.close()
+        message_id = get_store().insert(data)
+        feed.notify()
         
         return jsonify({'id': message_id}), 201
         
     except (TypeError, ValueError, KeyError) as e:
         return jsonify({'error': 'Invalid JSON data', 'details': str(e)}), 400
 
+@app.route('/messages/trace', methods=['POST'])
+@profiler.timed("api POST /messages/trace")
+def add_render_times():
+    """Record when messages were shown, body is a list of {uid, render_ns}"""
+    stamps = request.get_json()
+    if not isinstance(stamps, list):
+        return jsonify({'error': 'Expected a list of {uid, render_ns}'}), 400
+    try:
+        missing = get_history().record_render_times(stamps)
+    except (TypeError, KeyError, ValueError) as e:
+        return jsonify({'error': 'Invalid JSON data', 'details': str(e)}), 400
+    return jsonify({'missing': missing})
+
+@app.route('/messages/stream', methods=['GET'])
+def stream_messages():
+    """Push new messages as Server-Sent Events, optionally for one protocol"""
+    try:
+        last_event_id = parse_last_event_id(
+            request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+    protocol = request.args.get('protocol')
+    # Taken now, not when the stream starts, so MAX_STREAMS holds under load
+    subscription = feed.subscribe(protocol, app.config.get('MAX_STREAMS'))
+    if subscription is None:
+        return jsonify({'error': 'Too many streams'}), 503, {'Retry-After': '5'}
+    response = Response(
+        feed.stream(protocol, last_event_id, subscription),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Also when the stream is never started, e.g. the client went away
+    response.call_on_close(lambda: feed.unsubscribe(subscription))
+    return response
+
+@app.route('/sync/changes', methods=['GET'])
+@profiler.timed("api GET /sync/changes")
+def sync_changes():
+    """Messages after a row id, for peers replicating this history"""
+    if not isinstance(get_store(), SQLiteStore):
+        return jsonify({'error': 'History sync needs the sqlite storage backend'}), 501
+    db = get_db()
+    try:
+        batch = export_changes(
+            db,
+            since=request.args.get('since', 0, type=int),
+            limit=request.args.get('limit', DEFAULT_BATCH_SIZE, type=int),
+            exclude_origin=request.args.get('exclude_origin')
+        )
+    finally:
+        db.close()
+    body, headers = encode_batch(batch, request.headers.get('Accept-Encoding', ''))
+    return Response(body, mimetype='application/json', headers=headers)
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # CHATAPP_API_SERVER=dev for werkzeug's development server
+    make_api_server(app, '127.0.0.1', 5000).serve_forever()
@@ -0,0 +1,323 @@
+import os
+import queue
+import socket
+import threading
+import traceback
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_STREAMS = 32         # Event streams, each on a thread of its own
+DEFAULT_BACKLOG = 64             # Connections waiting for a worker
+# Seconds a socket may sit idle: waiting for a request, between keep-alive
+# requests, or between two reads of one request. Not a limit on how long a
+# whole request may take.
+DEFAULT_TIMEOUT = 10.0
+MAX_CONTENT_LENGTH = 1024 * 1024  # Largest request body, bigger ones get 413
+
+OVERLOADED_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Retry-After: 1\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n\r\n"
+)
+
+class RequestBody:
+    """wsgi.input that keeps track of the unread part of the body"""
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def _limit(self, size):
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+        return size
+
+    def read(self, size=-1):
+        size = self._limit(size)
+        data = self.stream.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        size = self._limit(size)
+        data = self.stream.readline(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        """Skip what the app did not read, returns False if the client went away"""
+        while self.remaining:
+            if not self.read(min(self.remaining, 65536)):
+                return False
+        return True
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Serves several requests per connection, e.g. from a requests.Session.
+
+    Werkzeug closes every connection because it cannot tell where an
+    unread request body ends, and after each response discards whatever
+    the client sent next. HTTP/1.1 requests without a chunked body are run
+    by run_app instead. It keeps the connection alive if the request had a
+    Content-Length up to max_drain, skipping exactly the unread body so the
+    next request can be read. While other connections wait for a worker,
+    the connection is closed after the response instead, so a few busy
+    clients cannot hold every worker.
+
+    Event streams (text/event-stream responses) go to a thread of their own
+    once the headers are sent, so connected dashboards hold no worker.
+    """
+    protocol_version = "HTTP/1.1"
+    max_drain = MAX_CONTENT_LENGTH
+    _run_app = False  # Served by run_app rather than werkzeug's run_wsgi
+    _keep_alive = False
+    _body = None
+
+    def parse_request(self):
+        self._run_app = self._keep_alive = False
+        if not super().parse_request():
+            return False
+        length = self.headers.get("Content-Length", "0")
+        # HTTP/1.0 can't take a chunked response, werkzeug handles those
+        self._run_app = (
+            self.request_version == "HTTP/1.1"
+            and "chunked" not in self.headers.get("Transfer-Encoding", "").lower()
+            and length.isdigit()
+        )
+        self._keep_alive = (
+            self._run_app
+            and not self.close_connection
+            and not self.server.has_waiting_connections()
+            and int(length) <= self.max_drain
+        )
+        return True
+
+    def make_environ(self):
+        environ = super().make_environ()
+        if self._run_app:
+            self._body = RequestBody(environ["wsgi.input"], int(self.headers.get("Content-Length", "0")))
+            environ["wsgi.input"] = self._body
+        return environ
+
+    def run_wsgi(self):
+        if self._run_app:
+            self.run_app()
+        else:
+            super().run_wsgi()
+
+    def run_app(self):
+        """Run the app like werkzeug's run_wsgi, but keep the connection
+        alive when possible and hand event streams to a thread of their own"""
+        if self.headers.get("Expect", "").lower().strip(" \t") == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        environ = self.environ = self.make_environ()
+        response = {"status": None, "headers": None, "sent": False, "chunked": False,
+                    "stream": False, "out": self.wfile}
+
+        def write(data):
+            if not response["sent"]:
+                response["sent"] = True
+                code, _, reason = response["status"].partition(" ")
+                code = int(code)
+                self.send_response(code, reason)
+                names = set()
+                for name, value in response["headers"]:
+                    self.send_header(name, value)
+                    names.add(name.lower())
+                    if name.lower() == "content-type" and value.startswith("text/event-stream"):
+                        response["stream"] = True
+                # Without a length the end of the body has to be marked
+                if not ("content-length" in names or environ["REQUEST_METHOD"] == "HEAD"
+                        or 100 <= code < 200 or code in (204, 304)):
+                    response["chunked"] = True
+                    self.send_header("Transfer-Encoding", "chunked")
+                if not self._keep_alive or response["stream"]:
+                    self.close_connection = True
+                self.send_header("Connection", "close" if self.close_connection else "keep-alive")
+                self.end_headers()
+            if data and response["chunked"]:
+                response["out"].write(b"%x\r\n%s\r\n" % (len(data), data))
+            elif data:
+                response["out"].write(data)
+            response["out"].flush()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"], response["headers"] = status, headers
+            return write
+
+        def finish(chunks):
+            for data in chunks:
+                write(data)
+            if not response["sent"]:
+                write(b"")
+            if response["chunked"]:
+                response["out"].write(b"0\r\n\r\n")
+                response["out"].flush()
+
+        body = None
+        try:
+            body = self.server.app(environ, start_response)
+            chunks = iter(body)
+            for data in chunks:
+                write(data)
+                if response["stream"]:
+                    # The worker's file is closed when it moves on
+                    response["out"] = self.connection.makefile("wb")
+                    self.server.start_stream(self.connection, self._stream, body, finish, chunks, response["out"])
+                    body = None
+                    return
+            finish(())
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+            return
+        except Exception:
+            self.close_connection = True
+            self.log_error("Error on request:\n%s", traceback.format_exc())
+            if not response["sent"]:
+                try:
+                    self.send_error(500)
+                except OSError:
+                    pass
+            return
+        finally:
+            if body is not None and hasattr(body, "close"):
+                body.close()
+        if not self.close_connection and not self._body.drain():
+            self.close_connection = True
+
+    def _stream(self, body, finish, chunks, out):
+        """Send the rest of an event stream, on the stream's own thread"""
+        try:
+            finish(chunks)
+        except (OSError, ValueError):
+            pass  # The client went away, or the server closed the stream
+        except Exception:
+            self.log_error("Error on stream:\n%s", traceback.format_exc())
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            try:
+                out.close()
+            except OSError:
+                pass
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server with a fixed number of worker threads.
+
+    Accepted connections wait in a bounded queue for a free worker; when it
+    stays full for queue_timeout seconds the connection gets a 503, so a
+    burst of clients cannot grow threads or memory without limit. A worker
+    serves one connection at a time, for as long as it is kept alive; event
+    streams continue on threads of their own, see start_stream.
+    timeout closes connections that sit idle that long (see DEFAULT_TIMEOUT);
+    it does not limit how long the app takes to answer.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, workers=DEFAULT_WORKERS, backlog=DEFAULT_BACKLOG,
+                 timeout=DEFAULT_TIMEOUT, queue_timeout=1.0):
+        handler = type("KeepAliveRequestHandler", (KeepAliveRequestHandler,), {"timeout": timeout})
+        self.request_queue_size = backlog  # listen() backlog, used while binding
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.rejected = 0
+        self._connections = queue.Queue(maxsize=backlog)
+        self._closed = threading.Event()
+        self._streams = set()  # Connections owned by a stream thread
+        self._streams_lock = threading.Lock()
+        super().__init__(host, port, app, handler=handler)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self._connections.put((request, client_address), timeout=self.queue_timeout)
+        except queue.Full:
+            self.rejected += 1
+            try:
+                request.sendall(OVERLOADED_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def has_waiting_connections(self):
+        return not self._connections.empty()
+
+    def start_stream(self, request, target, *args):
+        """Take a connection from its worker and run target(*args) for it
+        on a new thread, which closes the connection when it returns.
+
+        The number of streams is bounded by the app, see MAX_STREAMS.
+        """
+        with self._streams_lock:
+            self._streams.add(request)
+
+        def run():
+            try:
+                target(*args)
+            finally:
+                with self._streams_lock:
+                    self._streams.discard(request)
+                self.shutdown_request(request)
+        threading.Thread(target=run, daemon=True).start()
+
+    @property
+    def stream_count(self):
+        with self._streams_lock:
+            return len(self._streams)
+
+    def _work(self):
+        while not self._closed.is_set():
+            try:
+                request, client_address = self._connections.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._streams_lock:
+                    streaming = request in self._streams
+                if not streaming:
+                    self.shutdown_request(request)
+
+    def server_close(self):
+        self._closed.set()
+        super().server_close()
+        with self._streams_lock:
+            streams = list(self._streams)
+        for request in streams:
+            # Their next write fails and the stream threads end
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        while True:
+            try:
+                request, _ = self._connections.get_nowait()
+            except queue.Empty:
+                break
+            self.shutdown_request(request)
+
+def make_api_server(app, host, port, mode=None, workers=None, timeout=None):
+    """Create the HTTP server for a Flask app.
+
+    mode is "pool" (default), a PooledWSGIServer, or "dev", werkzeug's
+    thread-per-connection development server. Both default to
+    $CHATAPP_API_SERVER and $CHATAPP_API_WORKERS.
+    """
+    mode = mode or os.environ.get("CHATAPP_API_SERVER", "pool")
+    if app.config.get("MAX_CONTENT_LENGTH") is None:  # Flask defaults to no limit
+        app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+    if mode == "dev":
+        return make_server(host, port, app, threaded=True)
+    if mode != "pool":
+        raise ValueError(f"Unknown API server mode: {mode}")
+    workers = workers or int(os.environ.get("CHATAPP_API_WORKERS", DEFAULT_WORKERS))
+    # /messages/stream clients get threads of their own, not workers
+    app.config.setdefault("MAX_STREAMS", int(os.environ.get("CHATAPP_API_MAX_STREAMS", DEFAULT_MAX_STREAMS)))
+    return PooledWSGIServer(host, port, app, workers=workers,
+                            timeout=timeout if timeout is not None else DEFAULT_TIMEOUT)
@@ -0,0 +1,115 @@
+"""Throughput and write latency of the REST API under mixed reads and writes.
+
+Readers fetch the full history (slow), writers post messages (fast); compares
+the pooled server, werkzeug's thread-per-connection server and a single
+thread, each with and without keep-alive.
+
+Run from the repository root:
+    python benchmarks/bench_api_server.py [--messages 5000] [--readers 8] [--writers 8] [--seconds 5]
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from werkzeug.serving import make_server
+from api import app
+from api_server import make_api_server
+from database.setup_db import setup_database
+
+def fill(database, count):
+    setup_database(database)
+    connection = sqlite3.connect(database)
+    connection.executemany(
+        'INSERT INTO messages (protocol, sender, recipient, message) VALUES (?, ?, ?, ?)',
+        ((("TCP/IP(Server)", "Client", "You", f"sensor reading {i}: temperature=21.{i % 10}C"))
+         for i in range(count))
+    )
+    connection.commit()
+    connection.close()
+
+def start_server(mode, workers):
+    if mode == 'single':
+        server = make_server('127.0.0.1', 0, app, threaded=False)
+    else:
+        server = make_api_server(app, '127.0.0.1', 0, mode=mode, workers=workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def client(url, keep_alive, deadline, read, latencies, errors):
+    session = requests.Session()
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if read:
+                response = session.get(f"{url}/messages", timeout=30)
+            else:
+                response = session.post(f"{url}/messages", timeout=30, json={
+                    "protocol": "TCP/IP(Server)", "sender": "Bench", "recipient": "You", "message": "ping"})
+            ok = response.ok
+        except requests.RequestException:
+            ok = False
+        if not ok:
+            errors.append(1)
+        else:
+            latencies.append(time.perf_counter() - start)
+    session.close()
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(mode, keep_alive, args):
+    server = start_server(mode, args.workers)
+    url = f"http://127.0.0.1:{server.port}"
+    deadline = time.perf_counter() + args.seconds
+    reads, writes, errors = [], [], []
+    threads = [threading.Thread(target=client, args=(url, keep_alive, deadline, True, reads, errors))
+               for _ in range(args.readers)]
+    threads += [threading.Thread(target=client, args=(url, keep_alive, deadline, False, writes, errors))
+                for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    server.server_close()
+
+    label = f"{mode} {'keep-alive' if keep_alive else 'close'}"
+    print(f"{label:>17}: {(len(reads) + len(writes)) / args.seconds:7.1f} req/s "
+          f"({len(reads)} reads, {len(writes)} writes, {len(errors)} errors); "
+          f"POST p50 {percentile(writes, 0.5) * 1000:.1f} ms, p99 {percentile(writes, 0.99) * 1000:.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    for mode in ('pool', 'dev', 'single'):
+        for keep_alive in (True, False):
+            if mode != 'pool' and keep_alive:
+                continue  # werkzeug closes every connection anyway
+            with tempfile.TemporaryDirectory() as directory:
+                database = os.path.join(directory, 'chat.db')
+                fill(database, args.messages)
+                app.config['DATABASE'] = database
+                run(mode, keep_alive, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""File transfer throughput and chat latency while a file is being sent.
+
+Run from the repository root:
+    python benchmarks/bench_file_transfer.py [--size-mb 100] [--no-sendfile]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+from protocols.file_transfer import DEFAULT_CHUNK_SIZE
+
+def write_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[:size % len(block)])
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=100)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--chat-interval", type=float, default=0.05, help="Seconds between chat messages")
+    parser.add_argument("--no-sendfile", action="store_true", help="Copy chunks through Python instead")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "payload.bin")
+        write_file(path, args.size_mb * 1024 * 1024)
+
+        server = EthernetMasterHandler("127.0.0.1", 0, download_dir=os.path.join(directory, "received"))
+        server.set_status_callback(lambda status: None)
+        server.initialize()
+        client = EthernetClientHandler("127.0.0.1", server.port)
+        client.file_transfers.chunk_size = args.chunk_size
+        client.file_transfers.use_sendfile = not args.no_sendfile
+        client.initialize()
+        while not server.connected_clients:
+            time.sleep(0.01)
+
+        start = time.perf_counter()
+        # Checksumming runs in the sender thread and counts towards the transfer time
+        sender = client.file_transfers.send_file(path, None, client.client_socket, client._lock)
+
+        # Chat while the file is on its way, each message carries its send time
+        latencies = []
+        received_file = threading.Event()
+
+        def chat():
+            while not received_file.is_set():
+                client.send("ping")
+                time.sleep(args.chat_interval)
+
+        threading.Thread(target=chat, daemon=True).start()
+        while not received_file.is_set():
+            message = server.receive_message()
+            if message is None:
+                if sender.done.is_set() and not sender.result:
+                    break
+                time.sleep(0.001)
+            elif message.get("type") == "file":
+                received_file.set()
+            else:
+                latencies.append((time.time_ns() - message["sent_ns"]) / 1e6)
+        elapsed = time.perf_counter() - start
+        sender.done.wait(10.0)
+
+        client.cleanup()
+        server.cleanup()
+
+        if not sender.result:
+            print(f"Transfer failed: {sender.error}")
+            return
+        mode = "read + sendall" if args.no_sendfile else "sendfile"
+        print(f"Sent {args.size_mb} MB with {mode} in {elapsed:.2f}s: {args.size_mb / elapsed:.1f} MB/s")
+        if latencies:
+            print(f"Chat during transfer: {len(latencies)} messages, "
+                  f"p50 {percentile(latencies, 0.5):.1f} ms, p99 {percentile(latencies, 0.99):.1f} ms, "
+                  f"max {max(latencies):.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Throughput and tail latency of the Ethernet handlers over impaired links.
+
+The client and server talk through benchmarks/impairment_proxy.py on
+loopback, so no network (or root, as tc netem needs) is required.
+
+Run from the repository root:
+    python benchmarks/bench_impairment.py [--messages 2000] [--size 200] [--round-trips 200] [--links lan wifi]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.impairment_proxy import Impairment, ImpairmentProxy
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+
+LINKS = {
+    "loopback": Impairment(),
+    "lan": Impairment(latency=0.0005, jitter=0.0002, bandwidth=12_500_000),  # 100 Mbit/s
+    "wifi": Impairment(latency=0.003, jitter=0.002, bandwidth=2_500_000),  # 20 Mbit/s
+    "congested": Impairment(latency=0.02, jitter=0.01, bandwidth=125_000, split=536),  # 1 Mbit/s
+}
+
+def connect(link, queue_size):
+    master = EthernetMasterHandler("127.0.0.1", 0, queue_size=queue_size)
+    master.set_status_callback(lambda message: None)
+    master.initialize()
+    proxy = ImpairmentProxy("127.0.0.1", master.port, link, seed=1).start()
+    client = EthernetClientHandler("127.0.0.1", proxy.port, queue_size=queue_size)
+    client.initialize()
+    while not master.connected_clients:
+        time.sleep(0.01)
+    return master, proxy, client
+
+def throughput(master, client, text, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        client.send(text)
+    for _ in range(count):
+        master.message_queue.get(timeout=60)
+    return count / (time.perf_counter() - start)
+
+def round_trips(master, client, count):
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        client.send(f"ping {i}")
+        master.send(master.message_queue.get(timeout=10)["content"])
+        client.message_queue.get(timeout=10)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return [latencies[min(len(latencies) - 1, int(len(latencies) * q))] for q in (0.5, 0.99, 0.999)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=200, help="characters per message")
+    parser.add_argument('--round-trips', type=int, default=200)
+    parser.add_argument('--links', nargs='+', choices=sorted(LINKS), default=list(LINKS))
+    args = parser.parse_args()
+
+    text = "x" * args.size
+    for name in args.links:
+        master, proxy, client = connect(LINKS[name], args.messages)
+        try:
+            rate = throughput(master, client, text, args.messages)
+            p50, p99, p999 = round_trips(master, client, args.round_trips)
+        finally:
+            client.cleanup()
+            proxy.stop()
+            master.cleanup()
+        print(f"{name:>10}: {rate:9,.0f} msg/s ({rate * args.size / 1e6:6.2f} MB/s); round trip "
+              f"p50 {p50 * 1000:6.2f} ms, p99 {p99 * 1000:6.2f} ms, p99.9 {p999 * 1000:6.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Latency and throughput of loopback TCP vs the Unix socket handlers.
+
+Round trip: the client sends a message and waits for the server to echo it.
+Throughput: the client sends --messages messages as fast as it can until the
+server has received them all. Each is measured for small chat messages and
+bulk payloads, over TCP on 127.0.0.1, a Unix socket, and a Unix socket with
+shared memory for bulk content.
+
+Run from the repository root:
+    python benchmarks/bench_local_ipc.py [--round-trips 2000] [--messages 2000] [--bulk-kb 256]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+from protocols.local_handler import LocalMasterHandler, LocalClientHandler
+
+def tcp_pair(directory, queue_size):
+    master = EthernetMasterHandler("127.0.0.1", 0, queue_size=queue_size)
+    master.initialize()
+    return master, EthernetClientHandler("127.0.0.1", master.port, queue_size=queue_size)
+
+def unix_pair(directory, queue_size, shared_memory=False):
+    path = os.path.join(directory, "bench.sock")
+    master = LocalMasterHandler(path, shared_memory=shared_memory, queue_size=queue_size)
+    master.initialize()
+    return master, LocalClientHandler(path, shared_memory=shared_memory, queue_size=queue_size)
+
+def connect(make_pair, directory, queue_size):
+    master, client = make_pair(directory, queue_size)
+    master.set_status_callback(lambda message: None)
+    client.initialize()
+    while not master.connected_clients:
+        time.sleep(0.01)
+    return master, client
+
+def round_trips(master, client, text, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        client.send(text)
+        master.send(master.message_queue.get(timeout=10)["content"])
+        client.message_queue.get(timeout=10)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def throughput(master, client, text, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        client.send(text)
+    for _ in range(count):
+        master.message_queue.get(timeout=30)
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--round-trips', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--bulk-kb', type=int, default=256)
+    args = parser.parse_args()
+
+    transports = (
+        ("tcp loopback", tcp_pair),
+        ("unix socket", unix_pair),
+        ("unix + shm", lambda directory, size: unix_pair(directory, size, shared_memory=True)),
+    )
+    payloads = (("100 B", "x" * 100), (f"{args.bulk_kb} KiB", "x" * (args.bulk_kb * 1024)))
+    for size_label, text in payloads:
+        round_trip_count = args.round_trips if len(text) < 10000 else args.round_trips // 10
+        message_count = args.messages if len(text) < 10000 else args.messages // 10
+        for label, make_pair in transports:
+            with tempfile.TemporaryDirectory() as directory:
+                master, client = connect(make_pair, directory, message_count)
+                try:
+                    p50, p99 = round_trips(master, client, text, round_trip_count)
+                    rate = throughput(master, client, text, message_count)
+                finally:
+                    client.cleanup()
+                    master.cleanup()
+            print(f"{size_label:>8} {label:>12}: round trip p50 {p50 * 1e6:8.1f} us, "
+                  f"p99 {p99 * 1e6:8.1f} us; {rate:10,.0f} msg/s ({rate * len(text) / 1e6:8.1f} MB/s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Fan-out cost of the TCP master vs UDP multicast as the number of peers grows.
+
+All peers run in this process on the loopback interface. For each peer count
+the sender sends --messages chat messages; reported are the time spent in
+send() and the time until every peer has received all of them.
+
+Run from the repository root:
+    python benchmarks/bench_multicast.py [--messages 2000] [--peers 1 2 4 8 16]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+from protocols.multicast_handler import MulticastHandler
+
+GROUP = "239.255.42.99"
+
+def wait_for(receivers, count, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while any(r.message_queue.qsize() < count for r in receivers):
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+def measure(sender, receivers, args):
+    text = "x" * args.size
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        sender.send(text)
+    sent = time.perf_counter() - start
+    complete = wait_for(receivers, args.messages)
+    delivered = time.perf_counter() - start
+    return sent, delivered if complete else float('nan')
+
+def tcp(peers, args):
+    master = EthernetMasterHandler("127.0.0.1", 0, queue_size=args.messages)
+    master.set_status_callback(lambda message: None)
+    master.initialize()
+    clients = [EthernetClientHandler("127.0.0.1", master.port, queue_size=args.messages)
+               for _ in range(peers)]
+    for client in clients:
+        client.initialize()
+    while len(master.connected_clients) < peers:
+        time.sleep(0.01)
+    try:
+        return measure(master, clients, args) + ("",)
+    finally:
+        for handler in clients + [master]:
+            handler.cleanup()
+
+def multicast(peers, args):
+    options = dict(group=GROUP, interface="127.0.0.1", queue_size=args.messages)
+    receivers = [MulticastHandler(port=0, **options)]
+    receivers[0].initialize()
+    for _ in range(peers - 1):
+        receivers.append(MulticastHandler(port=receivers[0].port, **options))
+        receivers[-1].initialize()
+    sender = MulticastHandler(port=receivers[0].port, **options)
+    sender.initialize()
+    try:
+        sent, delivered = measure(sender, receivers, args)
+        stats = sender.stats()
+        lost = sum(r.stats()["lost"] for r in receivers)
+        return sent, delivered, (f"{stats['datagrams_sent']} datagrams, "
+                                 f"{stats['retransmitted']} resent, {lost} lost")
+    finally:
+        for handler in receivers + [sender]:
+            handler.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=100, help="characters per message")
+    parser.add_argument('--peers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    for peers in args.peers:
+        for label, run in (("tcp", tcp), ("multicast", multicast)):
+            sent, delivered, details = run(peers, args)
+            print(f"{peers:>3} peers {label:>9}: send {sent / args.messages * 1e6:7.1f} us/msg, "
+                  f"all delivered after {delivered * 1000:7.1f} ms "
+                  f"({args.messages * peers / delivered:,.0f} msg/s) {details}")
+
+if __name__ == '__main__':
+    main()
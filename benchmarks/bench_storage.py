@@ -0,0 +1,90 @@
+"""Write and read throughput of the SQLite store against the message log.
+
+Run from the repository root:
+    python benchmarks/bench_storage.py [--messages 100000] [--single 2000] [--fsync]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.message_log import LogStore
+from database.storage import SQLiteStore
+
+def make_messages(count, start=0):
+    now = time.time_ns()
+    return [{
+        "protocol": "UART/Serial" if i % 4 else "TCP/IP(Server)",
+        "sender": "Sensor",
+        "recipient": "You",
+        "message": f"can frame {i}: id=0x1{i % 256:02x} data=00 11 22 33 44 55 66 77",
+        "sent_ns": now + i,
+        "recv_ns": now + i + 1000,
+    } for i in range(start, start + count)]
+
+def rate(count, seconds):
+    return f"{count / seconds:>12,.0f} msg/s"
+
+def run(name, store, args):
+    results = {}
+    # One insert per API request, which is what the Flask route does
+    messages = make_messages(args.single)
+    start = time.perf_counter()
+    for data in messages:
+        store.insert(data)
+    results["insert (one per call)"] = rate(args.single, time.perf_counter() - start)
+
+    messages = make_messages(args.messages, args.single)
+    start = time.perf_counter()
+    for i in range(0, len(messages), args.batch_size):
+        store.insert_many(messages[i:i + args.batch_size])
+    results[f"insert_many ({args.batch_size} per call)"] = rate(args.messages, time.perf_counter() - start)
+
+    total = store.max_id()
+    start = time.perf_counter()
+    last_id = 0
+    replayed = 0
+    while True:
+        rows = store.fetch_after(last_id, limit=1000)
+        if not rows:
+            break
+        replayed += len(rows)
+        last_id = rows[-1]["id"]
+    results["sequential replay"] = rate(replayed, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    read = 0
+    for _ in range(args.range_reads):
+        first = random.randint(1, max(1, total - 100))
+        read += len(store.read_range(first, first + 99))
+    results["id-range reads (100 ids)"] = rate(read, time.perf_counter() - start)
+
+    print(name)
+    for label, value in results.items():
+        print(f"  {label:<28}{value}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000, help="Messages written in batches")
+    parser.add_argument("--single", type=int, default=2000, help="Messages written one at a time")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--range-reads", type=int, default=500)
+    parser.add_argument("--fsync", action="store_true", help="fsync the log after every write, like a SQLite commit")
+    args = parser.parse_args()
+    random.seed(1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteStore(os.path.join(directory, "chat_history.db"))
+        run("sqlite", store, args)
+        store.close()
+
+        store = LogStore(os.path.join(directory, "message_log"), fsync=args.fsync)
+        run("log" + (" (fsync)" if args.fsync else ""), store, args)
+        store.close()
+
+if __name__ == "__main__":
+    main()
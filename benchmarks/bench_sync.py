@@ -0,0 +1,90 @@
+"""Catch-up time for a device that missed 100k messages.
+
+Run from the repository root:
+    python benchmarks/bench_sync.py [--messages 100000] [--batch-size 1000]
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from werkzeug.serving import make_server
+from api import app
+from database.setup_db import setup_database
+from database.sync import SyncClient
+
+def fill(database, count):
+    setup_database(database)
+    connection = sqlite3.connect(database)
+    connection.executemany(
+        'INSERT INTO messages (protocol, sender, recipient, message) VALUES (?, ?, ?, ?)',
+        ((("TCP/IP(Server)", "Client", "You", f"sensor reading {i}: temperature=21.{i % 10}C"))
+         for i in range(count))
+    )
+    connection.commit()
+    connection.close()
+
+class CountingSession(requests.Session):
+    """Counts bytes on the wire (before decompression)"""
+    def __init__(self):
+        super().__init__()
+        self.wire_bytes = 0
+        self.requests = 0
+
+    def get(self, *args, **kwargs):
+        response = super().get(*args, **kwargs)
+        self.requests += 1
+        self.wire_bytes += int(response.headers.get('Content-Length', 0))
+        return response
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as directory:
+        peer = os.path.join(directory, 'peer.db')
+        local = os.path.join(directory, 'local.db')
+        start = time.perf_counter()
+        fill(peer, args.messages)
+        setup_database(local)
+        print(f"Filled peer with {args.messages} messages in {time.perf_counter() - start:.2f}s")
+
+        app.config['DATABASE'] = peer
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.port}"
+
+        for label, encoding in (("deflate", "gzip, deflate"), ("uncompressed", "identity")):
+            if os.path.exists(local):
+                os.unlink(local)
+            setup_database(local)
+            session = CountingSession()
+            session.headers['Accept-Encoding'] = encoding
+            client = SyncClient(url, local, batch_size=args.batch_size, session=session)
+
+            start = time.perf_counter()
+            received = client.pull()
+            elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            again = client.pull()
+            idle = time.perf_counter() - start
+
+            print(f"{label:>12}: caught up {received} messages in {elapsed:.2f}s "
+                  f"({received / elapsed:,.0f} msg/s, {session.requests} requests, "
+                  f"{session.wire_bytes / 1e6:.1f} MB on the wire); "
+                  f"up-to-date pull: {again} rows in {idle * 1000:.1f} ms")
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
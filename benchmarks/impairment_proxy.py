@@ -0,0 +1,256 @@
+"""TCP proxy that makes a loopback connection behave like a real network.
+
+Put it between an EthernetMasterHandler and its EthernetClientHandlers to
+add latency, jitter, a bandwidth limit, split or coalesced segments and
+connection resets, without any network or root privileges (unlike tc netem):
+
+    proxy = ImpairmentProxy("127.0.0.1", master.port, Impairment(latency=0.005, split=7))
+    proxy.start()
+    client = EthernetClientHandler("127.0.0.1", proxy.port)
+"""
+import queue
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+RECV_SIZE = 65536
+
+class Impairment:
+    """What happens to the bytes flowing in one direction.
+
+    latency, jitter: seconds added to every read, jitter uniformly in
+        [-jitter, jitter]; data is never reordered
+    bandwidth: bytes per second, None for unlimited
+    split: forward data in writes of 1 to split bytes, so the receiver sees
+        messages cut at arbitrary points
+    coalesce: seconds to hold data back so consecutive writes arrive together
+    reset_after: bytes after which the connection is reset
+    """
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, split=None,
+                 coalesce=0.0, reset_after=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.split = split
+        self.coalesce = coalesce
+        self.reset_after = reset_after
+
+def _reset(sock):
+    """Close with an RST instead of a FIN"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        sock.close()
+    except OSError:
+        pass
+
+class _Pipe:
+    """Forwards one direction of a connection: a reader thread timestamps
+    the data, a writer thread delivers it when due"""
+    def __init__(self, connection, source, destination, impairment, rng):
+        self.connection = connection
+        self.source = source
+        self.destination = destination
+        self.impairment = impairment
+        self.rng = rng
+        self.forwarded = 0
+        self._due = queue.Queue()  # (delivery time, data), None at the end
+        self._held = None  # Taken from _due too early while coalescing
+        self._last_due = 0.0
+        self._link_free = 0.0  # When the bandwidth-limited link is idle again
+
+    def start(self):
+        threading.Thread(target=self._read, daemon=True).start()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def _read(self):
+        impairment = self.impairment
+        while not self.connection.closed:
+            try:
+                # Wait with a timeout so a reset connection is noticed
+                if not select.select([self.source], [], [], 0.2)[0]:
+                    continue
+                data = self.source.recv(RECV_SIZE)
+            except (OSError, ValueError):
+                break
+            if not data:
+                break
+            due = time.monotonic() + impairment.latency
+            if impairment.jitter:
+                due += self.rng.uniform(-impairment.jitter, impairment.jitter)
+            self._last_due = max(self._last_due, due)  # No reordering
+            self._due.put((self._last_due, data))
+        self._due.put(None)
+
+    def _write(self):
+        impairment = self.impairment
+        while True:
+            item, self._held = self._held or self._due.get(), None
+            if item is None:
+                self.connection.half_close(self.destination)
+                return
+            due, data = item
+            if impairment.coalesce:
+                due += impairment.coalesce
+                self._sleep_until(due)
+                data, finished = self._take_ready(data, due)
+            else:
+                finished = False
+            if impairment.bandwidth:
+                start = max(due, self._link_free)
+                self._link_free = start + len(data) / impairment.bandwidth
+                due = self._link_free
+            self._sleep_until(due)
+            if not self._send(data):
+                return
+            if finished:
+                self.connection.half_close(self.destination)
+                return
+
+    def _take_ready(self, data, due):
+        """Append everything that is due by then, returns (data, ended)"""
+        parts = [data]
+        while True:
+            try:
+                item = self._due.get_nowait()
+            except queue.Empty:
+                return b"".join(parts), False
+            if item is None:
+                return b"".join(parts), True
+            if item[0] > due:
+                self._held = item  # Not due yet, goes in the next write
+                return b"".join(parts), False
+            parts.append(item[1])
+
+    @staticmethod
+    def _sleep_until(due):
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _send(self, data):
+        impairment = self.impairment
+        if impairment.reset_after is not None:
+            allowed = impairment.reset_after - self.forwarded
+            if allowed < len(data):
+                self._sendall(data[:max(allowed, 0)])
+                self.connection.reset()
+                return False
+        if not impairment.split:
+            return self._sendall(data)
+        offset = 0
+        while offset < len(data):
+            size = self.rng.randint(1, impairment.split)
+            if not self._sendall(data[offset:offset + size]):
+                return False
+            offset += size
+            time.sleep(0.0002)  # Give the receiver a chance to read each piece on its own
+        return True
+
+    def _sendall(self, data):
+        try:
+            self.destination.sendall(data)
+        except OSError:
+            self.connection.close()
+            return False
+        self.forwarded += len(data)
+        return True
+
+class ProxiedConnection:
+    def __init__(self, client, server, upstream, downstream, rng):
+        self.client = client
+        self.server = server
+        self.closed = False
+        for sock in (client, server):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.upstream = _Pipe(self, client, server, upstream, rng)
+        self.downstream = _Pipe(self, server, client, downstream, rng)
+        self._half_closed = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.upstream.start()
+        self.downstream.start()
+
+    def half_close(self, sock):
+        """Pass on an end of stream, closes once both directions ended"""
+        with self._lock:
+            self._half_closed.add(sock)
+            both = len(self._half_closed) == 2
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        if both:
+            self.close()
+
+    def reset(self):
+        """Drop the connection with an RST to both ends"""
+        self.closed = True
+        _reset(self.client)
+        _reset(self.server)
+
+    def close(self):
+        self.closed = True
+        for sock in (self.client, self.server):
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+class ImpairmentProxy:
+    """Accepts connections on listen_port and forwards each to the target,
+    impairing client to server traffic with `upstream` and server to client
+    traffic with `downstream` (the same as upstream unless given)"""
+    def __init__(self, target_host, target_port, upstream=None, downstream=None,
+                 listen_host="127.0.0.1", listen_port=0, seed=None):
+        self.target = (target_host, target_port)
+        self.upstream = upstream or Impairment()
+        self.downstream = downstream or self.upstream
+        self.rng = random.Random(seed)
+        self.connections = []
+        self.is_running = False
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((listen_host, listen_port))
+        self.port = self._listener.getsockname()[1]
+
+    def start(self):
+        self._listener.listen(16)
+        self.is_running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while self.is_running:
+            try:
+                client, _ = self._listener.accept()
+            except OSError:
+                return
+            try:
+                server = socket.create_connection(self.target)
+            except OSError:
+                _reset(client)
+                continue
+            connection = ProxiedConnection(client, server, self.upstream, self.downstream, self.rng)
+            self.connections.append(connection)
+            connection.start()
+
+    def active_connections(self):
+        return [connection for connection in self.connections if not connection.closed]
+
+    def reset_connections(self):
+        """Reset every open connection, as a dropped link or a rebooted peer would"""
+        for connection in self.active_connections():
+            connection.reset()
+
+    def stop(self):
+        self.is_running = False
+        try:
+            self._listener.close()
+        except OSError:
+            pass
+        for connection in self.connections:
+            connection.close()
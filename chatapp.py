@@ -1,4 +1,13 @@
-import requests
+import time
+_PROCESS_START = time.perf_counter()
+
+import sys
+from profiling import configure as configure_profiling
+# Before Kivy (which rejects unknown options) and the modules that use the
+# profiler are imported: --profile[=cprofile|sample], --profile-seconds=N
+profiler = configure_profiling(sys.argv)
+
+import os
 import sqlite3
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
@@ -8,14 +17,28 @@ from kivy.properties import ListProperty
 from kivy.clock import Clock
 from protocols.uart_handler import UARTHandler
 from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+from protocols.multicast_handler import MulticastHandler
+from protocols.local_handler import LocalMasterHandler, LocalClientHandler
+from protocols.message_bus import MessageBus
+from protocols.bounded_queue import SPILL
+from message_feed import MessageFeed, parse_last_event_id
+from database.setup_db import setup_database
+from database.history_cache import HistoryCache
+from database.messages import missing_fields
+from database.storage import SQLiteStore, open_store
+from database.sync import DEFAULT_BATCH_SIZE, SyncClient, encode_batch, export_changes
 from functools import partial
+from collections import deque
 from kivy.uix.widget import Widget
-from flask import Flask, request, jsonify
 import threading
-from werkzeug.serving import make_server
 import socket
 
-def find_free_port(start_port=1000, max_attempts=100):
+# Flask, werkzeug and requests are imported where they are used so the window
+# can appear before the API server has been brought up in the background.
+
+CHAT_HISTORY_LIMIT = 200  # Messages shown when opening a protocol's chat
+
+def find_free_port(start_port=5000, max_attempts=100):
     """Find a free port starting from start_port"""
     for port in range(start_port, start_port + max_attempts):
         try:
@@ -26,11 +49,48 @@ def find_free_port(start_port=1000, max_attempts=100):
             continue
     raise RuntimeError(f"Could not find a free port after {max_attempts} attempts")
 
+def discover_host_ip():
+    """Find the LAN address of this device without a (possibly slow) DNS lookup"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            # Connecting a UDP socket only selects a route, no packet is sent
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+    except OSError:
+        return "127.0.0.1"
+
+class StartupProfile:
+    """Records named startup milestones relative to process start"""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.marks = []
+        self._lock = threading.Lock()
+
+    def mark(self, name):
+        if self.enabled:
+            with self._lock:
+                self.marks.append((name, time.perf_counter()))
+
+    def report(self):
+        lines = ["Startup profile (ms since process start):"]
+        previous = _PROCESS_START
+        with self._lock:
+            marks = sorted(self.marks, key=lambda mark: mark[1])
+        for name, timestamp in marks:
+            lines.append(
+                f"  {name:<20} {(timestamp - _PROCESS_START) * 1000:8.1f}"
+                f"  (+{(timestamp - previous) * 1000:.1f})"
+            )
+            previous = timestamp
+        return "\n".join(lines)
+
 class FlaskThread(threading.Thread):
     def __init__(self, app, port):  # Add port parameter
+        from api_server import make_api_server
         threading.Thread.__init__(self, daemon=True)
-        # Allow connections from other devices
-        self.srv = make_server('0.0.0.0', port, app)
+        # Allow connections from other devices. A pool of workers serves
+        # requests concurrently, see api_server.py
+        self.srv = make_api_server(app, '0.0.0.0', port)
         self.ctx = app.app_context()
         self.ctx.push()
         self.port = port  # Store port number
@@ -40,108 +100,173 @@ class FlaskThread(threading.Thread):
 
     def shutdown(self):
         self.srv.shutdown()
+        self.srv.server_close()
 
 class MessageBubble(Label):
     bubble_color = ListProperty([0, 0, 0, 0])
 
 class ChatApp(App):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Set once the API server is up, see _start_services
+        self.base_url = None
+        self.message_store = None  # Opened in the background, see initialize_database
+        self.history_cache = None
+        # Protocol -> (ETag, messages) of the last history response
+        self._history_responses = {}
+        self._api_ready = threading.Event()
+        # Set CHATAPP_STARTUP_PROFILE=1 to print startup timings
+        self.startup_profile = StartupProfile(
+            enabled=os.environ.get("CHATAPP_STARTUP_PROFILE") == "1"
+        )
+        self.startup_profile.mark("imports done")
+        # All running protocol handlers publish here; the UI view and the
+        # database writer each consume through their own bounded queue. The
+        # view may lose messages it can't keep up with, they are in the
+        # history; the writer must not, so its overflow goes to disk.
+        self.message_bus = MessageBus()
+        self.view_subscription = self.message_bus.subscribe("view", maxsize=500)
+        self.persist_subscription = self.message_bus.subscribe("persistence", maxsize=10000, policy=SPILL)
+        # Protocol -> messages received while another protocol was on screen,
+        # shown on selection unless the history already has them
+        self._offscreen = {}
+        self.active_protocols = set()
+        # (uid, render_ns, attempts) waiting to be stored by _persist_messages
+        self._render_times = deque()
+
     def initialize_database(self):
         """Initialize the database if it doesn't exist"""
+        setup_database("database/chat_history.db")
+        # $CHATAPP_STORAGE=log keeps messages in the append-only log instead
+        self.message_store = open_store()
+        self.history_cache = HistoryCache(self.message_store, size=CHAT_HISTORY_LIMIT)
+
+    def _connect_db(self):
         connection = sqlite3.connect("database/chat_history.db")
-        cursor = connection.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            protocol TEXT NOT NULL,
-            sender TEXT NOT NULL,
-            recipient TEXT NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        connection.commit()
-        connection.close()
+        connection.row_factory = sqlite3.Row
+        return connection
 
     def setup_api(self):
         """Initialize and setup Flask API"""
+        from flask import Flask, Response, request, jsonify
+        from werkzeug.exceptions import HTTPException
+        from api_server import MAX_CONTENT_LENGTH
         self.flask_app = Flask(__name__)
+        self.flask_app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+        # One producer serves every /messages/stream client
+        self.message_feed = MessageFeed(lambda: self.message_store)
 
         @self.flask_app.route('/messages', methods=['GET'])
+        @profiler.timed("api GET /messages")
         def get_messages():
             protocol = request.args.get('protocol')
-            connection = sqlite3.connect("database/chat_history.db")
-            connection.row_factory = sqlite3.Row
-            try:
-                cursor = connection.cursor()
-                if protocol:
-                    messages = cursor.execute(
-                        'SELECT * FROM messages WHERE protocol = ? ORDER BY timestamp',
-                        [protocol]
-                    ).fetchall()
-                else:
-                    messages = cursor.execute(
-                        'SELECT * FROM messages ORDER BY timestamp'
-                    ).fetchall()
-                return jsonify([dict(msg) for msg in messages])
-            finally:
-                connection.close()
+            limit = request.args.get('limit', type=int)
+            if limit is not None and limit <= 0:
+                return jsonify({'error': 'limit must be a positive number'}), 400
+            # Unchanged history costs two index lookups instead of a query and encode
+            version = self.history_cache.version()
+            if request.if_none_match.contains(version):
+                response = Response(status=304)
+            else:
+                response = jsonify(self.history_cache.list(protocol, limit))
+            response.set_etag(version)
+            return response
 
         @self.flask_app.route('/messages', methods=['POST'])
+        @profiler.timed("api POST /messages")
         def add_message():
             try:
                 data = request.get_json()
                 
                 # Check for required fields
-                required_fields = ['protocol', 'sender', 'recipient', 'message']
-                missing_fields = [field for field in required_fields if field not in data]
+                missing = missing_fields(data)
                 
-                if missing_fields:
+                if missing:
                     return jsonify({
                         'error': 'Missing required fields',
-                        'missing_fields': missing_fields
+                        'missing_fields': missing
                     }), 400
 
-                connection = sqlite3.connect("database/chat_history.db")
-                cursor = connection.cursor()
-                
-                cursor.execute('''
-                    INSERT INTO messages (protocol, sender, recipient, message)
-                    VALUES (?, ?, ?, ?)
-                ''', [data['protocol'], data['sender'], data['recipient'], data['message']])
-                
-                message_id = cursor.lastrowid
-                connection.commit()
-                connection.close()
+                message_id = self.message_store.insert(data)
+                self.message_feed.notify()
                 
                 return jsonify({'id': message_id}), 201
                 
+            except HTTPException:
+                raise  # e.g. 413 for a body over MAX_CONTENT_LENGTH
+            except Exception as e:
+                return jsonify({'error': str(e)}), 400
+
+        @self.flask_app.route('/messages/trace', methods=['POST'])
+        @profiler.timed("api POST /messages/trace")
+        def add_render_times():
+            """Record when messages were shown, body is a list of {uid, render_ns}"""
+            try:
+                missing = self.history_cache.record_render_times(request.get_json())
+                return jsonify({'missing': missing})
+            except HTTPException:
+                raise
             except Exception as e:
                 return jsonify({'error': str(e)}), 400
 
+        @self.flask_app.route('/messages/stream', methods=['GET'])
+        def stream_messages():
+            """Push new messages as Server-Sent Events, optionally for one protocol"""
+            try:
+                last_event_id = parse_last_event_id(
+                    request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+                )
+            except ValueError:
+                return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+            protocol = request.args.get('protocol')
+            # Taken now, not when the stream starts, so MAX_STREAMS holds under load
+            subscription = self.message_feed.subscribe(protocol, self.flask_app.config.get('MAX_STREAMS'))
+            if subscription is None:
+                return jsonify({'error': 'Too many streams'}), 503, {'Retry-After': '5'}
+            response = Response(
+                self.message_feed.stream(protocol, last_event_id, subscription),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+            # Also when the stream is never started, e.g. the client went away
+            response.call_on_close(lambda: self.message_feed.unsubscribe(subscription))
+            return response
+
+        @self.flask_app.route('/sync/changes', methods=['GET'])
+        @profiler.timed("api GET /sync/changes")
+        def sync_changes():
+            """Messages after a row id, for peers replicating this history"""
+            if not isinstance(self.message_store, SQLiteStore):
+                return jsonify({'error': 'History sync needs the sqlite storage backend'}), 501
+            connection = self._connect_db()
+            try:
+                batch = export_changes(
+                    connection,
+                    since=request.args.get('since', 0, type=int),
+                    limit=request.args.get('limit', DEFAULT_BATCH_SIZE, type=int),
+                    exclude_origin=request.args.get('exclude_origin')
+                )
+            finally:
+                connection.close()
+            body, headers = encode_batch(batch, request.headers.get('Accept-Encoding', ''))
+            return Response(body, mimetype='application/json', headers=headers)
+
     def build(self):
-        # Initialize database before starting the app
-        self.initialize_database()
-        
-        # Find a free port for the API server
-        self.api_port = find_free_port()
-        
-        # Setup and start API server
-        self.setup_api()
-        self.flask_thread = FlaskThread(self.flask_app, self.api_port)
-        self.flask_thread.start()
-        
-        # Get the actual IP address of this device
-        hostname = socket.gethostname()
-        self.host_ip = socket.gethostbyname(hostname)
-        
-        # Update base URL to use actual IP
-        self.base_url = f"http://{self.host_ip}:{self.api_port}/messages"
-        
-        # Initialize protocol handlers with actual IP
-        self.protocol_port = 5001  # Fixed port for easier confialreadyguration
+        self.startup_profile.mark("build")
+        # With --profile=cprofile or sample, capture the first seconds of use
+        profiler.start_capture()
+        Clock.schedule_once(lambda dt: profiler.stop_capture(), profiler.seconds)
+
+        # Protocol handlers only open sockets when selected, so building
+        # them here is cheap
+        self.protocol_port = 5001  # Fixed port for easier configuration
         self.protocol_handlers = {
             "TCP/IP(Server)": EthernetMasterHandler(host="127.0.0.1", port=self.protocol_port),
             "TCP/IP(Client)": EthernetClientHandler(host="127.0.0.1", port=self.protocol_port),
+            # Other processes on this Pi, e.g. a logger or test tools
+            "Local(Server)": LocalMasterHandler(path="/tmp/chatapp.sock"),
+            "Local(Client)": LocalClientHandler(path="/tmp/chatapp.sock"),
+            "UDP Multicast": MulticastHandler(group="239.255.42.99", port=self.protocol_port + 1),
             "UART/Serial": UARTHandler(port="/dev/ttyUSB0", baudrate=9600),
             # Future protocols:
             # "SPI": SPIHandler(bus=0, device=0),
@@ -154,8 +279,76 @@ class ChatApp(App):
         self.scroll_to_bottom = Clock.create_trigger(self._scroll_to_bottom, timeout=0.1)
         self.start_receiving()
         self.connection_lost_shown = False  # Add flag for connection message
+
+        # Database, API server and IP discovery come up in the background so
+        # the first frame is not held back by them
+        self._pending_startup = {"first frame", "services"}
+        threading.Thread(target=self._start_services, daemon=True).start()
+        from kivy.core.window import Window
+        Window.bind(on_flip=self._on_first_frame)
         return self.root
 
+    def _start_services(self):
+        self.initialize_database()
+        self.setup_api()
+        self.api_port = find_free_port()
+        self.flask_thread = FlaskThread(self.flask_app, self.api_port)
+        self.flask_thread.start()
+        # The API is only used by this app, so talk to it over loopback
+        self.base_url = f"http://127.0.0.1:{self.api_port}/messages"
+        self._api_ready.set()
+        self.startup_profile.mark("api ready")
+
+        self.host_ip = discover_host_ip()
+        self.startup_profile.mark("host ip")
+        Clock.schedule_once(lambda dt: self._startup_step_done("services"))
+
+        # Comma separated peer API URLs, e.g. http://192.168.1.100:5000
+        peers = [url.strip() for url in os.environ.get("CHATAPP_SYNC_PEERS", "").split(",") if url.strip()]
+        if peers and isinstance(self.message_store, SQLiteStore):
+            self._sync_history(peers)
+        elif peers:
+            print("History sync needs the sqlite storage backend, not syncing")
+
+    def _sync_history(self, peers, interval=30.0):
+        """Keep pulling message history from other devices (background thread)"""
+        clients = [SyncClient(url, "database/chat_history.db") for url in peers]
+        while True:
+            self._sync_peers(clients)
+            time.sleep(interval)
+
+    def _sync_peers(self, clients):
+        """Pull once from every peer; a failing peer is logged and retried
+        next time, without stopping the others or the sync thread"""
+        import requests
+        for client in clients:
+            try:
+                received = client.pull()
+                if received:
+                    print(f"Synced {received} messages from {client.peer_url}")
+                    self.message_feed.notify()
+            except requests.exceptions.RequestException as e:
+                print(f"Sync with {client.peer_url} failed: {str(e)}")
+            except Exception as e:
+                # e.g. a database error, or a batch or row the peer got wrong
+                print(f"Sync with {client.peer_url} failed: {type(e).__name__}: {str(e)}")
+
+    def _on_first_frame(self, window):
+        window.unbind(on_flip=self._on_first_frame)
+        self.startup_profile.mark("first frame")
+        self._startup_step_done("first frame")
+
+    def _startup_step_done(self, step):
+        self._pending_startup.discard(step)
+        if not self._pending_startup and self.startup_profile.enabled:
+            print(self.startup_profile.report())
+
+    def _api_url(self, timeout=5.0):
+        """Return the API base URL, waiting briefly if the server is still starting"""
+        if self.base_url is None:
+            self._api_ready.wait(timeout)
+        return self.base_url
+
     def _scroll_to_bottom(self, dt):
         scroll_view = self.root.ids.chat_scroll
         if (scroll_view):
@@ -179,61 +372,109 @@ class ChatApp(App):
     def select_protocol(self, protocol):
         # Reset connection lost flag when switching protocols
         self.connection_lost_shown = False
-        # Cleanup previous protocol if exists
-        if self.current_protocol and hasattr(self.protocol_handlers[self.current_protocol], 'cleanup'): 
-            print("Cleaning up previous protocol")
-            cleanup_msg = self.protocol_handlers[self.current_protocol].cleanup()
-            if cleanup_msg:
-                self.add_message_bubble("System", cleanup_msg, False)
-            
+        # Show what arrived for the old protocol before the view filter changes
+        self._drain_view()
+        # Other protocols keep running in the background, switching only
+        # changes which one is shown
         self.current_protocol = protocol
         self.setup_protocol_list()
         
-        # Initialize new protocol
         handler = self.protocol_handlers[protocol]
-        #if hasattr(handler, 'initialize'):initialize
-        status_message = handler.initialize()
+        status_message = None
+        # (Re)initialize on first use, or when the handler has stopped, e.g. a
+        # client that lost its server
+        if protocol not in self.active_protocols or not getattr(handler, 'is_running', True):
+            if protocol in self.active_protocols:
+                handler.cleanup()
+            status_message = handler.initialize()
+            self.active_protocols.add(protocol)
+            if protocol.startswith(("TCP/IP", "Local", "UDP")):
+                self.message_bus.attach(protocol, handler)
 
-        self.load_chat_history()
-        self.add_message_bubble("System", status_message, False)
+        shown = self.load_chat_history()
+        # Received but possibly not stored when the history was read
+        for message in self._offscreen.pop(protocol, ()):
+            if message["uid"] not in shown:
+                self._show_received(message)
+        if status_message:
+            self.add_message_bubble("System", status_message, False)
 
     def start_receiving(self):
+        self.message_bus.start()
+        threading.Thread(target=self._persist_messages, daemon=True).start()
         # Schedule periodic checking for new messages
         Clock.schedule_interval(self._check_messages, 0.1)  # Check every 100ms
 
-    def _check_messages(self, dt):
-        if not self.current_protocol:
-            return
-        
-        if self.current_protocol.startswith("TCP/IP"):  # Update condition
-            handler = self.protocol_handlers[self.current_protocol]
-            
-            # Check if client lost connection
-            if isinstance(handler, EthernetClientHandler) and not handler.connected:
-                if not self.connection_lost_shown:
-                    self.add_message_bubble("System", "Lost connection to server", False)
-                    self.connection_lost_shown = True
-                return
-                
-            # Reset the flag when connected
-            if isinstance(handler, EthernetClientHandler) and handler.connected:
-                self.connection_lost_shown = False
-                
-            response = handler.receive()
-            if response != "No messages":
-                # Save received message to database
+    def _sender_name(self, protocol):
+        handler = self.protocol_handlers.get(protocol)
+        if isinstance(handler, MulticastHandler):
+            return "Peer"
+        return "Client" if isinstance(handler, EthernetMasterHandler) else "Master"
+
+    def _persist_messages(self):
+        """Save every received message, whichever protocol is on screen, and
+        report when the UI showed it"""
+        import requests
+        session = requests.Session()
+        while self.message_bus.is_running:
+            message = self.persist_subscription.get(timeout=0.5)
+            if message is not None:
                 data = {
-                    "protocol": self.current_protocol,
-                    "sender": "Client" if isinstance(handler, EthernetMasterHandler) else "Master",
+                    "protocol": message["protocol"],
+                    "sender": self._sender_name(message["protocol"]),
                     "recipient": "You",
-                    "message": response
+                    "message": message["content"],
+                    "uid": message["uid"],
                 }
+                for field in ("sent_ns", "recv_ns", "enqueue_ns", "dequeue_ns"):
+                    data[field] = message.get(field)
                 try:
-                    requests.post(self.base_url, json=data)
-                    self.add_message_bubble(data["sender"], response, False)
+                    with profiler.stage("persist.post"):
+                        session.post(self._api_url(), json=data)
                 except requests.exceptions.RequestException:
                     pass  # Silently fail database updates
+            self._flush_render_times(session)
+
+    def _flush_render_times(self, session):
+        import requests
+        stamps = []
+        while self._render_times:
+            stamps.append(self._render_times.popleft())
+        if not stamps:
+            return
+        try:
+            response = session.post(f"{self._api_url()}/trace", json=[
+                {"uid": uid, "render_ns": render_ns} for uid, render_ns, _ in stamps
+            ])
+            missing = set(response.json().get("missing", []))
+        except (requests.exceptions.RequestException, ValueError):
+            return
+        # Shown before it was stored, try again on the next round
+        for uid, render_ns, attempts in stamps:
+            if uid in missing and attempts < 5:
+                self._render_times.append((uid, render_ns, attempts + 1))
+
+    @profiler.timed("ui.check_messages")
+    def _check_messages(self, dt):
+        self._drain_view()
+
+        if not self.current_protocol:
+            return
+        
+        handler = self.protocol_handlers[self.current_protocol]
+            
+        # Check if client lost connection
+        if isinstance(handler, EthernetClientHandler) and not handler.connected:
+            if not self.connection_lost_shown:
+                self.add_message_bubble("System", "Lost connection to server", False)
+                self.connection_lost_shown = True
+            return
+            
+        # Reset the flag when connected
+        if isinstance(handler, EthernetClientHandler) and handler.connected:
+            self.connection_lost_shown = False
 
+    @profiler.timed("ui.send_message")
     def send_message(self):
         if not self.current_protocol:
             return
@@ -243,6 +484,9 @@ class ChatApp(App):
             return
 
         handler = self.protocol_handlers.get(self.current_protocol)
+        if handler and message_input.startswith("/send "):
+            self.send_file(handler, message_input[len("/send "):].strip())
+            return
         if handler:
             result = handler.send(message_input)
             if result and isinstance(result, str):  # Check for error message
@@ -259,14 +503,29 @@ class ChatApp(App):
                 "sender": "You",
                 "recipient": "Device",
                 "message": message_input,
+                "sent_ns": time.time_ns(),
             }
+            import requests
             try:
-                requests.post(self.base_url, json=data)
+                with profiler.stage("ui.send_message.post"):
+                    requests.post(self._api_url(), json=data)
                 self.add_message_bubble("You", message_input, True)
                 self.root.ids.message_input.text = ""
             except requests.exceptions.RequestException as e:
                 self.add_message_bubble("Error", str(e), False)
 
+    def send_file(self, handler, path):
+        """Handle "/send <path>", the transfer runs in the background"""
+        path = os.path.expanduser(path)
+        if not hasattr(handler, "send_file"):
+            self.add_message_bubble("System", f"{self.current_protocol} cannot send files", False)
+        elif not os.path.isfile(path):
+            self.add_message_bubble("System", f"No such file: {path}", False)
+        else:
+            self.add_message_bubble("System", handler.send_file(path), False)
+            self.root.ids.message_input.text = ""
+
+    @profiler.timed("ui.add_message_bubble")
     def add_message_bubble(self, sender, message, is_sender):
         chat_history = self.root.ids.chat_history
         wrapper = BoxLayout(
@@ -306,28 +565,58 @@ class ChatApp(App):
         chat_history.add_widget(wrapper)
         self.scroll_to_bottom()
 
+    def _drain_view(self):
+        """Show received messages for the protocol on screen and hold the
+        others until theirs is selected"""
+        for message in self.view_subscription.drain():
+            if message["protocol"] == self.current_protocol:
+                self._show_received(message)
+            else:
+                self._offscreen.setdefault(
+                    message["protocol"], deque(maxlen=CHAT_HISTORY_LIMIT)
+                ).append(message)
+
+    def _show_received(self, message):
+        self.add_message_bubble(self._sender_name(message["protocol"]), message["content"], False)
+        self._render_times.append((message["uid"], time.time_ns(), 0))
+
+    @profiler.timed("ui.load_chat_history")
     def load_chat_history(self):
+        """Show the current protocol's history, returns the uids shown"""
         if not self.current_protocol:
-            return
+            return set()
             
         chat_history = self.root.ids.chat_history
         chat_history.clear_widgets()
         
+        import requests
         try:
-            response = requests.get(f"{self.base_url}?protocol={self.current_protocol}")
-            messages = response.json()
+            # Reuse the last response while the history has not changed
+            etag, messages = self._history_responses.get(self.current_protocol, (None, None))
+            with profiler.stage("ui.load_chat_history.get"):
+                response = requests.get(
+                    self._api_url(),
+                    params={"protocol": self.current_protocol, "limit": CHAT_HISTORY_LIMIT},
+                    headers={"If-None-Match": etag} if etag else {}
+                )
+            if response.status_code != 304:
+                messages = response.json()
+                self._history_responses[self.current_protocol] = (response.headers.get("ETag"), messages)
 
             for msg in messages:
                 is_sender = msg['sender'] == 'You'
                 self.add_message_bubble(msg['sender'], msg['message'], is_sender)
             
             self.scroll_to_bottom()
+            return {msg.get('uid') for msg in messages}
                 
         except requests.exceptions.RequestException as e:
             self.add_message_bubble("Error", str(e), False)
+            return set()
 
     def on_stop(self):
         Clock.unschedule(self._check_messages)  # Stop message checking
+        self.message_bus.stop()
         # Cleanup all handlers when app closes
         for handler in self.protocol_handlers.values():
             if hasattr(handler, 'cleanup'):
@@ -335,6 +624,9 @@ class ChatApp(App):
         # Shutdown Flask server
         if hasattr(self, 'flask_thread'):
             self.flask_thread.shutdown()
+        if self.message_store:
+            self.message_store.close()
+        profiler.finish()
 
 if __name__ == "__main__":
     ChatApp().run()
@@ -0,0 +1,100 @@
+# database/history_cache.py
+import bisect
+import threading
+from collections import OrderedDict
+from database.messages import history_key
+
+class RecentHistory:
+    """The most recent messages of one protocol, in history order"""
+    def __init__(self, rows, size):
+        self.size = size
+        self.rows = sorted(rows, key=history_key)
+        self.keys = [history_key(row) for row in self.rows]
+        self.ids = {row["id"] for row in self.rows}
+        # Fewer rows than the cache holds means this is the whole history
+        self.complete = len(self.rows) < size
+
+    def add(self, row):
+        if row["id"] in self.ids:
+            return
+        key = history_key(row)
+        if not self.complete and self.keys and key < self.keys[0]:
+            return  # Older than everything cached, e.g. a late synced message
+        index = bisect.bisect(self.keys, key)
+        self.keys.insert(index, key)
+        self.rows.insert(index, row)
+        self.ids.add(row["id"])
+        if len(self.rows) > self.size:
+            self.ids.discard(self.rows.pop(0)["id"])
+            self.keys.pop(0)
+            self.complete = False
+
+class HistoryCache:
+    """Recent message history per protocol, kept in memory.
+
+    Each cached protocol holds its last `size` messages; the least recently
+    requested protocol is evicted beyond `max_protocols`. New messages are
+    picked up with one fetch_after from the highest id seen, so writes that
+    bypass the cache (e.g. history sync) show up too.
+    """
+    CATCH_UP_LIMIT = 5000  # Beyond this many new messages, reload instead
+
+    def __init__(self, store, size=200, max_protocols=16):
+        self.store = store
+        self.size = size
+        self.max_protocols = max_protocols
+        self.hits = 0
+        self.misses = 0
+        self._histories = OrderedDict()  # Protocol (None for all) -> RecentHistory
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def version(self):
+        """Changes whenever GET /messages could return something different,
+        used as its ETag"""
+        return self.store.version()
+
+    def list(self, protocol=None, limit=None):
+        if not limit or limit > self.size:
+            return self.store.list(protocol, limit)
+        with self._lock:
+            self._catch_up()
+            history = self._histories.get(protocol)
+            if history is None:
+                self.misses += 1
+                history = RecentHistory(self.store.list(protocol, self.size), self.size)
+                self._histories[protocol] = history
+                if len(self._histories) > self.max_protocols:
+                    self._histories.popitem(last=False)
+            else:
+                self.hits += 1
+                self._histories.move_to_end(protocol)
+            return history.rows[-limit:]
+
+    def _catch_up(self):
+        max_id = self.store.max_id()
+        if not self._histories or max_id - self._last_id > self.CATCH_UP_LIMIT:
+            self._histories.clear()
+            self._last_id = max_id
+            return
+        while self._last_id < max_id:
+            rows = self.store.fetch_after(self._last_id)
+            if not rows:
+                break
+            for row in rows:
+                for protocol in (None, row["protocol"]):
+                    history = self._histories.get(protocol)
+                    if history is not None:
+                        history.add(row)
+            self._last_id = rows[-1]["id"]
+
+    def record_render_times(self, stamps):
+        """Store render times and update the cached copies of the messages"""
+        missing = self.store.record_render_times(stamps)
+        with self._lock:
+            render_times = {stamp["uid"]: stamp["render_ns"] for stamp in stamps}
+            for history in self._histories.values():
+                for row in history.rows:
+                    if row["uid"] in render_times:
+                        row["render_ns"] = render_times[row["uid"]]
+        return missing
@@ -0,0 +1,63 @@
+# database/latency_report.py
+import argparse
+import sqlite3
+
+# (stage, start column, end column), see TRACE_FIELDS in database/messages.py
+STAGES = [
+    ("network", "sent_ns", "recv_ns"),        # Peer's clock to ours, needs synced clocks (NTP)
+    ("decode", "recv_ns", "enqueue_ns"),
+    ("queue", "enqueue_ns", "dequeue_ns"),
+    ("persist", "dequeue_ns", "persist_ns"),
+    ("render", "dequeue_ns", "render_ns"),
+    ("sent -> stored", "sent_ns", "persist_ns"),
+    ("sent -> shown", "sent_ns", "render_ns"),
+]
+
+def stage_latencies(connection, protocol=None):
+    """Latency in milliseconds of every traced message, per stage"""
+    query = f"SELECT {', '.join(sorted({c for _, a, b in STAGES for c in (a, b)}))} FROM messages WHERE recv_ns IS NOT NULL"
+    params = []
+    if protocol:
+        query += " AND protocol = ?"
+        params.append(protocol)
+    # A cursor of our own, the caller's connection keeps its row factory
+    cursor = connection.cursor()
+    cursor.row_factory = sqlite3.Row
+    latencies = {stage: [] for stage, _, _ in STAGES}
+    for row in cursor.execute(query, params):
+        for stage, start, end in STAGES:
+            if row[start] is not None and row[end] is not None:
+                latencies[stage].append((row[end] - row[start]) / 1e6)
+    return latencies
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def format_report(latencies):
+    lines = [f"{'stage':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+    for stage, values in latencies.items():
+        if not values:
+            lines.append(f"{stage:<16}{0:>8}{'-':>10}{'-':>10}{'-':>10}{'-':>10}")
+            continue
+        values = sorted(values)
+        lines.append(
+            f"{stage:<16}{len(values):>8}"
+            f"{percentile(values, 0.50):>10.3f}{percentile(values, 0.95):>10.3f}"
+            f"{percentile(values, 0.99):>10.3f}{values[-1]:>10.3f}"
+        )
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Break received message latency down by stage")
+    parser.add_argument("database", nargs="?", default="database/chat_history.db")
+    parser.add_argument("--protocol", help="Only messages of this protocol")
+    args = parser.parse_args()
+    connection = sqlite3.connect(args.database)
+    try:
+        print(format_report(stage_latencies(connection, args.protocol)))
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+# database/message_log.py
+#
+# Append-only message store for high message rates. Messages are appended to
+# segment files of at most segment_bytes; every segment has an index file of
+# 8-byte record offsets, memory-mapped so looking up an id is a single array
+# read. Ids are consecutive, so message id N is entry N - base_id of the
+# segment starting at base_id.
+#
+#   00000000000000000001.log  [length, crc32, payload] [length, crc32, payload] ...
+#   00000000000000000001.idx  [offset + 1] [offset + 1] ... [0] [0] (preallocated)
+#   render_times.txt          "uid render_ns" lines, records are never rewritten
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from database.messages import TRACE_FIELDS, history_key
+from database.storage import MessageStore
+from profiling import profiler
+
+RECORD_HEADER = struct.Struct("<II")  # Payload length, crc32 of the payload
+INDEX_ENTRY = struct.Struct("<Q")     # Record offset + 1, 0 marks an unused entry
+READ_SIZE = 1024 * 1024               # Bytes per read when scanning a segment
+
+class Segment:
+    """One log file and its memory-mapped offset index"""
+    def __init__(self, directory, base_id, capacity):
+        self.base_id = base_id
+        self.capacity = capacity
+        name = os.path.join(directory, f"{base_id:020d}")
+        self.log_path = name + ".log"
+        self.index_path = name + ".idx"
+        self.fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        with open(self.index_path, "a+b") as f:
+            if os.fstat(f.fileno()).st_size < capacity * INDEX_ENTRY.size:
+                f.truncate(capacity * INDEX_ENTRY.size)  # Sparse until written
+            self.index = mmap.mmap(f.fileno(), capacity * INDEX_ENTRY.size)
+        self.count = self._count_entries()
+
+    def _entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)[0]
+
+    def _count_entries(self):
+        # Entries are filled in order, binary search for the first unused one
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def offset(self, position):
+        return self._entry(position) - 1
+
+    def _read_record(self, offset):
+        """Payload of the record at offset, or None if it is torn or corrupt"""
+        header = os.pread(self.fd, RECORD_HEADER.size, offset)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, crc = RECORD_HEADER.unpack(header)
+        payload = os.pread(self.fd, length, offset + RECORD_HEADER.size)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return None
+        return payload
+
+    def recover(self):
+        """Make the index and log agree after a crash, returns records lost.
+
+        Records are written before their index entry, so the log can be
+        ahead of the index (records are indexed again) or end in a torn
+        record (it is cut off, along with an index entry pointing at it).
+        """
+        lost = 0
+        while self.count and self._read_record(self.offset(self.count - 1)) is None:
+            self.count -= 1
+            lost += 1
+        end = 0
+        if self.count:
+            offset = self.offset(self.count - 1)
+            end = offset + RECORD_HEADER.size + RECORD_HEADER.unpack(
+                os.pread(self.fd, RECORD_HEADER.size, offset))[0]
+        while self.count < self.capacity:
+            payload = self._read_record(end)
+            if payload is None:
+                break
+            INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, end + 1)
+            self.count += 1
+            end += RECORD_HEADER.size + len(payload)
+        self.index[self.count * INDEX_ENTRY.size:] = bytes((self.capacity - self.count) * INDEX_ENTRY.size)
+        if self.size > end:
+            os.ftruncate(self.fd, end)
+            self.size = end
+        return lost
+
+    def append(self, payloads):
+        """Write records in one system call and index them"""
+        data = bytearray()
+        offsets = []
+        for payload in payloads:
+            offsets.append(self.size + len(data))
+            data += RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+            data += payload
+        os.write(self.fd, data)
+        for offset in offsets:
+            INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, offset + 1)
+            self.count += 1
+        self.size += len(data)
+
+    def records(self, start, stop):
+        """Yield the payloads of entries start..stop-1, reading in large blocks"""
+        if start >= stop:
+            return
+        offset = self.offset(start)
+        end = self.offset(stop) if stop < self.count else self.size
+        buffer = b""
+        while offset < end:
+            block = os.pread(self.fd, min(READ_SIZE, end - offset), offset)
+            if not block:
+                break
+            offset += len(block)
+            buffer += block
+            pos = 0
+            while pos + RECORD_HEADER.size <= len(buffer):
+                length, _ = RECORD_HEADER.unpack_from(buffer, pos)
+                if pos + RECORD_HEADER.size + length > len(buffer):
+                    break
+                yield buffer[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + length]
+                pos += RECORD_HEADER.size + length
+            buffer = buffer[pos:]
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        self.index.flush()
+        self.index.close()
+        os.close(self.fd)
+
+class LogStore(MessageStore):
+    """Segmented append-only log of messages.
+
+    Writes are appends without transactions, and the log is only fsynced
+    with fsync=True, so a power cut can lose the last messages but never
+    corrupts older ones. Duplicate uids are recognised among the last
+    dedupe_window messages, which covers retried posts.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, segment_records=1024 * 1024,
+                 fsync=False, dedupe_window=100000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_records = segment_records
+        self.fsync = fsync
+        self.dedupe_window = dedupe_window
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        base_ids = sorted(int(name[:-4]) for name in os.listdir(directory)
+                          if name.endswith(".log") and name[:-4].isdigit())
+        self.segments = [Segment(directory, base_id, segment_records) for base_id in base_ids]
+        if not self.segments:
+            self.segments.append(Segment(directory, 1, segment_records))
+        lost = self.segments[-1].recover()
+        if lost:
+            print(f"Message log: dropped {lost} incomplete record(s) after a crash")
+        self._next_id = self.segments[-1].base_id + self.segments[-1].count
+
+        # Records are immutable, so render times live in a file of their own
+        self._render_times = {}
+        self._max_render_ns = 0
+        self._render_path = os.path.join(directory, "render_times.txt")
+        if os.path.exists(self._render_path):
+            with open(self._render_path) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self._render_times[parts[0]] = int(parts[1])
+                        self._max_render_ns = max(self._max_render_ns, int(parts[1]))
+
+        self._recent_uids = OrderedDict()
+        for row in self.read_range(max(1, self._next_id - dedupe_window), self._next_id - 1):
+            self._recent_uids[row["uid"]] = row["id"]
+
+    def _row(self, message_id, data, persist_ns):
+        row = {
+            "id": message_id,
+            "protocol": data["protocol"],
+            "sender": data["sender"],
+            "recipient": data["recipient"],
+            "message": data["message"],
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(persist_ns / 1e9)),
+            "uid": data.get("uid") or uuid.uuid4().hex,
+            "origin": data.get("origin"),
+        }
+        for field in TRACE_FIELDS:
+            row[field] = data.get(field)
+        row["persist_ns"] = persist_ns
+        row["render_ns"] = None
+        return row
+
+    def insert(self, data):
+        return self.insert_many([data])[0]
+
+    @profiler.timed("log.insert_many")
+    def insert_many(self, messages):
+        persist_ns = time.time_ns()
+        ids = []
+        with self._lock:
+            batch = []
+            for data in messages:
+                uid = data.get("uid")
+                if uid in self._recent_uids:
+                    ids.append(self._recent_uids[uid])
+                    continue
+                row = self._row(self._next_id, data, persist_ns)
+                self._next_id += 1
+                self._remember_uid(row["uid"], row["id"])
+                batch.append(json.dumps(row).encode())
+                ids.append(row["id"])
+            while batch:
+                segment = self._writable_segment()
+                room = segment.capacity - segment.count
+                segment.append(batch[:room])
+                batch = batch[room:]
+                if self.fsync:
+                    segment.sync()
+        return ids
+
+    def _remember_uid(self, uid, message_id):
+        self._recent_uids[uid] = message_id
+        if len(self._recent_uids) > self.dedupe_window:
+            self._recent_uids.popitem(last=False)
+
+    def _writable_segment(self):
+        segment = self.segments[-1]
+        if segment.count >= segment.capacity or segment.size >= self.segment_bytes:
+            segment.index.flush()
+            segment = Segment(self.directory, segment.base_id + segment.count, self.segment_records)
+            self.segments.append(segment)
+        return segment
+
+    def _scan(self, first_id, last_id=None):
+        """Yield rows from first_id on, in id order"""
+        with self._lock:
+            segments = [(segment, segment.count) for segment in self.segments]
+        for segment, count in segments:
+            start = max(first_id - segment.base_id, 0)
+            stop = count if last_id is None else min(count, last_id - segment.base_id + 1)
+            for payload in segment.records(start, stop):
+                row = json.loads(payload)
+                render_ns = self._render_times.get(row["uid"])
+                if render_ns is not None:
+                    row["render_ns"] = render_ns
+                yield row
+
+    @profiler.timed("log.list")
+    def list(self, protocol=None, limit=None):
+        rows = [row for row in self._scan(1) if not protocol or row["protocol"] == protocol]
+        rows.sort(key=history_key)
+        return rows[-limit:] if limit else rows
+
+    def fetch_after(self, last_id, protocol=None, limit=500):
+        rows = []
+        for row in self._scan(last_id + 1):
+            if not protocol or row["protocol"] == protocol:
+                rows.append(row)
+                if len(rows) >= limit:
+                    break
+        return rows
+
+    def read_range(self, first_id, last_id):
+        if first_id > last_id:
+            return []
+        return list(self._scan(max(first_id, 1), last_id))
+
+    def max_id(self):
+        with self._lock:
+            return self._next_id - 1
+
+    def max_render_ns(self):
+        with self._lock:
+            return self._max_render_ns
+
+    def record_render_times(self, stamps):
+        # Messages are shown right after they are stored, so only messages in
+        # the dedupe window are looked up
+        missing = []
+        lines = []
+        with self._lock:
+            for stamp in stamps:
+                uid, render_ns = stamp["uid"], int(stamp["render_ns"])
+                if uid not in self._recent_uids:
+                    missing.append(uid)
+                    continue
+                self._render_times[uid] = render_ns
+                self._max_render_ns = max(self._max_render_ns, render_ns)
+                lines.append(f"{uid} {render_ns}\n")
+            if lines:
+                with open(self._render_path, "a") as f:
+                    f.writelines(lines)
+        return missing
+
+    def close(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
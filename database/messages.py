@@ -0,0 +1,102 @@
+# database/messages.py
+import time
+
+REQUIRED_FIELDS = ['protocol', 'sender', 'recipient', 'message']
+# Nanosecond wall-clock times (time.time_ns) along a message's path:
+# sent by the peer, read from the socket, queued by the handler, taken off
+# the queue by the message bus, stored, and shown in the UI
+TRACE_FIELDS = ['sent_ns', 'recv_ns', 'enqueue_ns', 'dequeue_ns', 'persist_ns', 'render_ns']
+# Oldest rows have no times, they keep their insertion order
+# History follows this device's clock, when each message was stored.
+# sent_ns comes from the sender's clock and is only for latency stats.
+HISTORY_ORDER = 'ORDER BY persist_ns, id'
+HISTORY_ORDER_NEWEST_FIRST = 'ORDER BY persist_ns DESC, id DESC'
+
+def history_key(row):
+    """Sort key matching HISTORY_ORDER, SQLite sorts NULL first"""
+    return (row['persist_ns'] if row['persist_ns'] is not None else -1, row['id'])
+
+def missing_fields(data):
+    return [field for field in REQUIRED_FIELDS if field not in data]
+
+def insert_message(connection, data):
+    """Store a message, returns its id.
+
+    Posting the same uid twice stores it once and returns the existing id.
+    """
+    fields = REQUIRED_FIELDS + [field for field in ('uid', 'sent_ns', 'recv_ns', 'enqueue_ns', 'dequeue_ns')
+                                if data.get(field) is not None]
+    values = [data[field] for field in fields]
+    fields.append('persist_ns')
+    values.append(time.time_ns())
+    cursor = connection.execute(
+        f"INSERT INTO messages ({', '.join(fields)}) VALUES ({', '.join('?' for _ in fields)}) "
+        "ON CONFLICT(uid) DO NOTHING",
+        values
+    )
+    if cursor.rowcount == 0:
+        return connection.execute('SELECT id FROM messages WHERE uid = ?', [data['uid']]).fetchone()[0]
+    return cursor.lastrowid
+
+def list_messages(connection, protocol=None, limit=None):
+    """Message history, with limit only the most recent messages"""
+    where = 'WHERE protocol = ?' if protocol else ''
+    params = [protocol] if protocol else []
+    if limit:
+        rows = connection.execute(
+            f'SELECT * FROM (SELECT * FROM messages {where} {HISTORY_ORDER_NEWEST_FIRST} LIMIT ?) {HISTORY_ORDER}',
+            params + [limit]
+        ).fetchall()
+    else:
+        rows = connection.execute(f'SELECT * FROM messages {where} {HISTORY_ORDER}', params).fetchall()
+    return [dict(row) for row in rows]
+
+def record_render_times(connection, stamps):
+    """Store when messages were shown, stamps are {"uid", "render_ns"} dicts.
+
+    Returns the uids that are not stored yet, so the caller can retry them.
+    """
+    missing = []
+    for stamp in stamps:
+        cursor = connection.execute(
+            'UPDATE messages SET render_ns = ? WHERE uid = ?',
+            [stamp['render_ns'], stamp['uid']]
+        )
+        if cursor.rowcount == 0:
+            missing.append(stamp['uid'])
+    return missing
+
+def messages_after(connection, last_id, protocol=None, limit=500):
+    """Messages with an id above last_id in id order"""
+    if protocol:
+        rows = connection.execute(
+            'SELECT * FROM messages WHERE id > ? AND protocol = ? ORDER BY id LIMIT ?',
+            [last_id, protocol, limit]
+        ).fetchall()
+    else:
+        rows = connection.execute(
+            'SELECT * FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+            [last_id, limit]
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def messages_between(connection, first_id, last_id):
+    """Messages with first_id <= id <= last_id in id order"""
+    rows = connection.execute(
+        'SELECT * FROM messages WHERE id BETWEEN ? AND ? ORDER BY id',
+        [first_id, last_id]
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def max_message_id(connection):
+    return connection.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+def max_render_ns(connection):
+    return connection.execute('SELECT COALESCE(MAX(render_ns), 0) FROM messages').fetchone()[0]
+
+def history_version(connection):
+    """Highest id and render time stored, both answered from an index"""
+    return connection.execute(
+        'SELECT (SELECT COALESCE(MAX(id), 0) FROM messages), '
+        '(SELECT COALESCE(MAX(render_ns), 0) FROM messages)'
+    ).fetchone()
@@ -1,8 +1,52 @@
 # database/setup_db.py
 import sqlite3
 
-def setup_database():
-    connection = sqlite3.connect("database/chat_history.db")
+DEFAULT_DATABASE = "database/chat_history.db"
+
+def migrate_database(connection):
+    """Bring an existing messages table up to date, safe to run repeatedly"""
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(messages)")}
+    # Globally unique id and originating node, used by database/sync.py
+    if "uid" not in columns:
+        connection.execute("ALTER TABLE messages ADD COLUMN uid TEXT")
+    if "origin" not in columns:
+        connection.execute("ALTER TABLE messages ADD COLUMN origin TEXT")
+    # Per-stage latency trace, see database/messages.py
+    for column in ("sent_ns", "recv_ns", "enqueue_ns", "dequeue_ns", "persist_ns", "render_ns"):
+        if column not in columns:
+            connection.execute(f"ALTER TABLE messages ADD COLUMN {column} INTEGER")
+    connection.execute("UPDATE messages SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_uid ON messages(uid)")
+    # Latest render time, part of the history ETag
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_messages_render_ns ON messages(render_ns)")
+    # History of a protocol in HISTORY_ORDER, see database/messages.py
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_messages_history ON messages(protocol, persist_ns, id)")
+    # Writers that do not set a uid get a random one
+    connection.execute("""
+    CREATE TRIGGER IF NOT EXISTS messages_default_uid AFTER INSERT ON messages
+    WHEN NEW.uid IS NULL
+    BEGIN
+        UPDATE messages SET uid = lower(hex(randomblob(16))) WHERE id = NEW.id;
+    END
+    """)
+
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS sync_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """)
+    # Last row id pulled from each peer node
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS sync_state (
+        peer TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+def setup_database(database=DEFAULT_DATABASE):
+    connection = sqlite3.connect(database)
     cursor = connection.cursor()
 
     cursor.execute("""
@@ -12,9 +56,18 @@ def setup_database():
         sender TEXT NOT NULL,
         recipient TEXT NOT NULL,
         message TEXT NOT NULL,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        uid TEXT,
+        origin TEXT,
+        sent_ns INTEGER,
+        recv_ns INTEGER,
+        enqueue_ns INTEGER,
+        dequeue_ns INTEGER,
+        persist_ns INTEGER,
+        render_ns INTEGER
     )
     """)
+    migrate_database(connection)
     connection.commit()
     connection.close()
 
@@ -0,0 +1,142 @@
+# database/storage.py
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from database.setup_db import DEFAULT_DATABASE, setup_database
+from profiling import profiler
+from database.messages import (
+    history_version, insert_message, list_messages, max_message_id, max_render_ns, messages_after,
+    messages_between, record_render_times
+)
+
+DEFAULT_LOG_DIRECTORY = "database/message_log"
+
+class MessageStore(ABC):
+    """Where the API keeps messages.
+
+    Messages are dicts with the columns of the messages table (see
+    database/setup_db.py). Ids are assigned by the store and increase with
+    every insert.
+    """
+    @abstractmethod
+    def insert(self, data) -> int:
+        """Store a message, returns its id.
+
+        Posting the same uid twice stores it once and returns the existing id.
+        """
+        pass
+
+    def insert_many(self, messages):
+        """Store several messages at once, returns their ids"""
+        return [self.insert(data) for data in messages]
+
+    @abstractmethod
+    def list(self, protocol=None, limit=None):
+        """Message history in display order, optionally for one protocol.
+
+        With limit, only the most recent messages are returned.
+        """
+        pass
+
+    @abstractmethod
+    def fetch_after(self, last_id, protocol=None, limit=500):
+        """Messages with an id above last_id in id order"""
+        pass
+
+    @abstractmethod
+    def read_range(self, first_id, last_id):
+        """Messages with first_id <= id <= last_id in id order"""
+        pass
+
+    @abstractmethod
+    def max_id(self) -> int:
+        pass
+
+    @abstractmethod
+    def max_render_ns(self) -> int:
+        """Latest render time stored, 0 if there is none"""
+        pass
+
+    def version(self):
+        """Changes whenever list() could return something different. Built
+        from stored data only, so it stays valid across restarts."""
+        return f"{self.max_id()}.{self.max_render_ns()}"
+
+    @abstractmethod
+    def record_render_times(self, stamps):
+        """Store when messages were shown, returns the uids not stored yet"""
+        pass
+
+    def close(self):
+        """Optional cleanup method"""
+        pass
+
+class SQLiteStore(MessageStore):
+    """Messages table in SQLite, see database/messages.py"""
+    def __init__(self, database=DEFAULT_DATABASE):
+        self.database = database
+        setup_database(database)
+
+    def connect(self):
+        connection = sqlite3.connect(self.database)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _write(self, write):
+        connection = self.connect()
+        try:
+            result = write(connection)
+            connection.commit()
+            return result
+        finally:
+            connection.close()
+
+    def _read(self, read):
+        connection = self.connect()
+        try:
+            return read(connection)
+        finally:
+            connection.close()
+
+    @profiler.timed("sqlite.insert")
+    def insert(self, data):
+        return self._write(lambda connection: insert_message(connection, data))
+
+    @profiler.timed("sqlite.insert_many")
+    def insert_many(self, messages):
+        # One transaction instead of a commit per message
+        return self._write(lambda connection: [insert_message(connection, data) for data in messages])
+
+    @profiler.timed("sqlite.list")
+    def list(self, protocol=None, limit=None):
+        return self._read(lambda connection: list_messages(connection, protocol, limit))
+
+    @profiler.timed("sqlite.fetch_after")
+    def fetch_after(self, last_id, protocol=None, limit=500):
+        return self._read(lambda connection: messages_after(connection, last_id, protocol, limit))
+
+    def read_range(self, first_id, last_id):
+        return self._read(lambda connection: messages_between(connection, first_id, last_id))
+
+    def max_id(self):
+        return self._read(max_message_id)
+
+    def max_render_ns(self):
+        return self._read(max_render_ns)
+
+    def version(self):
+        return "{}.{}".format(*self._read(history_version))
+
+    def record_render_times(self, stamps):
+        return self._write(lambda connection: record_render_times(connection, stamps))
+
+def open_store(backend=None, path=None):
+    """Open the store named by backend or $CHATAPP_STORAGE: "sqlite" (the
+    default) or "log", the append-only log in database/message_log.py"""
+    backend = backend or os.environ.get("CHATAPP_STORAGE", "sqlite")
+    if backend == "sqlite":
+        return SQLiteStore(path or DEFAULT_DATABASE)
+    if backend == "log":
+        from database.message_log import LogStore
+        return LogStore(path or DEFAULT_LOG_DIRECTORY)
+    raise ValueError(f"Unknown storage backend: {backend}")
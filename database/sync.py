@@ -0,0 +1,155 @@
+# database/sync.py
+#
+# Incremental replication of message history between devices. Every message
+# has a globally unique uid and the origin node that first stored it. A
+# device pulls rows from a peer in batches through GET /sync/changes,
+# starting after the peer row id it saw last (the high-water mark kept in
+# sync_state). Rows are upserted on uid, so replaying a batch is harmless,
+# and each batch is committed together with its high-water mark, so an
+# interrupted sync resumes where it stopped.
+import json
+import sqlite3
+import uuid
+import zlib
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+SYNC_FIELDS = ('uid', 'origin', 'protocol', 'sender', 'recipient', 'message', 'timestamp',
+               'sent_ns', 'recv_ns', 'enqueue_ns', 'dequeue_ns', 'persist_ns', 'render_ns')
+
+def new_uid():
+    return uuid.uuid4().hex
+
+def get_node_id(connection):
+    """Identity of this database, created on first use"""
+    row = connection.execute("SELECT value FROM sync_meta WHERE key = 'node_id'").fetchone()
+    if row:
+        return row[0]
+    node_id = new_uid()
+    connection.execute("INSERT OR IGNORE INTO sync_meta (key, value) VALUES ('node_id', ?)", [node_id])
+    connection.commit()
+    return connection.execute("SELECT value FROM sync_meta WHERE key = 'node_id'").fetchone()[0]
+
+def get_high_water_mark(connection, peer):
+    row = connection.execute('SELECT last_id FROM sync_state WHERE peer = ?', [peer]).fetchone()
+    return row[0] if row else 0
+
+def export_changes(connection, since, limit=DEFAULT_BATCH_SIZE, exclude_origin=None):
+    """Rows after `since`, skipping those that originally came from exclude_origin"""
+    limit = max(1, min(limit, MAX_BATCH_SIZE))
+    rows = connection.execute(
+        f"SELECT id, {', '.join(SYNC_FIELDS)} FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+        [since, limit]
+    ).fetchall()
+    node_id = get_node_id(connection)
+    # Rows written here before origins existed belong to this node
+    changes = [
+        [row[field] if field != 'origin' else (row['origin'] or node_id) for field in SYNC_FIELDS]
+        for row in rows
+        if (row['origin'] or node_id) != exclude_origin
+    ]
+    return {
+        'node_id': node_id,
+        'fields': list(SYNC_FIELDS),
+        'changes': changes,
+        # Advance past skipped rows too, they never need to be sent
+        'last_id': rows[-1]['id'] if rows else since,
+        'has_more': len(rows) == limit,
+    }
+
+def check_batch(batch):
+    """Raise ValueError unless a peer's batch can be applied as is.
+
+    The field names end up in the INSERT, and without a uid on every row
+    the insert trigger would give replayed rows new uids and store them
+    again.
+    """
+    fields = batch.get('fields')
+    if not isinstance(fields, list) or not set(fields) <= set(SYNC_FIELDS) or len(set(fields)) != len(fields):
+        raise ValueError(f"Batch fields must be distinct names from {SYNC_FIELDS}")
+    if 'uid' not in fields:
+        raise ValueError("Batch rows have no uid")
+    uid = fields.index('uid')
+    for row in batch.get('changes', []):
+        if not isinstance(row, list) or len(row) != len(fields):
+            raise ValueError("Batch row does not match its fields")
+        if not isinstance(row[uid], str) or not row[uid]:
+            raise ValueError("Batch row has no uid")
+
+def apply_changes(connection, batch):
+    """Upsert a batch from export_changes and record the peer's high-water mark
+    in the same transaction, returns the number of new rows"""
+    check_batch(batch)
+    fields = batch['fields']
+    placeholders = ', '.join('?' for _ in fields)
+    with connection:
+        cursor = connection.executemany(
+            f"INSERT INTO messages ({', '.join(fields)}) VALUES ({placeholders}) "
+            "ON CONFLICT(uid) DO NOTHING",
+            batch['changes']
+        )
+        inserted = cursor.rowcount
+        connection.execute(
+            "INSERT INTO sync_state (peer, last_id, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) "
+            "ON CONFLICT(peer) DO UPDATE SET last_id = excluded.last_id, updated_at = excluded.updated_at",
+            [batch['node_id'], batch['last_id']]
+        )
+    return inserted
+
+def encode_batch(batch, accept_encoding=''):
+    """Serialize a batch for HTTP, returns (body, extra headers).
+
+    Batches are deflate compressed when the client accepts it, as requests
+    does by default.
+    """
+    body = json.dumps(batch, separators=(',', ':')).encode()
+    if 'deflate' in accept_encoding:
+        return zlib.compress(body, 6), {'Content-Encoding': 'deflate'}
+    return body, {}
+
+class SyncClient:
+    """Pulls message history from a peer's REST API into a local database"""
+    def __init__(self, peer_url, database, batch_size=DEFAULT_BATCH_SIZE, session=None, timeout=30):
+        import requests
+        self.peer_url = peer_url.rstrip('/')
+        self.database = database
+        self.batch_size = batch_size
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.peer_node_id = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _fetch(self, **params):
+        response = self.session.get(f"{self.peer_url}/sync/changes", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def pull(self):
+        """Fetch everything the peer stored since the last pull, returns the
+        number of new rows"""
+        connection = self._connect()
+        try:
+            local_node = get_node_id(connection)
+            total = 0
+            if self.peer_node_id is None:
+                # Learn who the peer is; the high-water mark is kept per node
+                # because row ids only mean something in the peer's database
+                batch = self._fetch(since=0, limit=1, exclude_origin=local_node)
+                self.peer_node_id = batch['node_id']
+                if get_high_water_mark(connection, self.peer_node_id) == 0:
+                    total += apply_changes(connection, batch)
+            while True:
+                batch = self._fetch(
+                    since=get_high_water_mark(connection, self.peer_node_id),
+                    limit=self.batch_size,
+                    exclude_origin=local_node
+                )
+                total += apply_changes(connection, batch)
+                if not batch['has_more']:
+                    return total
+        finally:
+            connection.close()
@@ -0,0 +1,149 @@
+import json
+import threading
+from protocols.message_bus import MessageBus
+
+def parse_last_event_id(value):
+    """Parse a Last-Event-ID header, returns None when absent"""
+    if value is None or value == "":
+        return None
+    last_id = int(value)
+    if last_id < 0:
+        raise ValueError("Last-Event-ID must not be negative")
+    return last_id
+
+def format_event(message):
+    return f"id: {message['id']}\nevent: message\ndata: {json.dumps(message)}\n\n"
+
+class MessageFeed:
+    """Watches the message store and pushes new rows to stream subscribers.
+
+    A single producer thread queries the store, however many clients are
+    streaming, and fans each new row out through a MessageBus. The insert
+    route calls notify() so new messages go out without waiting for the next
+    poll; polling still picks up rows written by other processes.
+    """
+    def __init__(self, store, poll_interval=0.5, subscriber_queue_size=1000, batch_size=500):
+        self.store = store  # Returns the MessageStore to read, see database/storage.py
+        self.poll_interval = poll_interval
+        self.subscriber_queue_size = subscriber_queue_size
+        self.batch_size = batch_size
+        self.heartbeat = 15.0  # Seconds between keep-alive comments
+        self.last_id = 0
+        self.subscriber_count = 0
+        self._bus = MessageBus()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def notify(self):
+        """Tell the producer that a message was just inserted"""
+        self._wakeup.set()
+
+    def fetch_after(self, last_id, protocol=None, limit=None):
+        return self.store().fetch_after(last_id, protocol, limit or self.batch_size)
+
+    def subscribe(self, protocol=None, max_subscribers=None):
+        """Subscription for stream(), or None when max_subscribers are
+        already streaming; checked and counted under one lock so concurrent
+        requests cannot all get past the limit"""
+        with self._lock:
+            if max_subscribers and self.subscriber_count >= max_subscribers:
+                return None
+            if self.subscriber_count == 0:
+                # Nothing was polled while nobody listened, start from now
+                self.last_id = self.store().max_id()
+            self.subscriber_count += 1
+            subscription = self._bus.subscribe(
+                "stream",
+                maxsize=self.subscriber_queue_size,
+                protocols=[protocol] if protocol else None
+            )
+            # Rows after this id reach the subscription through the bus
+            subscription.start_id = self.last_id
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Safe to call more than once for the same subscription"""
+        with self._lock:
+            if getattr(subscription, "unsubscribed", False):
+                return
+            subscription.unsubscribed = True
+            self._bus.unsubscribe(subscription)
+            self.subscriber_count -= 1
+
+    def poll_once(self):
+        """Publish rows inserted since the last poll, returns the count"""
+        with self._lock:
+            if not self.subscriber_count:
+                return 0
+            rows = self.fetch_after(self.last_id)
+            for row in rows:
+                self._bus.publish(row["protocol"], row)
+            if rows:
+                self.last_id = rows[-1]["id"]
+        if len(rows) == self.batch_size:
+            self._wakeup.set()  # More rows are waiting
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"Message feed error: {str(e)}")
+            with self._lock:
+                if not self.subscriber_count:
+                    self._thread = None
+                    return
+
+    def _replay(self, last_id, protocol):
+        while True:
+            rows = self.fetch_after(last_id, protocol)
+            for row in rows:
+                yield row
+                last_id = row["id"]
+            if len(rows) < self.batch_size:
+                return
+
+    def stream(self, protocol=None, last_event_id=None, subscription=None):
+        """Generate Server-Sent Events for new messages.
+
+        With last_event_id, messages after that id are replayed from the
+        database first. A subscriber that falls so far behind that its queue
+        overflows is caught up from the database as well. Pass a
+        subscription from subscribe() to reserve the stream up front.
+        """
+        subscription = subscription or self.subscribe(protocol)
+        try:
+            yield "retry: 3000\n\n"
+            if last_event_id is None:
+                last_sent = subscription.start_id
+            else:
+                last_sent = last_event_id
+                for row in self._replay(last_event_id, protocol):
+                    yield format_event(row)
+                    last_sent = row["id"]
+            dropped = 0
+            while True:
+                message = subscription.get(timeout=self.heartbeat)
+                if subscription.dropped != dropped:
+                    dropped = subscription.dropped
+                    subscription.drain()
+                    for row in self._replay(last_sent, protocol):
+                        yield format_event(row)
+                        last_sent = row["id"]
+                    continue
+                if message is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                if message["id"] <= last_sent:
+                    continue  # Already sent during replay
+                yield format_event(message)
+                last_sent = message["id"]
+        finally:
+            self.unsubscribe(subscription)
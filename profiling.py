@@ -0,0 +1,255 @@
+"""Opt-in profiling: per-stage timers, plus cProfile or stack-sample captures.
+
+Enable with CHATAPP_PROFILE or the --profile flag:
+    timers    time the hot paths (UI callbacks, API routes, storage, handler
+              receive loops) and write the slowest stages on exit
+    cprofile  timers, plus cProfile of the UI thread for a time window
+    sample    timers, plus stack samples of all threads for a time window,
+              written in the folded format flamegraph.pl reads
+"""
+import atexit
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+MODES = ("timers", "cprofile", "sample")
+DEFAULT_DIRECTORY = "profiles"
+DEFAULT_SECONDS = 30.0  # Length of a cProfile or sampling capture
+SAMPLE_INTERVAL = 0.01
+RECENT_SAMPLES = 2048  # Per stage, for percentiles
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def add(self, elapsed_ns):
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+        self.recent.append(elapsed_ns)
+
+    def percentile(self, fraction):
+        recent = sorted(self.recent)
+        return recent[min(len(recent) - 1, int(len(recent) * fraction))] if recent else 0
+
+class _Stage:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter_ns() - self.start)
+        return False
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of all threads every interval seconds"""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self._done = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._done.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                stack = ";".join(reversed(calls))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+
+class Profiler:
+    """Collects stage timings; does nothing unless enabled.
+
+    Wrap code in `with profiler.stage(name):` or decorate a function with
+    `@profiler.timed(name)`. Decorating while disabled returns the function
+    unchanged, so it costs nothing.
+    """
+    def __init__(self, mode=None, directory=DEFAULT_DIRECTORY, seconds=DEFAULT_SECONDS):
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._cprofile = None
+        self._sampler = None
+        self._finished = False
+        self.configure(mode, directory, seconds)
+
+    def configure(self, mode=None, directory=DEFAULT_DIRECTORY, seconds=DEFAULT_SECONDS):
+        if mode is not None and mode not in MODES:
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        self.mode = mode
+        self.directory = directory
+        self.seconds = seconds
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def record(self, name, elapsed_ns):
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(elapsed_ns)
+
+    def stage(self, name):
+        return _Stage(self, name) if self.mode else _NO_STAGE
+
+    def timed(self, name=None):
+        def decorate(function):
+            if not self.mode:
+                return function
+            stage_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter_ns()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(stage_name, time.perf_counter_ns() - start)
+            return wrapper
+        return decorate
+
+    def _path(self, suffix):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"chatapp-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+
+    def start_capture(self):
+        """Start the cProfile or sampling capture, cProfile records the calling thread"""
+        if self.mode == "cprofile" and self._cprofile is None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        elif self.mode == "sample" and self._sampler is None:
+            self._sampler = StackSampler()
+            self._sampler.start()
+
+    def stop_capture(self):
+        """Stop a running capture and write it to a file, returns its path"""
+        path = None
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            path = self._path(".prof")
+            self._cprofile.dump_stats(path)
+            self._cprofile = None
+        if self._sampler is not None:
+            self._sampler.stop()
+            path = self._path(".folded")
+            self._sampler.write(path)
+            self._sampler = None
+        if path:
+            print(f"Profile written to {path}")
+        return path
+
+    def summary(self, limit=20):
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1].total_ns)[:limit]
+        lines = ["Slowest stages (ms):",
+                 f"  {'stage':<32} {'count':>8} {'total':>10} {'mean':>8} {'p99':>8} {'max':>8}"]
+        for name, stats in stages:
+            lines.append(
+                f"  {name:<32} {stats.count:>8} {stats.total_ns / 1e6:>10.1f} "
+                f"{stats.total_ns / stats.count / 1e6:>8.2f} {stats.percentile(0.99) / 1e6:>8.2f} "
+                f"{stats.max_ns / 1e6:>8.2f}"
+            )
+        return "\n".join(lines)
+
+    def finish(self):
+        """Stop any capture and write the stage summary, once"""
+        if not self.enabled or self._finished:
+            return
+        self._finished = True
+        self.stop_capture()
+        summary = self.summary()
+        print(summary)
+        with open(self._path("-summary.txt"), "w") as f:
+            f.write(summary + "\n")
+
+def parse_argv(argv):
+    """Remove --profile[=mode] and --profile-seconds=N from argv (Kivy
+    rejects options it does not know), returns (mode, seconds)"""
+    mode = seconds = None
+    for arg in list(argv[1:]):
+        if arg == "--profile" or arg.startswith("--profile="):
+            mode = arg.partition("=")[2] or "timers"
+        elif arg.startswith("--profile-seconds="):
+            seconds = _seconds(arg.partition("=")[2], None)
+        else:
+            continue
+        argv.remove(arg)
+    return mode, seconds
+
+def _seconds(value, default):
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Invalid profiling duration '{value}', using {default or DEFAULT_SECONDS} seconds")
+        return default
+
+def configure(argv=None, environ=None):
+    """Set up the shared profiler from the command line and $CHATAPP_PROFILE,
+    $CHATAPP_PROFILE_SECONDS and $CHATAPP_PROFILE_DIR.
+
+    Every module imports this, so a mistyped setting only prints a warning
+    and leaves profiling off instead of keeping the app from starting.
+    """
+    environ = os.environ if environ is None else environ
+    mode, seconds = parse_argv(argv) if argv is not None else (None, None)
+    mode = mode or environ.get("CHATAPP_PROFILE", "")
+    mode = {"": None, "0": None, "1": "timers"}.get(mode, mode)
+    if mode is not None and mode not in MODES:
+        print(f"Unknown profiling mode '{mode}', expected one of {', '.join(MODES)}; profiling is off")
+        mode = None
+    profiler.configure(
+        mode,
+        directory=environ.get("CHATAPP_PROFILE_DIR", DEFAULT_DIRECTORY),
+        seconds=seconds or _seconds(environ.get("CHATAPP_PROFILE_SECONDS", DEFAULT_SECONDS), DEFAULT_SECONDS),
+    )
+    return profiler
+
+# Shared by the app, the API and the handlers. Configured from the environment
+# on import; chatapp.py also reads the command line, before importing anything
+# that uses it, as functions decorated while disabled stay untimed
+profiler = Profiler()
+configure()
+atexit.register(profiler.finish)
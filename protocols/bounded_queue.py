@@ -0,0 +1,141 @@
+# protocols/bounded_queue.py
+import json
+import tempfile
+import threading
+from collections import deque
+from queue import Empty
+
+# Overflow policies
+BLOCK = "block"              # Wait for the consumer; socket readers stop reading,
+                             # which applies TCP backpressure to the peer
+DROP_OLDEST = "drop_oldest"  # Discard the oldest queued message
+SPILL = "spill"              # Keep overflow in a temporary file on disk
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+class BoundedMessageQueue:
+    """FIFO of received messages with a fixed in-memory capacity.
+
+    Messages must be JSON serializable when the spill policy is used.
+    """
+    def __init__(self, maxsize=1000, policy=BLOCK, spill_dir=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}', expected one of {POLICIES}")
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # Spill file, read from _spill_read_pos and appended at the end
+        self._spill_file = None
+        self._spill_read_pos = 0
+        self._spill_count = 0
+
+        # Counters
+        self.dropped = 0
+        self.spilled = 0
+        self.high_water = 0
+        self.spill_high_water = 0
+
+    def put(self, message, timeout=None):
+        """Queue a message, returns False if it was not queued because the
+        queue is closed or the block policy timed out"""
+        with self._condition:
+            if self._closed:
+                return False
+            if self.policy == SPILL and (self._spill_count or len(self._items) >= self.maxsize):
+                # Once spilling, everything goes through the file to keep order
+                self._spill(message)
+                return True
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    has_room = self._condition.wait_for(
+                        lambda: self._closed or len(self._items) < self.maxsize, timeout
+                    )
+                    if not has_room or self._closed:
+                        return False
+            self._items.append(message)
+            self.high_water = max(self.high_water, len(self._items))
+            self._condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items or self._spill_count or self._closed, timeout):
+                raise Empty
+            return self._pop()
+
+    def get_nowait(self):
+        with self._condition:
+            return self._pop()
+
+    def _pop(self):
+        if not self._items:
+            self._refill()
+        if not self._items:
+            raise Empty
+        message = self._items.popleft()
+        if self._spill_count:
+            self._refill()
+        self._condition.notify_all()
+        return message
+
+    def _spill(self, message):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        self._spill_file.seek(0, 2)
+        self._spill_file.write(json.dumps(message).encode() + b"\n")
+        self._spill_count += 1
+        self.spilled += 1
+        self.spill_high_water = max(self.spill_high_water, self._spill_count)
+        self._condition.notify_all()
+
+    def _refill(self):
+        """Move spilled messages back into memory, oldest first"""
+        if not self._spill_count:
+            return
+        self._spill_file.seek(self._spill_read_pos)
+        while self._spill_count and len(self._items) < self.maxsize:
+            self._items.append(json.loads(self._spill_file.readline()))
+            self._spill_count -= 1
+        self._spill_read_pos = self._spill_file.tell()
+        if not self._spill_count:
+            # Reuse the file from the start once it has been drained
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+            self._spill_read_pos = 0
+
+    def close(self):
+        """Wake up blocked producers and release the spill file"""
+        with self._condition:
+            self._closed = True
+            self._items.clear()
+            if self._spill_file:
+                self._spill_file.close()
+                self._spill_file = None
+            self._spill_count = 0
+            self._spill_read_pos = 0
+            self._condition.notify_all()
+
+    def qsize(self):
+        with self._condition:
+            return len(self._items) + self._spill_count
+
+    def stats(self):
+        with self._condition:
+            return {
+                "policy": self.policy,
+                "capacity": self.maxsize,
+                "queued": len(self._items),
+                "spill_queued": self._spill_count,
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+                "high_water": self.high_water,
+                "spill_high_water": self.spill_high_water,
+            }
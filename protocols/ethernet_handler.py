@@ -1,20 +1,165 @@
 # protocols/ethernet_handler.py
 from protocols.protocol_handler import ProtocolHandler
+from protocols.bounded_queue import BoundedMessageQueue, BLOCK
+from protocols.file_transfer import (FileTransferManager, FileScan, FairLock, ReplyWriter, FRAME_TYPES,
+                                     MAX_CHUNK_SIZE, abort_connection)
+from profiling import profiler
+from queue import Empty
+import re
 import socket
 import threading
-from queue import Queue
+import time
 import json
 
+RECV_SIZE = 65536
+SEND_TIMEOUT = 10.0  # Seconds a peer may stop reading before it is disconnected
+BUSY_WAIT = 0.05  # Seconds to wait for a busy client before trying the next one
+
+class JSONStreamDecoder:
+    """Splits a TCP byte stream into JSON messages.
+
+    Peers write JSON objects back to back without a delimiter, so a single
+    recv can hold several messages or only part of one. A message with a
+    "payload_length" key is followed by that many raw bytes (e.g. a file
+    chunk), which are returned in its "payload" key.
+    """
+    MAX_PENDING = 1024 * 1024  # Give up on an unfinished message beyond this
+    MAX_PAYLOAD = MAX_CHUNK_SIZE  # Frames announcing more are invalid
+    _WHITESPACE = re.compile(r"\s*")
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._decoder = json.JSONDecoder()
+        self._payload_frame = None  # Frame still waiting for payload bytes
+        self._payload = bytearray()
+
+    def feed(self, data: bytes):
+        """Add received bytes, returns (complete messages, invalid frame count)"""
+        self._buffer += data
+        messages = []
+        invalid = 0
+        pos = 0  # Byte offset into the buffer
+        while pos < len(self._buffer):
+            if self._payload_frame is not None:
+                needed = self._payload_frame["payload_length"] - len(self._payload)
+                piece = self._buffer[pos:pos + needed]
+                self._payload += piece
+                pos += len(piece)
+                if len(self._payload) < self._payload_frame["payload_length"]:
+                    break
+                self._payload_frame["payload"] = bytes(self._payload)
+                messages.append(self._payload_frame)
+                self._payload_frame = None
+                self._payload = bytearray()
+                continue
+            pos, complete, frame_invalid = self._decode_frames(pos, messages)
+            invalid += frame_invalid
+            if not complete:
+                break  # Wait for the rest of a message
+        del self._buffer[:pos]
+        return messages, invalid
+
+    def _decode_frames(self, start, messages):
+        """Decode JSON messages from byte offset start until the data runs
+        out or a payload follows, returns (new offset, complete, invalid)"""
+        # surrogateescape keeps a 1:1 mapping for bytes that are not valid
+        # UTF-8 (e.g. a multi-byte character cut in half, or payload bytes)
+        # so consumed text can be measured in bytes again
+        text = bytes(self._buffer[start:]).decode("utf-8", errors="surrogateescape")
+        invalid = 0
+        pos = 0
+        consumed = start
+
+        def advance(new_pos):
+            nonlocal pos, consumed
+            consumed += len(text[pos:new_pos].encode("utf-8", errors="surrogateescape"))
+            pos = new_pos
+
+        while True:
+            advance(self._WHITESPACE.match(text, pos).end())
+            if pos == len(text):
+                return consumed, True, invalid
+            if text[pos] != "{":
+                invalid += 1
+                advance(self._next_object(text, pos))
+                continue
+            try:
+                message, end = self._decoder.raw_decode(text, pos)
+            except json.JSONDecodeError as e:
+                if self._is_incomplete(e, text) and len(text) - pos <= self.MAX_PENDING:
+                    return consumed, False, invalid
+                invalid += 1
+                advance(self._next_object(text, pos))
+                continue
+            advance(end)
+            if not isinstance(message, dict):
+                invalid += 1
+            elif isinstance(message.get("payload_length"), int) and message["payload_length"] > self.MAX_PAYLOAD:
+                invalid += 1
+            elif isinstance(message.get("payload_length"), int) and message["payload_length"] > 0:
+                # The payload is raw bytes, continue from the byte offset
+                self._payload_frame = message
+                return consumed, True, invalid
+            else:
+                messages.append(message)
+
+    @staticmethod
+    def _next_object(text, pos):
+        next_start = text.find("{", pos + 1)
+        return next_start if next_start != -1 else len(text)
+
+    @staticmethod
+    def _is_incomplete(error, text):
+        # A message cut short fails at (or just before) the end of the data
+        return error.msg.startswith("Unterminated string") or error.pos >= len(text) - 8
+
+def _enqueue(handler, message):
+    """Queue a received message until it fits or the handler stops.
+
+    With the block policy this holds up the socket reader, so the kernel
+    buffers fill and the peer is slowed down instead of memory growing.
+    """
+    while handler.is_running:
+        if handler.message_queue.put(message, timeout=0.2):
+            return True
+    return False
+
+def _file_received(handler, incoming):
+    """Show a finished file transfer as a chat message"""
+    now = time.time_ns()
+    _enqueue(handler, {
+        "content": f"Received file {incoming.name} ({incoming.size} bytes): {incoming.path}",
+        "type": "file",
+        "path": incoming.path,
+        "recv_ns": now,
+        "enqueue_ns": now,
+    })
+
 class EthernetMasterHandler(ProtocolHandler):
-    def __init__(self, host: str, port: int):
+    decoder_class = JSONStreamDecoder
+    profile_name = "tcp_server"  # Prefix of its profiling stages
+
+    def __init__(self, host: str, port: int, queue_size: int = 1000,
+                 overflow_policy: str = BLOCK, spill_dir: str = None,
+                 download_dir: str = "downloads"):
         self.host = host
         self.port = port
         self.server_socket = None
         self.is_running = False
+        # Guards the client dicts only, never held while writing to a socket
         self._lock = threading.Lock()
         self.status_callback = None
         self.connected_clients = {}  # Store client sockets
-        self.message_queue = Queue()
+        # Client address -> lock held while writing to that client. Fair so
+        # chat messages get their turn between the chunks of a file.
+        self._send_locks = {}
+        self.send_timeout = SEND_TIMEOUT
+        # Received messages; see protocols/bounded_queue.py for the policies
+        self.message_queue = BoundedMessageQueue(queue_size, overflow_policy, spill_dir)
+        self.file_transfers = FileTransferManager(
+            download_dir, notify=self._notify_status,
+            on_file_received=lambda incoming: _file_received(self, incoming)
+        )
         self.last_message = None  # Add this for handling received messages
 
     def set_status_callback(self, callback):
@@ -24,46 +169,84 @@ class EthernetMasterHandler(ProtocolHandler):
         if self.status_callback:
             self.status_callback(message)
 
+    @property
+    def endpoint(self):
+        return f"{self.host}:{self.port}"
+
+    def _create_server_socket(self):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Add socket reuse options
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        if self.port == 0:
+            # Let the OS pick a port, e.g. for tests and benchmarks
+            self.port = server_socket.getsockname()[1]
+        return server_socket
+
+    def _accept(self):
+        """Next client as (socket, address), address keys connected_clients"""
+        return self.server_socket.accept()
+
     def initialize(self):
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # Add socket reuse options
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
+            self.server_socket = self._create_server_socket()
             self.server_socket.listen(1)
             self.is_running = True
             threading.Thread(target=self._listen_for_connections, daemon=True).start()
-            return f"Server listening on {self.host}:{self.port}"
+            return f"Server listening on {self.endpoint}"
         except Exception as e:
             return f"Failed to start server: {str(e)}"
 
+    def _send_lock(self, address):
+        """The lock of a client's connection, call with self._lock held"""
+        return self._send_locks.setdefault(address, FairLock())
+
     def _handle_client(self, client_socket, address):
+        decoder = self.decoder_class()
+        with self._lock:
+            replies = ReplyWriter(client_socket, self._send_lock(address))
         while self.is_running:
             try:
-                data = client_socket.recv(1024)
+                data = client_socket.recv(RECV_SIZE)
+                recv_ns = time.time_ns()
                 if not data:
                     break
-                message = json.loads(data.decode())
-                self.message_queue.put(message)
-                self.last_message = message['content']  # Store last message
-                self._notify_status(f"Message from {address[0]}:{address[1]}: {message['content']}")
-            except json.JSONDecodeError:
-                self._notify_status(f"Invalid message format from {address[0]}:{address[1]}")
+                with profiler.stage(f"{self.profile_name}.receive"):
+                    messages, invalid = decoder.feed(data)
+                    if invalid:
+                        self._notify_status(f"Invalid message format from {address[0]}:{address[1]}")
+                    for message in messages:
+                        if message.get('type') in FRAME_TYPES:
+                            self.file_transfers.handle_frame(message, address, replies.send)
+                            continue
+                        message['recv_ns'] = recv_ns
+                        message['enqueue_ns'] = time.time_ns()
+                        if not _enqueue(self, message):
+                            break
+                        self.last_message = message.get('content')  # Store last message
+                        self._notify_status(f"Message from {address[0]}:{address[1]}: {message.get('content')}")
+            except socket.timeout:
+                continue  # The timeout is for writes, the client is just quiet
             except Exception as e:
                 self._notify_status(f"Error handling client {address[0]}:{address[1]}: {str(e)}")
                 break
         
         # Clean up client connection
+        replies.close()
         with self._lock:
             if address in self.connected_clients:
                 del self.connected_clients[address]
+            self._send_locks.pop(address, None)
         client_socket.close()
         self._notify_status(f"Client {address[0]}:{address[1]} disconnected")
 
     def _listen_for_connections(self):
         while self.is_running:
             try:
-                client_socket, address = self.server_socket.accept()
+                client_socket, address = self._accept()
+                # Bounds every write, so a client that stops reading can't
+                # hold its send lock forever
+                client_socket.settimeout(self.send_timeout)
                 with self._lock:
                     self.connected_clients[address] = client_socket
                 self._notify_status(f"Client connected from {address[0]}:{address[1]}")
@@ -77,22 +260,64 @@ class EthernetMasterHandler(ProtocolHandler):
                 if self.is_running:
                     self._notify_status(f"Connection error: {str(e)}")
 
-    def send(self, message: str):
+    def _clients(self):
+        """(address, socket, send lock) of every connected client"""
         with self._lock:
-            if not self.connected_clients:
-                return "No clients connected"
-            
-            data = json.dumps({
-                "content": message,
-                "type": "message"
-            }).encode()
-            
-            # Send to all connected clients
-            for addr, client in self.connected_clients.items():
-                try:
-                    client.send(data)
-                except Exception as e:
-                    self._notify_status(f"Failed to send to {addr[0]}:{addr[1]}: {str(e)}")
+            return [(addr, client, self._send_lock(addr)) for addr, client in self.connected_clients.items()]
+
+    def _send_to_clients(self, write):
+        """Call write(address, socket) for each client under its send lock.
+
+        Clients whose lock is busy, e.g. with a file chunk, are retried in
+        rounds, so one that stopped reading holds up nobody else until its
+        writes time out.
+        """
+        busy = self._clients()
+        if not busy:
+            return "No clients connected"
+        deadline = time.monotonic() + self.send_timeout
+        wait = 0
+        while busy:
+            busy = [client for client in busy if not self._write_to_client(client, write, wait)]
+            wait = BUSY_WAIT
+            if busy and time.monotonic() > deadline:
+                for addr, client, _ in busy:
+                    self._notify_status(f"Failed to send to {addr[0]}:{addr[1]}: timed out")
+                    abort_connection(client)
+                break
+
+    def _write_to_client(self, client, write, timeout):
+        """Returns False if the client's send lock was not free in time"""
+        addr, sock, send_lock = client
+        if not send_lock.acquire(timeout):
+            return False
+        try:
+            write(addr, sock)
+        except Exception as e:
+            self._notify_status(f"Failed to send to {addr[0]}:{addr[1]}: {str(e)}")
+            abort_connection(sock)
+        finally:
+            send_lock.release()
+        return True
+
+    def send(self, message: str):
+        data = json.dumps({
+            "content": message,
+            "type": "message",
+            "sent_ns": time.time_ns()
+        }).encode()
+        # sendall, with the timeout set send() may write only part of it
+        return self._send_to_clients(lambda addr, client: client.sendall(data))
+
+    def send_file(self, path: str):
+        """Send a file to all connected clients in the background"""
+        clients = self._clients()
+        if not clients:
+            return "No clients connected"
+        scan = FileScan(path, self.file_transfers.chunk_size)  # Checksummed once for all clients
+        for addr, client, send_lock in clients:
+            self.file_transfers.send_file(path, addr, client, send_lock, scan)
+        return f"Sending file {path} to {len(clients)} client(s)"
 
     def receive(self) -> str:
         try:
@@ -101,6 +326,17 @@ class EthernetMasterHandler(ProtocolHandler):
         except:
             return "No messages"
 
+    def receive_message(self):
+        """Next message dict including its trace times, or None"""
+        try:
+            return self.message_queue.get_nowait()
+        except Empty:
+            return None
+
+    def queue_stats(self):
+        """Drop, spill and high-water counters of the receive queue"""
+        return self.message_queue.stats()
+
     def cleanup(self):
         with self._lock:
             self.is_running = False
@@ -114,6 +350,7 @@ class EthernetMasterHandler(ProtocolHandler):
                         except:
                             pass
                     self.connected_clients.clear()
+                    self._send_locks.clear()
                     
                     # Then close server socket
                     self.server_socket.shutdown(socket.SHUT_RDWR)
@@ -122,49 +359,86 @@ class EthernetMasterHandler(ProtocolHandler):
                     pass
                 finally:
                     self.server_socket = None
+        self.file_transfers.close()
         return "Server stopped"
 
 class EthernetClientHandler(ProtocolHandler):
-    def __init__(self, host: str, port: int):
+    decoder_class = JSONStreamDecoder
+    profile_name = "tcp_client"
+
+    def __init__(self, host: str, port: int, queue_size: int = 1000,
+                 overflow_policy: str = BLOCK, spill_dir: str = None,
+                 download_dir: str = "downloads"):
         self.host = host
         self.port = port
         self.client_socket = None
         self.is_running = False
-        self.message_queue = Queue()
-        self._lock = threading.Lock()
+        # Received messages; see protocols/bounded_queue.py for the policies
+        self.message_queue = BoundedMessageQueue(queue_size, overflow_policy, spill_dir)
+        self.file_transfers = FileTransferManager(
+            download_dir, on_file_received=lambda incoming: _file_received(self, incoming)
+        )
+        self._lock = FairLock()  # Held while writing to the socket
+        self.send_timeout = SEND_TIMEOUT
         self.connected = False  # Add connection state
         self.last_message = None  # Add this for handling received messages
 
+    @property
+    def endpoint(self):
+        return f"{self.host}:{self.port}"
+
+    def _create_socket(self):
+        """Unconnected socket and the address to connect it to"""
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM), (self.host, self.port)
+
     def initialize(self):
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client_socket, address = self._create_socket()
         try:
-            self.client_socket.connect((self.host, self.port))
+            self.client_socket.connect(address)
+            # Bounds every write, so a server that stops reading can't hold
+            # the send lock forever
+            self.client_socket.settimeout(self.send_timeout)
             self.is_running = True
             self.connected = True
             # Start receiving thread
             threading.Thread(target=self._receive_messages, daemon=True).start()
-            return f"Client connected to {self.host}:{self.port}"
-        except ConnectionRefusedError:
+            return f"Client connected to {self.endpoint}"
+        except (ConnectionRefusedError, FileNotFoundError):
             self.connected = False
             self.is_running = False
-            return f"Failed to connect to {self.host}:{self.port} - No server found"
+            return f"Failed to connect to {self.endpoint} - No server found"
         except Exception as e:
             self.connected = False
             self.is_running = False
             return f"Connection error: {str(e)}"
 
     def _receive_messages(self):
+        decoder = self.decoder_class()
+        replies = ReplyWriter(self.client_socket, self._lock)
         while self.is_running:
             try:
-                data = self.client_socket.recv(1024)
+                data = self.client_socket.recv(RECV_SIZE)
+                recv_ns = time.time_ns()
                 if not data:
                     self.connected = False
                     self.is_running = False
                     print("Server disconnected")
                     break
-                message = json.loads(data.decode())
-                self.message_queue.put(message)
-                self.last_message = message['content']  # Store last message
+                with profiler.stage(f"{self.profile_name}.receive"):
+                    messages, invalid = decoder.feed(data)
+                    if invalid:
+                        print("Invalid message format from server")
+                    for message in messages:
+                        if message.get('type') in FRAME_TYPES:
+                            self.file_transfers.handle_frame(message, None, replies.send)
+                            continue
+                        message['recv_ns'] = recv_ns
+                        message['enqueue_ns'] = time.time_ns()
+                        if not _enqueue(self, message):
+                            break
+                        self.last_message = message.get('content')  # Store last message
+            except socket.timeout:
+                continue  # The timeout is for writes, the server is just quiet
             except ConnectionResetError:
                 self.connected = False
                 self.is_running = False
@@ -175,22 +449,25 @@ class EthernetClientHandler(ProtocolHandler):
                 self.connected = False
                 self.is_running = False
                 break
+        replies.close()
 
     def send(self, message: str):
         if not self.is_running or not self.client_socket or not self.connected:
             return "Not connected to server"
         
         try:
-            # Test connection before sending
-            self.client_socket.settimeout(1.0)  # Set timeout for connection test
-            self.client_socket.send(b"")  # Test send
-            self.client_socket.settimeout(None)  # Reset timeout
-            
             data = json.dumps({
                 "content": message,
-                "type": "message"
+                "type": "message",
+                "sent_ns": time.time_ns()
             }).encode()
-            self.client_socket.send(data)
+            # Under the lock, a file sender may be in sendfile on this socket
+            with self._lock:
+                # Test connection before sending
+                self.client_socket.settimeout(1.0)  # Set timeout for connection test
+                self.client_socket.send(b"")  # Test send
+                self.client_socket.settimeout(self.send_timeout)  # Reset timeout
+                self.client_socket.sendall(data)
         except (ConnectionResetError, BrokenPipeError):
             self.connected = False
             self.is_running = False
@@ -204,6 +481,13 @@ class EthernetClientHandler(ProtocolHandler):
             self.is_running = False
             return f"Send error: {str(e)}"
 
+    def send_file(self, path: str):
+        """Send a file to the server in the background"""
+        if not self.is_running or not self.client_socket or not self.connected:
+            return "Not connected to server"
+        self.file_transfers.send_file(path, None, self.client_socket, self._lock)
+        return f"Sending file {path}"
+
     def receive(self) -> str:
         try:
             message = self.message_queue.get_nowait()
@@ -211,9 +495,21 @@ class EthernetClientHandler(ProtocolHandler):
         except:
             return "No messages"
 
+    def receive_message(self):
+        """Next message dict including its trace times, or None"""
+        try:
+            return self.message_queue.get_nowait()
+        except Empty:
+            return None
+
+    def queue_stats(self):
+        """Drop, spill and high-water counters of the receive queue"""
+        return self.message_queue.stats()
+
     def cleanup(self):
         self.is_running = False
         self.connected = False
+        self.file_transfers.close()
         if self.client_socket:
             try:
                 self.client_socket.shutdown(socket.SHUT_RDWR)
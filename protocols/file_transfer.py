@@ -0,0 +1,449 @@
+# protocols/file_transfer.py
+#
+# Chunked file transfer over a stream socket that also carries chat
+# messages. Frames are JSON objects like chat messages:
+#
+#   file_offer   sender -> receiver  name, size, sha256, chunk_size
+#   file_resume  receiver -> sender  offset to (re)start from
+#   file_chunk   sender -> receiver  offset, crc32, payload_length, followed
+#                                    by payload_length raw bytes
+#   file_done    receiver -> sender  ok, error
+#
+# The transfer id is derived from the file content, so offering the same file
+# again after an interruption resumes from the partial file on the receiver.
+import hashlib
+import json
+import os
+import queue
+import re
+import socket
+import threading
+import zlib
+
+FRAME_TYPES = ("file_offer", "file_resume", "file_chunk", "file_done")
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024  # Larger payloads are rejected by the receiver
+# 32 hex digits of the sha256 followed by the size as 16 hex digits; it names
+# the partial file on the receiver, so nothing else is accepted
+TRANSFER_ID = re.compile(r"[0-9a-f]{48}")
+
+class FairLock:
+    """Lock handed out in request order.
+
+    A file sender takes it for every chunk; with a plain Lock it could take
+    it again straight away and starve chat messages waiting to be sent.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()  # Tickets of acquire calls that timed out
+
+    def acquire(self, timeout=None):
+        """Wait for our turn, returns False if timeout expired first"""
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            if self._condition.wait_for(lambda: self._serving == ticket, timeout):
+                return True
+            self._abandoned.add(ticket)  # release() skips it
+            return False
+
+    def release(self):
+        with self._condition:
+            self._serving += 1
+            while self._serving in self._abandoned:
+                self._abandoned.discard(self._serving)
+                self._serving += 1
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def encode_frame(frame):
+    return json.dumps(frame).encode()
+
+def abort_connection(sock):
+    """Shut a connection down after a failed or timed out write, which may
+    have left half a frame on it; its reader then sees it close"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def scan_file(path, chunk_size):
+    """Read a file once for its sha256 and per-chunk crc32s"""
+    sha256 = hashlib.sha256()
+    crcs = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            crcs.append(zlib.crc32(chunk))
+    return sha256.hexdigest(), crcs
+
+class FileScan:
+    """Size, sha256 and chunk crc32s of a file, computed by the first sender
+    thread that needs them and shared with the others"""
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = None
+        self.sha256 = None
+        self.crcs = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self.sha256 is None:
+                size = os.path.getsize(self.path)
+                self.sha256, self.crcs = scan_file(self.path, self.chunk_size)
+                self.size = size
+        return self
+
+    @property
+    def transfer_id(self):
+        return f"{self.sha256[:32]}{self.size:016x}"
+
+class FileSender(threading.Thread):
+    """Streams one file to one peer with socket.sendfile.
+
+    The file is checksummed in this thread, not the caller's, and
+    register(sender) is called once its transfer_id is known. The socket's
+    timeout bounds every write; a peer that stops reading for longer gets
+    its connection shut down.
+    """
+    def __init__(self, scan, sock, send_lock, use_sendfile=True,
+                 reply_timeout=10.0, notify=print, register=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.scan = scan
+        self.path = scan.path
+        self.sock = sock
+        self.send_lock = send_lock
+        self.chunk_size = scan.chunk_size
+        self.use_sendfile = use_sendfile
+        self.reply_timeout = reply_timeout
+        self.notify = notify
+        self.register = register
+        self.size = None
+        self.sha256 = None
+        self.crcs = None
+        self.transfer_id = None
+        self.bytes_sent = 0
+        self.resumed_from = None
+        self.result = None  # Set to True/False when the receiver answers
+        self.error = None
+        self.done = threading.Event()
+        self._resume_offset = None
+        self._stopped = False
+        self._reply = threading.Condition()
+
+    def stop(self):
+        """Give up after the chunk being sent, e.g. when the handler stops"""
+        with self._reply:
+            self._stopped = True
+            self._reply.notify_all()
+
+    def _check_stopped(self):
+        if self._stopped:
+            raise IOError("Transfer stopped")
+
+    def on_frame(self, frame):
+        """Called from the socket reader with file_resume/file_done frames"""
+        with self._reply:
+            if frame["type"] == "file_resume":
+                self._resume_offset = frame["offset"]
+            elif frame["type"] == "file_done":
+                self.result = bool(frame.get("ok"))
+                self.error = frame.get("error")
+            self._reply.notify_all()
+
+    def _send(self, frame, f=None, offset=0, count=0):
+        with self.send_lock:
+            self._check_stopped()
+            try:
+                self.sock.sendall(encode_frame(frame))
+                if count:
+                    if self.use_sendfile:
+                        # Zero-copy from the page cache to the socket
+                        self.sock.sendfile(f, offset, count)
+                    else:
+                        f.seek(offset)
+                        self.sock.sendall(f.read(count))
+            except OSError:
+                abort_connection(self.sock)
+                raise
+
+    def _take_resume_offset(self, timeout=0):
+        with self._reply:
+            if self._resume_offset is None and timeout:
+                self._reply.wait_for(lambda: self._resume_offset is not None or self._stopped, timeout)
+            offset, self._resume_offset = self._resume_offset, None
+            return offset
+
+    def _send_from(self, f, offset):
+        while offset < self.size:
+            # The receiver asks to go back when a chunk failed its check
+            rewind = self._take_resume_offset()
+            if rewind is not None:
+                offset = rewind
+            count = min(self.chunk_size, self.size - offset)
+            self._send({
+                "type": "file_chunk",
+                "transfer_id": self.transfer_id,
+                "offset": offset,
+                "crc32": self.crcs[offset // self.chunk_size],
+                "payload_length": count,
+            }, f, offset, count)
+            offset += count
+            self.bytes_sent += count
+
+    def run(self):
+        name = os.path.basename(self.path)
+        try:
+            self.scan.run()
+            self.size, self.sha256, self.crcs = self.scan.size, self.scan.sha256, self.scan.crcs
+            self.transfer_id = self.scan.transfer_id
+            if self.register:
+                self.register(self)
+            self._send({
+                "type": "file_offer",
+                "transfer_id": self.transfer_id,
+                "name": name,
+                "size": self.size,
+                "sha256": self.sha256,
+                "chunk_size": self.chunk_size,
+            })
+            offset = self._take_resume_offset(self.reply_timeout)
+            self._check_stopped()
+            if offset is None:
+                raise TimeoutError("Receiver did not answer the file offer")
+            self.resumed_from = offset
+            with open(self.path, "rb") as f:
+                while offset is not None:
+                    self._send_from(f, offset)
+                    with self._reply:
+                        self._reply.wait_for(
+                            lambda: self.result is not None or self._resume_offset is not None or self._stopped,
+                            self.reply_timeout
+                        )
+                    self._check_stopped()
+                    # A failed last chunk only shows up as a rewind request here
+                    offset = None if self.result is not None else self._take_resume_offset()
+            if self.result is None:
+                raise TimeoutError("Receiver did not confirm the file")
+            if not self.result:
+                raise IOError(self.error or "Receiver rejected the file")
+            self.notify(f"Sent file {name} ({self.size} bytes)")
+        except Exception as e:
+            self.result = False
+            self.error = self.error or str(e)
+            self.notify(f"File transfer of {name} failed: {self.error}")
+        finally:
+            self.done.set()
+
+class IncomingFile:
+    """Receiving side of one transfer, written to disk chunk by chunk"""
+    def __init__(self, offer, download_dir):
+        self.transfer_id = offer["transfer_id"]
+        if not isinstance(self.transfer_id, str) or not TRANSFER_ID.fullmatch(self.transfer_id):
+            raise ValueError("Invalid transfer id")
+        self.name = os.path.basename(offer["name"]) or "file"
+        self.size = offer["size"]
+        self.sha256 = offer["sha256"]
+        self.chunk_size = offer["chunk_size"]
+        if not isinstance(self.size, int) or self.size < 0:
+            raise ValueError("Invalid file size")
+        if not isinstance(self.chunk_size, int) or not 0 < self.chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError("Invalid chunk size")
+        self.download_dir = download_dir
+        self.part_path = os.path.join(download_dir, f".{self.transfer_id}.part")
+        self.path = None
+
+        # Keep whole chunks of an earlier attempt
+        existing = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+        self.offset = min(existing - existing % self.chunk_size, self.size)
+        self._file = open(self.part_path, "r+b" if existing else "wb")
+        self._file.truncate(self.offset)
+        self._hash = hashlib.sha256()
+        self._file.seek(0)
+        remaining = self.offset
+        while remaining:
+            data = self._file.read(min(remaining, 1024 * 1024))
+            self._hash.update(data)
+            remaining -= len(data)
+        self.resumed_from = self.offset
+
+    def write_chunk(self, frame):
+        """Returns True if the chunk was written, False if it must be resent"""
+        payload = frame["payload"]
+        if frame["offset"] != self.offset:
+            return None  # Sent before our rewind request arrived, ignore
+        if zlib.crc32(payload) != frame["crc32"]:
+            return False
+        self._file.seek(self.offset)
+        self._file.write(payload)
+        self._hash.update(payload)
+        self.offset += len(payload)
+        return True
+
+    @property
+    def complete(self):
+        return self.offset >= self.size
+
+    def finish(self):
+        """Verify and move into place, returns an error message or None"""
+        self._file.close()
+        if self._hash.hexdigest() != self.sha256:
+            os.unlink(self.part_path)
+            return "Checksum mismatch"
+        base, ext = os.path.splitext(self.name)
+        path = os.path.join(self.download_dir, self.name)
+        counter = 1
+        while os.path.exists(path):
+            path = os.path.join(self.download_dir, f"{base} ({counter}){ext}")
+            counter += 1
+        os.replace(self.part_path, path)
+        self.path = path
+        return None
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+class ReplyWriter:
+    """Sends the replies of a socket reader from a thread of its own.
+
+    A file sender holds the send lock while sendfile waits for the peer to
+    read. If the reader waited for that lock too, and the peer was doing the
+    same, two-way transfers would deadlock, so the reader only queues.
+    send_lock is the connection's own, shared with its senders.
+    """
+    def __init__(self, sock, send_lock):
+        self.sock = sock
+        self.send_lock = send_lock
+        self._frames = queue.Queue()
+        self._thread = None
+
+    def send(self, frame):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._frames.put(frame)
+
+    def _run(self):
+        while True:
+            frame = self._frames.get()
+            if frame is None:
+                return
+            try:
+                with self.send_lock:
+                    self.sock.sendall(encode_frame(frame))
+            except OSError:
+                abort_connection(self.sock)
+                return
+
+    def close(self):
+        if self._thread is not None:
+            self._frames.put(None)
+
+class FileTransferManager:
+    """File transfers of one protocol handler, both directions.
+
+    `peer` identifies the connection a frame came from (e.g. the client
+    address on the server) so several transfers can run at once.
+    """
+    def __init__(self, download_dir="downloads", chunk_size=DEFAULT_CHUNK_SIZE,
+                 use_sendfile=True, notify=print, on_file_received=None):
+        self.download_dir = download_dir
+        self.chunk_size = chunk_size
+        self.use_sendfile = use_sendfile
+        self.notify = notify
+        self.on_file_received = on_file_received  # Called with the IncomingFile
+        self.outgoing = {}
+        self.incoming = {}
+        self._senders = []  # Started and not done yet, stopped by close()
+        self._lock = threading.Lock()
+
+    def send_file(self, path, peer, sock, send_lock, scan=None):
+        """Start sending a file, pass the same FileScan when sending one
+        file to several peers so it is only read for checksums once.
+
+        send_lock is the lock of that peer's connection, not a shared one.
+        """
+        sender = FileSender(scan or FileScan(path, self.chunk_size), sock, send_lock,
+                            self.use_sendfile, notify=self.notify,
+                            register=lambda sender: self._register(peer, sender))
+        with self._lock:
+            self._senders = [running for running in self._senders if not running.done.is_set()]
+            self._senders.append(sender)
+        sender.start()
+        return sender
+
+    def _register(self, peer, sender):
+        with self._lock:
+            self.outgoing[(peer, sender.transfer_id)] = sender
+
+    def handle_frame(self, frame, peer, reply):
+        """Process a file_* frame, reply(frame) sends a frame back to the peer"""
+        key = (peer, frame.get("transfer_id"))
+        kind = frame["type"]
+        if kind in ("file_resume", "file_done"):
+            with self._lock:
+                sender = self.outgoing.get(key)
+                if kind == "file_done":
+                    self.outgoing.pop(key, None)
+            if sender:
+                sender.on_frame(frame)
+        elif kind == "file_offer":
+            os.makedirs(self.download_dir, exist_ok=True)
+            with self._lock:
+                previous = self.incoming.pop(key, None)
+            if previous:
+                previous.close()
+            try:
+                incoming = IncomingFile(frame, self.download_dir)
+            except (OSError, KeyError, ValueError) as e:
+                reply({"type": "file_done", "transfer_id": frame.get("transfer_id"), "ok": False, "error": str(e)})
+                return
+            with self._lock:
+                self.incoming[key] = incoming
+            reply({"type": "file_resume", "transfer_id": incoming.transfer_id, "offset": incoming.offset})
+            if incoming.complete:
+                self._finish(key, incoming, reply)
+        elif kind == "file_chunk":
+            with self._lock:
+                incoming = self.incoming.get(key)
+            if incoming is None:
+                return
+            written = incoming.write_chunk(frame)
+            if written is False:
+                reply({"type": "file_resume", "transfer_id": incoming.transfer_id, "offset": incoming.offset})
+            elif written and incoming.complete:
+                self._finish(key, incoming, reply)
+
+    def _finish(self, key, incoming, reply):
+        with self._lock:
+            self.incoming.pop(key, None)
+        error = incoming.finish()
+        reply({"type": "file_done", "transfer_id": incoming.transfer_id, "ok": error is None, "error": error})
+        if error:
+            self.notify(f"File {incoming.name} failed verification")
+        elif self.on_file_received:
+            self.on_file_received(incoming)
+
+    def close(self):
+        with self._lock:
+            for incoming in self.incoming.values():
+                incoming.close()
+            self.incoming.clear()
+            for sender in self._senders:
+                sender.stop()
+            self._senders.clear()
+            self.outgoing.clear()
@@ -0,0 +1,297 @@
+# protocols/local_handler.py
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler, JSONStreamDecoder
+from multiprocessing import resource_tracker, shared_memory
+import itertools
+import json
+import os
+import socket
+import stat
+import time
+
+DEFAULT_PATH = "/tmp/chatapp.sock"
+BULK_THRESHOLD = 16 * 1024  # Message bytes from which content goes through shared memory
+RING_SIZE = 4 * 1024 * 1024  # Bytes per connection and direction, a power of two
+POSITION_MASK = 0xFFFFFFFF
+
+_created = set()  # Names of the rings created by this process
+
+class SharedRing:
+    """Single-producer, single-consumer byte ring in shared memory.
+
+    The producer copies a payload in and sends its position and length over
+    the socket; the consumer copies it out in the same order and advances
+    the tail in the header, freeing the space. Positions count bytes modulo
+    2**32, so the tail is a single aligned 32-bit store.
+
+    The peer tells the consumer where to read, so read() only accepts the
+    next position in order and sizes up to the capacity.
+    """
+    HEADER = 8  # Tail, capacity
+
+    def __init__(self, memory, owner):
+        self.memory = memory
+        self.owner = owner
+        self.name = memory.name
+        self.words = memory.buf[:self.HEADER].cast("I")
+        self.capacity = self.words[1]
+        if self.capacity & (self.capacity - 1) or memory.size < self.HEADER + self.capacity:
+            self._release_views()
+            raise ValueError(f"{memory.name} is not a ring")
+        self.data = memory.buf[self.HEADER:self.HEADER + self.capacity]
+        self.head = 0
+
+    @classmethod
+    def create(cls, capacity=RING_SIZE):
+        if capacity & (capacity - 1) or capacity > 1 << 31:
+            raise ValueError("Ring capacity must be a power of two up to 2 GiB")
+        memory = shared_memory.SharedMemory(create=True, size=cls.HEADER + capacity)
+        header = memory.buf[:cls.HEADER].cast("I")
+        header[1] = capacity
+        header.release()
+        _created.add(memory.name)
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        memory = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            # Only the creating process may unlink it, don't let this one's
+            # resource tracker remove it on exit
+            resource_tracker.unregister(memory._name, "shared_memory")
+        return cls(memory, owner=False)
+
+    def write(self, payload, timeout=0.05):
+        """Copy payload in, returns its position, or None if the consumer
+        does not free enough space within timeout"""
+        size = len(payload)
+        if size > self.capacity:
+            return None
+        deadline = time.monotonic() + timeout
+        while self.capacity - ((self.head - self.words[0]) & POSITION_MASK) < size:
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.0005)
+        position = self.head
+        start = position % self.capacity
+        first = min(size, self.capacity - start)
+        self.data[start:start + first] = payload[:first]
+        self.data[:size - first] = payload[first:]
+        self.head = (position + size) & POSITION_MASK
+        return position
+
+    def read(self, position, size):
+        if position != self.words[0] or not isinstance(size, int) or not 0 <= size <= self.capacity:
+            raise ValueError("Payload outside the ring")
+        start = position % self.capacity
+        first = min(size, self.capacity - start)
+        payload = bytes(self.data[start:start + first]) + bytes(self.data[:size - first])
+        self.words[0] = (position + size) & POSITION_MASK
+        return payload
+
+    def _release_views(self):
+        for view in (getattr(self, "words", None), getattr(self, "data", None)):
+            if view is not None:
+                view.release()
+
+    def _release(self):
+        if getattr(self, "memory", None) is None:
+            return
+        self._release_views()
+        self.memory.close()
+        self.memory = None
+
+    def close(self):
+        if self.owner and self.memory is not None:
+            self.memory.unlink()
+            _created.discard(self.name)
+        self._release()
+
+    def __del__(self):
+        # The views must go before the memory, e.g. when a decoder is dropped
+        self._release()
+
+class SharedPayloadDecoder(JSONStreamDecoder):
+    """JSONStreamDecoder that fetches message content sent through a SharedRing.
+
+    The peer announces its ring once per connection with a shm_ring frame;
+    only that ring is ever attached and read.
+    """
+    def __init__(self):
+        super().__init__()
+        self._ring = None
+
+    def feed(self, data: bytes):
+        messages, invalid = super().feed(data)
+        resolved = []
+        for message in messages:
+            try:
+                if message.get("type") == "shm_ring":
+                    if self._ring is not None or not isinstance(message.get("name"), str):
+                        raise ValueError("Ring already announced")
+                    self._ring = SharedRing.attach(message["name"])
+                    continue
+                if "shm" in message:
+                    if self._ring is None:
+                        raise ValueError("No ring announced")
+                    position, size = message.pop("shm")
+                    message["content"] = self._ring.read(position, size).decode()
+            except (OSError, ValueError, TypeError):
+                invalid += 1
+                continue
+            resolved.append(message)
+        return resolved, invalid
+
+def _ring_frame(ring):
+    """Announces the ring the sender writes bulk content to"""
+    return json.dumps({"type": "shm_ring", "name": ring.name}).encode()
+
+def _message_frame(ring, message, payload):
+    """Encoded chat message, its content in the ring if there is room"""
+    frame = {"type": "message", "sent_ns": time.time_ns()}
+    position = ring.write(payload)
+    if position is None:
+        frame["content"] = message
+    else:
+        frame["shm"] = [position, len(payload)]
+    return json.dumps(frame).encode()
+
+class LocalMasterHandler(EthernetMasterHandler):
+    """EthernetMasterHandler over a Unix domain socket, for processes on the
+    same host (e.g. the UI, a logger and test tools).
+
+    With shared_memory, message content of bulk_threshold bytes or more is
+    copied through a SharedRing per client instead of the socket.
+    """
+    decoder_class = SharedPayloadDecoder
+    profile_name = "local_server"
+
+    def __init__(self, path: str = DEFAULT_PATH, shared_memory: bool = True,
+                 bulk_threshold: int = BULK_THRESHOLD, ring_size: int = RING_SIZE, **options):
+        super().__init__(host=path, port=None, **options)
+        self.path = path
+        self.shared_memory = shared_memory
+        self.bulk_threshold = bulk_threshold
+        self.ring_size = ring_size
+        self._rings = {}  # Client address -> SharedRing we write to
+        self._client_ids = itertools.count(1)
+        self._bound = False  # Whether the socket file at path is ours
+
+    @property
+    def endpoint(self):
+        return self.path
+
+    def _create_server_socket(self):
+        self._remove_stale_socket()
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server_socket.bind(self.path)
+        self._bound = True
+        # Only this user may connect; nobody can before listen() anyway
+        os.chmod(self.path, 0o600)
+        return server_socket
+
+    def _remove_stale_socket(self):
+        """Unlink a socket left over from a run that did not clean up, but
+        not one a running instance is listening on"""
+        try:
+            if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                raise OSError(f"{self.path} exists and is not a socket")
+        except FileNotFoundError:
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            os.unlink(self.path)
+            return
+        finally:
+            probe.close()
+        raise OSError(f"{self.path} is in use by another instance")
+
+    def _accept(self):
+        client_socket, _ = self.server_socket.accept()
+        # Unix socket clients have no address of their own
+        return client_socket, ("local", next(self._client_ids))
+
+    def _handle_client(self, client_socket, address):
+        try:
+            super()._handle_client(client_socket, address)
+        finally:
+            with self._lock:
+                ring = self._rings.pop(address, None)
+            if ring:
+                ring.close()
+
+    def send(self, message: str):
+        payload = message.encode()
+        if not self.shared_memory or len(payload) < self.bulk_threshold:
+            return super().send(message)
+
+        def write(addr, client):
+            # Under the client's send lock, so ring and socket order match
+            ring = self._rings.get(addr)
+            if ring is None:
+                ring = self._rings[addr] = SharedRing.create(self.ring_size)
+                client.sendall(_ring_frame(ring))
+            client.sendall(_message_frame(ring, message, payload))
+        return self._send_to_clients(write)
+
+    def cleanup(self):
+        result = super().cleanup()
+        with self._lock:
+            for ring in self._rings.values():
+                ring.close()
+            self._rings.clear()
+        if self._bound and os.path.exists(self.path):
+            os.unlink(self.path)
+            self._bound = False
+        return result
+
+class LocalClientHandler(EthernetClientHandler):
+    """EthernetClientHandler for a LocalMasterHandler's Unix domain socket"""
+    decoder_class = SharedPayloadDecoder
+    profile_name = "local_client"
+
+    def __init__(self, path: str = DEFAULT_PATH, shared_memory: bool = True,
+                 bulk_threshold: int = BULK_THRESHOLD, ring_size: int = RING_SIZE, **options):
+        super().__init__(host=path, port=None, **options)
+        self.path = path
+        self.shared_memory = shared_memory
+        self.bulk_threshold = bulk_threshold
+        self.ring_size = ring_size
+        self._ring = None  # SharedRing we write to
+
+    @property
+    def endpoint(self):
+        return self.path
+
+    def _create_socket(self):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), self.path
+
+    def send(self, message: str):
+        payload = message.encode()
+        if not self.shared_memory or len(payload) < self.bulk_threshold:
+            return super().send(message)
+        if not self.is_running or not self.client_socket or not self.connected:
+            return "Not connected to server"
+        try:
+            with self._lock:
+                if self._ring is None:
+                    self._ring = SharedRing.create(self.ring_size)
+                    self.client_socket.sendall(_ring_frame(self._ring))
+                self.client_socket.sendall(_message_frame(self._ring, message, payload))
+        except (ConnectionResetError, BrokenPipeError):
+            self.connected = False
+            self.is_running = False
+            return "Server connection lost"
+        except Exception as e:
+            self.connected = False
+            self.is_running = False
+            return f"Send error: {str(e)}"
+
+    def cleanup(self):
+        result = super().cleanup()
+        with self._lock:
+            if self._ring:
+                self._ring.close()
+                self._ring = None
+        return result
@@ -0,0 +1,152 @@
+# protocols/message_bus.py
+from protocols.bounded_queue import BoundedMessageQueue, DROP_OLDEST
+from queue import Empty
+import threading
+import time
+import uuid
+
+NO_MESSAGES = "No messages"  # What ProtocolHandler.receive returns when idle
+
+class Subscription:
+    """Bounded per-consumer queue fed by the MessageBus.
+
+    The overflow policy is one of protocols.bounded_queue's. By default a
+    slow consumer's oldest message is dropped so the other consumers and the
+    handlers are never held up; a consumer that must see every message,
+    like the database writer, spills to disk or blocks the bus instead.
+    """
+    def __init__(self, name, maxsize=1000, protocols=None, policy=DROP_OLDEST, spill_dir=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.protocols = set(protocols) if protocols else None
+        self._queue = BoundedMessageQueue(maxsize=maxsize, policy=policy, spill_dir=spill_dir)
+
+    @property
+    def policy(self):
+        return self._queue.policy
+
+    @property
+    def dropped(self):
+        return self._queue.dropped
+
+    def accepts(self, protocol):
+        return self.protocols is None or protocol in self.protocols
+
+    def put(self, message):
+        return self._queue.put(message)
+
+    def get(self, timeout=None):
+        """Wait for the next message, returns None on timeout"""
+        try:
+            return self._queue.get(timeout)
+        except Empty:
+            return None
+
+    def get_nowait(self):
+        try:
+            return self._queue.get_nowait()
+        except Empty:
+            return None
+
+    def drain(self):
+        """Return and remove everything queued so far"""
+        messages = []
+        while True:
+            message = self.get_nowait()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def stats(self):
+        return self._queue.stats()
+
+    def close(self):
+        """Discard what is queued and release a blocked publisher"""
+        self._queue.close()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+class MessageBus:
+    """Polls every attached protocol handler and fans received messages out
+    to all subscribers, so handlers keep running while not on screen.
+
+    Messages are dicts with at least "protocol" and "content" keys. Every
+    published message also gets a "uid", so consumers can refer to the same
+    message, e.g. the UI reporting when the stored message was shown.
+    """
+    def __init__(self, poll_interval=0.05, max_batch=100):
+        self.poll_interval = poll_interval
+        self.max_batch = max_batch  # Per handler per round, keeps polling fair
+        self.is_running = False
+        self._handlers = {}
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, name, maxsize=1000, protocols=None, policy=DROP_OLDEST, spill_dir=None):
+        subscription = Subscription(name, maxsize=maxsize, protocols=protocols,
+                                    policy=policy, spill_dir=spill_dir)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+        subscription.close()
+
+    def publish(self, protocol, message):
+        message = dict(message, protocol=protocol)
+        message.setdefault("uid", uuid.uuid4().hex)
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.accepts(protocol):
+                subscription.put(message)
+
+    def attach(self, protocol, handler):
+        with self._lock:
+            self._handlers[protocol] = handler
+
+    def detach(self, protocol):
+        with self._lock:
+            self._handlers.pop(protocol, None)
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self._thread = threading.Thread(target=self._pump, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self._thread:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def poll_once(self):
+        """Drain up to max_batch messages from each handler, returns the count"""
+        with self._lock:
+            handlers = list(self._handlers.items())
+        received = 0
+        for protocol, handler in handlers:
+            for _ in range(self.max_batch):
+                try:
+                    message = handler.receive_message()
+                except Exception as e:
+                    print(f"Bus receive error on {protocol}: {str(e)}")
+                    break
+                if message is None:
+                    break
+                message["dequeue_ns"] = time.time_ns()
+                self.publish(protocol, message)
+                received += 1
+        return received
+
+    def _pump(self):
+        while self.is_running:
+            if not self.poll_once():
+                time.sleep(self.poll_interval)
@@ -0,0 +1,427 @@
+# protocols/multicast_handler.py
+from protocols.protocol_handler import ProtocolHandler
+from protocols.bounded_queue import BoundedMessageQueue, DROP_OLDEST
+from protocols.ethernet_handler import _enqueue
+from profiling import profiler
+from collections import deque
+from queue import Empty
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+import json
+
+# Every datagram starts with a header:
+#   magic, kind, sender id, sequence number, count
+# DATA carries `count` messages numbered from `sequence` on, each prefixed
+# with its length. Receivers NACK the ranges they missed straight to the
+# sender, which resends them from its ring buffer, or answers LOST when they
+# have already left it. HEARTBEAT tells receivers the next sequence number,
+# so losing the last message before a quiet period is noticed too.
+HEADER = struct.Struct("!4sBQQH")
+LENGTH = struct.Struct("!H")
+RANGE = struct.Struct("!QQ")  # First and last sequence number, in NACK and LOST
+MAGIC = b"RPMC"
+DATA, NACK, HEARTBEAT, LOST = 1, 2, 3, 4
+
+IP_UDP_OVERHEAD = 28
+MAX_DATAGRAM = 65507
+MAX_NACK_RANGES = 64
+
+class SenderState:
+    """What a receiver knows about one sender's sequence"""
+    def __init__(self, next_seq, address):
+        self.next_seq = next_seq  # Next sequence number to deliver
+        self.highest = next_seq - 1  # Highest sequence number known to exist
+        self.pending = {}  # Received out of order, sequence -> message
+        self.address = address  # Where NACKs go
+        self.nacks = 0  # NACKs sent for the current gap
+        self.last_nack = 0.0
+
+    def missing(self):
+        """Ranges of sequence numbers between next_seq and highest not received"""
+        ranges = []
+        seq = self.next_seq
+        while seq <= self.highest and len(ranges) < MAX_NACK_RANGES:
+            if seq in self.pending:
+                seq += 1
+                continue
+            first = seq
+            while seq <= self.highest and seq not in self.pending:
+                seq += 1
+            ranges.append((first, seq - 1))
+        return ranges
+
+class MulticastHandler(ProtocolHandler):
+    """One-to-many chat over UDP multicast.
+
+    Every peer joins the same group and both sends and receives. Messages
+    sent within flush_interval of each other are packed into one datagram,
+    up to the MTU. Each sender numbers its messages; receivers deliver them
+    in order and ask for gaps to be resent (NACK) from the sender's ring of
+    the last retransmit_size messages. A gap that cannot be repaired after
+    max_nacks attempts is skipped and counted in stats()["lost"].
+
+    UDP has no backpressure, so a full receive queue drops its oldest
+    message by default instead of holding up the receive thread.
+    """
+    def __init__(self, group: str = "239.255.42.99", port: int = 5002,
+                 interface: str = "0.0.0.0", ttl: int = 1, mtu: int = 1500,
+                 flush_interval: float = 0.002, retransmit_size: int = 4096,
+                 nack_interval: float = 0.02, max_nacks: int = 10,
+                 heartbeat_interval: float = 1.0, queue_size: int = 1000,
+                 overflow_policy: str = DROP_OLDEST, spill_dir: str = None):
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.ttl = ttl
+        self.max_payload = mtu - IP_UDP_OVERHEAD - HEADER.size
+        self.flush_interval = flush_interval
+        self.nack_interval = nack_interval
+        self.max_nacks = max_nacks
+        self.heartbeat_interval = heartbeat_interval
+        self.sender_id = int.from_bytes(os.urandom(8), "big")
+        self.is_running = False
+        self.recv_socket = None  # Joined to the group
+        self.send_socket = None  # Sends to the group, gets NACKs and repairs
+        # Received messages; see protocols/bounded_queue.py for the policies
+        self.message_queue = BoundedMessageQueue(queue_size, overflow_policy, spill_dir)
+        self._senders = {}  # Sender id -> SenderState
+        self._receive_lock = threading.Lock()
+        self._ready = deque()  # In order messages waiting to be queued
+        self._deliver_lock = threading.Lock()  # Held while moving _ready to the queue
+        self._lock = threading.Condition()  # Held while numbering and sending
+        self._next_seq = 0
+        self._batch = []  # Encoded messages waiting for flush
+        self._batch_bytes = 0
+        self._batch_started = 0.0
+        self._ring = deque(maxlen=retransmit_size)  # (sequence, encoded message)
+        self._last_sent = 0.0
+        self._counters = {"datagrams_sent": 0, "retransmitted": 0, "nacks_sent": 0,
+                          "gaps": 0, "lost": 0, "duplicates": 0, "malformed": 0}
+        self._counters_lock = threading.Lock()
+        self.last_message = None
+
+    def initialize(self):
+        try:
+            self.recv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Several peers on one host (e.g. benchmarks) share the group port
+            self.recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            self.recv_socket.bind(("", self.port))
+            if self.port == 0:
+                self.port = self.recv_socket.getsockname()[1]
+            membership = socket.inet_aton(self.group) + socket.inet_aton(self.interface)
+            self.recv_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+            self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self.send_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            if self.interface != "0.0.0.0":
+                self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                            socket.inet_aton(self.interface))
+            self.send_socket.bind((self.interface, 0))
+        except Exception as e:
+            self._close_sockets()
+            return f"Failed to join multicast group: {str(e)}"
+        self.is_running = True
+        threading.Thread(target=self._receive_datagrams, daemon=True).start()
+        threading.Thread(target=self._run_timers, daemon=True).start()
+        return f"Joined multicast group {self.group}:{self.port}"
+
+    # Sending
+
+    def send(self, message: str):
+        if not self.is_running:
+            return "Multicast not started"
+        data = json.dumps({
+            "content": message,
+            "type": "message",
+            "sent_ns": time.time_ns()
+        }).encode()
+        if len(data) > MAX_DATAGRAM - HEADER.size - LENGTH.size:
+            return "Message too large for a datagram"
+        try:
+            with self._lock:
+                if self._batch and self._batch_bytes + LENGTH.size + len(data) > self.max_payload:
+                    self._flush()
+                self._ring.append((self._next_seq, data))
+                self._next_seq += 1
+                if not self._batch:
+                    self._batch_started = time.monotonic()
+                    self._lock.notify()
+                self._batch.append(data)
+                self._batch_bytes += LENGTH.size + len(data)
+                if self.flush_interval <= 0 or self._batch_bytes >= self.max_payload:
+                    self._flush()
+        except OSError as e:
+            return f"Send error: {str(e)}"
+
+    def _flush(self):
+        """Send the batch as one datagram, called with the lock held"""
+        if not self._batch:
+            return
+        first = self._next_seq - len(self._batch)
+        self._transmit(self._datagram(DATA, first, self._batch), (self.group, self.port))
+        self._batch = []
+        self._batch_bytes = 0
+
+    def _datagram(self, kind, seq, messages=()):
+        parts = [HEADER.pack(MAGIC, kind, self.sender_id, seq, len(messages))]
+        for data in messages:
+            parts.append(LENGTH.pack(len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    @staticmethod
+    def _ranges_datagram(kind, sender, ranges):
+        """NACK or LOST for ranges of the given sender's sequence numbers"""
+        return HEADER.pack(MAGIC, kind, sender, 0, len(ranges)) + b"".join(
+            RANGE.pack(first, last) for first, last in ranges)
+
+    def _transmit(self, datagram, address):
+        self.send_socket.sendto(datagram, address)
+        self._count("datagrams_sent")
+        self._last_sent = time.monotonic()
+
+    def _count(self, name, n=1):
+        with self._counters_lock:
+            self._counters[name] += n
+
+    def _resend(self, ranges, address):
+        """Answer a NACK from the ring, batching consecutive messages"""
+        with self._lock:
+            if not self._ring:
+                return
+            oldest = self._ring[0][0]
+            for first, last in ranges:
+                last = min(last, self._next_seq - len(self._batch) - 1)  # Only what was sent
+                if first > last:
+                    continue
+                if first < oldest:
+                    gone = min(last, oldest - 1)
+                    self._transmit(self._ranges_datagram(LOST, self.sender_id, [(first, gone)]), address)
+                    first = gone + 1
+                run, size = [], 0
+                for seq in range(first, last + 1):
+                    data = self._ring[seq - oldest][1]
+                    if run and size + LENGTH.size + len(data) > self.max_payload:
+                        self._transmit(self._datagram(DATA, seq - len(run), run), address)
+                        run, size = [], 0
+                    run.append(data)
+                    size += LENGTH.size + len(data)
+                    self._count("retransmitted")
+                if run:
+                    self._transmit(self._datagram(DATA, last + 1 - len(run), run), address)
+
+    def _run_timers(self):
+        """Flush batches, send heartbeats and NACK unrepaired gaps"""
+        while self.is_running:
+            with self._lock:
+                if not self._batch:
+                    self._lock.wait(self.nack_interval)
+                if self._batch:
+                    delay = self._batch_started + self.flush_interval - time.monotonic()
+                    if delay > 0:
+                        self._lock.wait(delay)
+                try:
+                    self._flush()
+                    if (self._next_seq and self.is_running
+                            and time.monotonic() - self._last_sent >= self.heartbeat_interval):
+                        self._transmit(self._datagram(HEARTBEAT, self._next_seq), (self.group, self.port))
+                except OSError as e:
+                    if self.is_running:
+                        print(f"Multicast send error: {str(e)}")
+            self._repair_gaps()
+
+    # Receiving
+
+    def _receive_datagrams(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.recv_socket, selectors.EVENT_READ)
+        selector.register(self.send_socket, selectors.EVENT_READ)
+        while self.is_running:
+            try:
+                for key, _ in selector.select(timeout=0.5):
+                    datagram, address = key.fileobj.recvfrom(MAX_DATAGRAM)
+                    with profiler.stage("multicast.receive"):
+                        self._handle_datagram(datagram, address, time.time_ns())
+            except (OSError, ValueError, struct.error) as e:
+                if self.is_running:
+                    print(f"Multicast receive error: {str(e)}")
+                    time.sleep(0.1)
+        selector.close()
+
+    def _handle_datagram(self, datagram, address, recv_ns):
+        if len(datagram) < HEADER.size:
+            return
+        magic, kind, sender, seq, count = HEADER.unpack_from(datagram)
+        if magic != MAGIC:
+            return
+        body = memoryview(datagram)[HEADER.size:]
+        if kind in (NACK, LOST):
+            if len(body) != count * RANGE.size:
+                self._count("malformed")
+                return
+            ranges = [RANGE.unpack_from(body, i * RANGE.size) for i in range(count)]
+            if kind == NACK and sender == self.sender_id:
+                self._resend(ranges, address)
+            elif kind == LOST:
+                for first, last in ranges:
+                    self._skip(sender, first, last)
+            return
+        if sender == self.sender_id:
+            return  # Our own datagram looped back
+        if kind == DATA:
+            messages = self._split_messages(body, count)
+            if messages is None:
+                self._count("malformed")
+                return
+            self._receive(sender, address, seq, messages, recv_ns)
+        elif kind == HEARTBEAT:
+            self._receive(sender, address, seq, [], recv_ns)
+
+    @staticmethod
+    def _split_messages(body, count):
+        """The count length-prefixed messages of a DATA body, or None if it
+        is truncated or has bytes left over"""
+        messages, offset = [], 0
+        for _ in range(count):
+            if offset + LENGTH.size > len(body):
+                return None
+            (length,) = LENGTH.unpack_from(body, offset)
+            offset += LENGTH.size
+            if offset + length > len(body):
+                return None
+            messages.append(bytes(body[offset:offset + length]))
+            offset += length
+        return messages if offset == len(body) else None
+
+    def _receive(self, sender, address, first, messages, recv_ns):
+        with self._receive_lock:
+            state = self._senders.get(sender)
+            if state is None:
+                # Joined mid-stream, start from the first message seen
+                state = self._senders[sender] = SenderState(first, address)
+            if not messages and first > state.next_seq and first - 1 > state.highest:
+                state.highest = first - 1  # Heartbeat, the tail was lost
+            for seq, data in enumerate(messages, first):
+                if seq < state.next_seq or seq in state.pending:
+                    self._count("duplicates")
+                    continue
+                state.pending[seq] = data
+                if seq > state.highest + 1:
+                    self._count("gaps")
+                state.highest = max(state.highest, seq)
+            self._deliver(state, recv_ns)
+        self._queue_ready()
+        if state.highest >= state.next_seq:
+            self._repair_gaps()
+
+    def _skip(self, sender, first, last):
+        with self._receive_lock:
+            state = self._senders.get(sender)
+            if state is None or last < state.next_seq:
+                return
+            for seq in range(max(first, state.next_seq), last + 1):
+                if seq not in state.pending:
+                    self._count("lost")
+            state.next_seq = last + 1
+            state.highest = max(state.highest, last)
+            self._deliver(state, time.time_ns())
+        self._queue_ready()
+
+    def _repair_gaps(self):
+        now = time.monotonic()
+        nacks = []
+        with self._receive_lock:
+            for sender, state in self._senders.items():
+                if state.highest < state.next_seq or now - state.last_nack < self.nack_interval:
+                    continue
+                ranges = state.missing()
+                if state.nacks >= self.max_nacks:
+                    nacks.append((sender, None, ranges[0]))  # Give up on the first gap
+                    continue
+                state.nacks += 1
+                state.last_nack = now
+                nacks.append((sender, state.address, ranges))
+        for sender, address, ranges in nacks:
+            if address is None:
+                self._skip(sender, *ranges)
+                continue
+            try:
+                self._transmit(self._ranges_datagram(NACK, sender, ranges), address)
+                self._count("nacks_sent")
+            except OSError as e:
+                print(f"Multicast NACK error: {str(e)}")
+
+    def _deliver(self, state, recv_ns):
+        """Move the sender's messages that are now in order to _ready,
+        called with the receive lock held so they stay in order"""
+        while state.next_seq in state.pending:
+            data = state.pending.pop(state.next_seq)
+            state.next_seq += 1
+            state.nacks = 0
+            try:
+                message = json.loads(data)
+            except ValueError:
+                print("Invalid multicast message")
+                continue
+            if not isinstance(message, dict):
+                continue
+            message['recv_ns'] = recv_ns
+            self._ready.append(message)
+
+    def _queue_ready(self):
+        """Queue the messages in _ready, outside the receive lock so a full
+        queue does not hold up NACKs and repairs"""
+        with self._deliver_lock:
+            while self._ready:
+                message = self._ready.popleft()
+                message['enqueue_ns'] = time.time_ns()
+                if not _enqueue(self, message):
+                    return
+                self.last_message = message.get('content')
+
+    def receive(self) -> str:
+        try:
+            message = self.message_queue.get_nowait()
+            return message['content']
+        except:
+            return "No messages"
+
+    def receive_message(self):
+        """Next message dict including its trace times, or None"""
+        try:
+            return self.message_queue.get_nowait()
+        except Empty:
+            return None
+
+    def queue_stats(self):
+        """Drop, spill and high-water counters of the receive queue"""
+        return self.message_queue.stats()
+
+    def stats(self):
+        """Datagram, retransmission and loss counters"""
+        with self._counters_lock:
+            return dict(self._counters, peers=len(self._senders))
+
+    def _close_sockets(self):
+        for sock in (self.recv_socket, self.send_socket):
+            if sock:
+                sock.close()
+        self.recv_socket = self.send_socket = None
+
+    def cleanup(self):
+        with self._lock:
+            try:
+                self._flush()
+            except OSError:
+                pass
+            self.is_running = False
+            self._lock.notify_all()
+            self._close_sockets()
+        return "Left multicast group"
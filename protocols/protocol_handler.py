@@ -11,6 +11,17 @@ class ProtocolHandler(ABC):
     def receive(self) -> str:
         pass
 
+    def receive_message(self):
+        """Next received message as a dict with a "content" key, or None.
+
+        Handlers that know more about a message (e.g. latency trace times)
+        override this to include it.
+        """
+        content = self.receive()
+        if content == "No messages":
+            return None
+        return {"content": content}
+
     def initialize(self):
         """Optional initialization method"""
         pass
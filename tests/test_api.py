@@ -1,8 +1,9 @@
 import unittest
 import json
 from unittest.mock import patch
-from api import app
+from api import app, feed, get_store
 from database.setup_db import setup_database
+import shutil
 import tempfile
 import os
 
@@ -73,5 +74,170 @@ class TestAPI(unittest.TestCase):
         data = json.loads(response.data)
         self.assertTrue('id' in data)
 
+    def post_message(self, message, protocol="test"):
+        response = self.app.post('/messages',
+                                 data=json.dumps({
+                                     "protocol": protocol,
+                                     "sender": "tester",
+                                     "recipient": "test_recipient",
+                                     "message": message
+                                 }),
+                                 content_type='application/json')
+        return json.loads(response.data)['id']
+
+    def read_events(self, response, count):
+        """Collect the data of the next `count` message events from a stream"""
+        events = []
+        chunks = iter(response.response)
+        while len(events) < count:
+            chunk = next(chunks)
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            for line in chunk.splitlines():
+                if line.startswith('data: '):
+                    events.append(json.loads(line[len('data: '):]))
+        return events
+
+    def test_history_sorted_by_store_time(self):
+        # The sender's clock is behind for the second message
+        for message, sent_ns in (("first", 2000), ("second", 1000)):
+            self.app.post('/messages', data=json.dumps({
+                "protocol": "test", "sender": "Client", "recipient": "You",
+                "message": message, "sent_ns": sent_ns
+            }), content_type='application/json')
+
+        data = json.loads(self.app.get('/messages').data)
+
+        self.assertEqual([m['message'] for m in data], ["first", "second"])
+        self.assertTrue(all(m['persist_ns'] for m in data))
+
+    def test_post_same_uid_is_stored_once(self):
+        message = {"protocol": "test", "sender": "Client", "recipient": "You",
+                   "message": "hi", "uid": "abc123"}
+        first = self.app.post('/messages', data=json.dumps(message), content_type='application/json')
+        second = self.app.post('/messages', data=json.dumps(message), content_type='application/json')
+
+        self.assertEqual(json.loads(first.data)['id'], json.loads(second.data)['id'])
+        self.assertEqual(len(json.loads(self.app.get('/messages').data)), 1)
+
+    def test_render_times(self):
+        self.app.post('/messages', data=json.dumps({
+            "protocol": "test", "sender": "Client", "recipient": "You",
+            "message": "hi", "uid": "abc123", "recv_ns": 10
+        }), content_type='application/json')
+
+        response = self.app.post('/messages/trace', data=json.dumps([
+            {"uid": "abc123", "render_ns": 99},
+            {"uid": "unknown", "render_ns": 100}
+        ]), content_type='application/json')
+
+        self.assertEqual(json.loads(response.data)['missing'], ["unknown"])
+        message = json.loads(self.app.get('/messages').data)[0]
+        self.assertEqual((message['recv_ns'], message['render_ns']), (10, 99))
+
+    def test_stream_pushes_new_messages(self):
+        response = self.app.get('/messages/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        self.assertIn('retry', next(chunks).decode())  # Subscribed
+
+        message_id = self.post_message("live")
+        event = json.loads(next(chunks).decode().split('data: ', 1)[1])
+
+        self.assertEqual(event['id'], message_id)
+        self.assertEqual(event['message'], "live")
+        response.close()
+        self.assertEqual(feed.subscriber_count, 0)
+
+    def test_stream_limit_is_reserved_per_request(self):
+        app.config['MAX_STREAMS'] = 1
+        try:
+            first = self.app.get('/messages/stream', buffered=False)  # Not started yet
+            second = self.app.get('/messages/stream', buffered=False)
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(second.status_code, 503)
+            first.close()
+            self.assertEqual(feed.subscriber_count, 0)
+        finally:
+            del app.config['MAX_STREAMS']
+
+    def test_stream_resumes_from_last_event_id(self):
+        first = self.post_message("one")
+        self.post_message("two")
+        self.post_message("three")
+
+        response = self.app.get('/messages/stream', buffered=False,
+                                headers={'Last-Event-ID': str(first)})
+        events = self.read_events(response, 2)
+        response.close()
+
+        self.assertEqual([e['message'] for e in events], ["two", "three"])
+
+    def test_stream_filters_by_protocol(self):
+        self.post_message("other", protocol="UART/Serial")
+        self.post_message("wanted", protocol="TCP/IP(Server)")
+
+        response = self.app.get('/messages/stream?protocol=TCP/IP(Server)',
+                                buffered=False, headers={'Last-Event-ID': '0'})
+        events = self.read_events(response, 1)
+        response.close()
+
+        self.assertEqual([e['message'] for e in events], ["wanted"])
+
+    def test_stream_invalid_last_event_id(self):
+        response = self.app.get('/messages/stream', headers={'Last-Event-ID': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_get(self):
+        message = {"protocol": "UART/Serial", "sender": "tester", "recipient": "you", "message": "hi"}
+        self.app.post('/messages', json=message)
+        response = self.app.get('/messages?protocol=UART/Serial&limit=50')
+        etag = response.headers['ETag']
+        self.assertEqual(len(response.get_json()), 1)
+
+        unchanged = self.app.get('/messages?protocol=UART/Serial&limit=50', headers={'If-None-Match': etag})
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.data, b'')
+
+        self.app.post('/messages', json=dict(message, message="again"))
+        changed = self.app.get('/messages?protocol=UART/Serial&limit=50', headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual([m["message"] for m in changed.get_json()], ["hi", "again"])
+        self.assertNotEqual(changed.headers['ETag'], etag)
+
+    def test_limit_returns_most_recent(self):
+        for i in range(5):
+            self.app.post('/messages', json={"protocol": "UART/Serial", "sender": "tester",
+                                             "recipient": "you", "message": str(i), "sent_ns": i})
+        response = self.app.get('/messages?protocol=UART/Serial&limit=2')
+        self.assertEqual([m["message"] for m in response.get_json()], ["3", "4"])
+
+    def test_limit_must_be_positive(self):
+        for limit in (0, -1):
+            response = self.app.get(f'/messages?limit={limit}')
+            self.assertEqual(response.status_code, 400)
+
+class TestAPILogStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        app.config.update(STORAGE='log', LOG_DIRECTORY=self.directory, TESTING=True)
+        self.app = app.test_client()
+
+    def tearDown(self):
+        get_store().close()
+        app.config['STORAGE'] = 'sqlite'
+        shutil.rmtree(self.directory)
+
+    def test_post_and_get(self):
+        message = {"protocol": "UART/Serial", "sender": "tester", "recipient": "you", "message": "hi", "uid": "u1"}
+        response = self.app.post('/messages', json=message)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.app.post('/messages', json=message).get_json(), response.get_json())
+
+        data = self.app.get('/messages?protocol=UART/Serial').get_json()
+        self.assertEqual([m["message"] for m in data], ["hi"])
+
+    def test_sync_needs_sqlite(self):
+        self.assertEqual(self.app.get('/sync/changes').status_code, 501)
+
 if __name__ == '__main__':
     unittest.main()
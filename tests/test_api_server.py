@@ -0,0 +1,203 @@
+import http.client
+import socket
+import threading
+import time
+import unittest
+from flask import Flask, request
+from api_server import PooledWSGIServer, make_api_server, DEFAULT_MAX_STREAMS
+
+def make_app():
+    app = Flask(__name__)
+    release = threading.Event()
+
+    @app.route('/slow')
+    def slow():
+        release.wait(5.0)
+        return 'slow'
+
+    @app.route('/port')
+    def port():
+        return str(request.environ['REMOTE_PORT'])
+
+    @app.route('/echo', methods=['POST'])
+    def echo():
+        return str(len(request.get_data()))
+
+    @app.route('/chunks')
+    def chunks():
+        return app.response_class(iter([b'one', b'two']))
+
+    @app.route('/fail')
+    def fail():
+        def body():
+            raise RuntimeError('boom')  # After the app returned, past Flask's error handling
+            yield b''
+        return app.response_class(body())
+
+    @app.route('/events')
+    def events():
+        def body():
+            yield 'retry: 3000\n\n'
+            while not release.wait(0.05):
+                yield ': keep-alive\n\n'
+        return app.response_class(body(), mimetype='text/event-stream')
+
+    app.release = release
+    return app
+
+class TestPooledWSGIServer(unittest.TestCase):
+    def start(self, **options):
+        self.app = make_app()
+        self.server = PooledWSGIServer('127.0.0.1', 0, self.app, **options)
+        self.port = self.server.socket.getsockname()[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.app.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path, timeout=5.0):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def test_slow_request_does_not_block_others(self):
+        self.start(workers=2)
+        slow = threading.Thread(target=self.get, args=('/slow',))
+        slow.start()
+        time.sleep(0.1)
+
+        start = time.perf_counter()
+        status, _ = self.get('/port')
+        self.assertEqual(status, 200)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.app.release.set()
+        slow.join()
+
+    def test_keep_alive(self):
+        self.start(workers=2)
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5.0)
+        ports = []
+        for _ in range(3):
+            connection.request('GET', '/port')
+            response = connection.getresponse()
+            self.assertEqual(response.version, 11)
+            ports.append(response.read())
+        connection.close()
+        self.assertEqual(len(set(ports)), 1)
+
+    def test_keep_alive_skips_unread_body(self):
+        self.start(workers=1)
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5.0)
+        connection.request('POST', '/port', body=b'x' * 100000)  # 405, body never read
+        response = connection.getresponse()
+        response.read()
+        self.assertEqual(response.status, 405)
+        connection.request('POST', '/echo', body=b'y' * 10)
+        self.assertEqual(connection.getresponse().read(), b'10')
+        connection.close()
+
+    def test_keep_alive_with_chunked_response(self):
+        self.start(workers=1)
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5.0)
+        for _ in range(2):
+            connection.request('GET', '/chunks')
+            response = connection.getresponse()
+            self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(response.getheader('Connection'), 'keep-alive')
+            self.assertEqual(response.read(), b'onetwo')
+        connection.close()
+
+    def test_app_error_is_500(self):
+        self.start(workers=1)
+        self.assertEqual(self.get('/fail')[0], 500)
+        self.assertEqual(self.get('/port')[0], 200)
+
+    def test_closes_kept_alive_connection_when_others_wait(self):
+        self.start(workers=1)
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5.0)
+        connection.request('GET', '/port')
+        connection.getresponse().read()
+        waiting = threading.Thread(target=self.get, args=('/port',))
+        waiting.start()
+        time.sleep(0.1)
+        connection.request('GET', '/port')
+        response = connection.getresponse()
+        response.read()
+        self.assertEqual(response.getheader('Connection'), 'close')
+        connection.close()
+        waiting.join()
+
+    def test_streams_do_not_hold_workers(self):
+        self.start(workers=1)
+        streams = []
+        for _ in range(3):
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5.0)
+            connection.request('GET', '/events')
+            response = connection.getresponse()
+            self.assertEqual(response.getheader('Connection'), 'close')
+            self.assertIn(b'retry', response.read1())
+            streams.append((connection, response))
+
+        self.assertEqual(self.get('/port', timeout=1.0)[0], 200)
+        self.assertEqual(self.server.stream_count, 3)
+        self.assertIn(b'keep-alive', streams[0][1].read1())
+
+        self.app.release.set()  # The streams end
+        for connection, response in streams:
+            response.read()
+            connection.close()
+        deadline = time.monotonic() + 2.0
+        while self.server.stream_count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.stream_count, 0)
+
+    def test_rejects_when_queue_stays_full(self):
+        self.start(workers=1, backlog=1, queue_timeout=0.1)
+        busy = threading.Thread(target=self.get, args=('/slow',))
+        busy.start()
+        time.sleep(0.1)
+        waiting = socket.create_connection(('127.0.0.1', self.port))  # Takes the queue slot
+        time.sleep(0.1)
+
+        status, _ = self.get('/port')
+        self.assertEqual(status, 503)
+        self.assertEqual(self.server.rejected, 1)
+        waiting.close()
+        self.app.release.set()
+        busy.join()
+
+    def test_idle_connection_times_out(self):
+        self.start(workers=1, timeout=0.2)
+        idle = socket.create_connection(('127.0.0.1', self.port))
+        idle.settimeout(5.0)
+        start = time.perf_counter()
+        self.assertEqual(idle.recv(1024), b'')
+        self.assertLess(time.perf_counter() - start, 2.0)
+        idle.close()
+        # The worker is free again
+        self.assertEqual(self.get('/port')[0], 200)
+
+class TestMakeAPIServer(unittest.TestCase):
+    def test_body_size_cap(self):
+        app = make_app()
+        server = make_api_server(app, '127.0.0.1', 0, mode='pool', workers=2)
+        try:
+            client = app.test_client()
+            self.assertEqual(client.post('/echo', data=b'x' * 1000).data, b'1000')
+            self.assertEqual(client.post('/echo', data=b'x' * (2 * 1024 * 1024)).status_code, 413)
+            self.assertEqual(app.config['MAX_STREAMS'], DEFAULT_MAX_STREAMS)
+        finally:
+            server.server_close()
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            make_api_server(make_app(), '127.0.0.1', 0, mode='forking')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+import json
+import socket
+import threading
+import time
+import tracemalloc
+from queue import Empty
+from protocols.bounded_queue import BoundedMessageQueue, BLOCK, DROP_OLDEST, SPILL
+from protocols.ethernet_handler import EthernetMasterHandler
+
+class TestBoundedMessageQueue(unittest.TestCase):
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            BoundedMessageQueue(10, "grow")
+
+    def test_drop_oldest(self):
+        queue = BoundedMessageQueue(2, DROP_OLDEST)
+        for i in range(5):
+            self.assertTrue(queue.put({"content": i}))
+
+        self.assertEqual(queue.get_nowait()["content"], 3)
+        self.assertEqual(queue.get_nowait()["content"], 4)
+        stats = queue.stats()
+        self.assertEqual(stats["dropped"], 3)
+        self.assertEqual(stats["high_water"], 2)
+
+    def test_block_times_out_when_full(self):
+        queue = BoundedMessageQueue(1, BLOCK)
+        queue.put({"content": "a"})
+
+        self.assertFalse(queue.put({"content": "b"}, timeout=0.05))
+        self.assertEqual(queue.qsize(), 1)
+
+    def test_block_resumes_when_consumed(self):
+        queue = BoundedMessageQueue(1, BLOCK)
+        queue.put({"content": "a"})
+        threading.Timer(0.05, queue.get_nowait).start()
+
+        self.assertTrue(queue.put({"content": "b"}, timeout=2.0))
+        self.assertEqual(queue.get_nowait()["content"], "b")
+
+    def test_close_wakes_blocked_producer(self):
+        queue = BoundedMessageQueue(1, BLOCK)
+        queue.put({"content": "a"})
+        threading.Timer(0.05, queue.close).start()
+
+        self.assertFalse(queue.put({"content": "b"}))
+
+    def test_spill_keeps_order(self):
+        queue = BoundedMessageQueue(3, SPILL)
+        for i in range(10):
+            queue.put({"content": i})
+
+        self.assertEqual(queue.stats()["spilled"], 7)
+        self.assertEqual(queue.stats()["high_water"], 3)
+        self.assertEqual([queue.get_nowait()["content"] for _ in range(10)], list(range(10)))
+        with self.assertRaises(Empty):
+            queue.get_nowait()
+
+    def test_spill_interleaved(self):
+        queue = BoundedMessageQueue(2, SPILL)
+        received = []
+        for i in range(20):
+            queue.put({"content": i})
+            if i % 3 == 0:
+                received.append(queue.get_nowait()["content"])
+        while queue.qsize():
+            received.append(queue.get_nowait()["content"])
+
+        self.assertEqual(received, list(range(20)))
+
+def _frame(i, padding=""):
+    return json.dumps({"content": f"message {i}{padding}", "type": "message"}).encode()
+
+class TestQueueSoak(unittest.TestCase):
+    """Flood a real server on loopback while nothing consumes its queue"""
+    MESSAGES = 20000
+
+    def start_server(self, **queue_options):
+        handler = EthernetMasterHandler("127.0.0.1", 0, **queue_options)
+        self.assertIn("Server listening", handler.initialize())
+        self.addCleanup(handler.cleanup)
+        sender = socket.create_connection(("127.0.0.1", handler.port))
+        self.addCleanup(sender.close)
+        return handler, sender
+
+    def wait_until(self, condition, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out waiting for the handler")
+            time.sleep(0.01)
+
+    def test_drop_oldest_memory_stays_bounded(self):
+        handler, sender = self.start_server(queue_size=100, overflow_policy=DROP_OLDEST)
+
+        payload = b"".join(_frame(i) for i in range(self.MESSAGES))
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            sender.sendall(payload)
+            self.wait_until(lambda: handler.queue_stats()["dropped"] + handler.message_queue.qsize() == self.MESSAGES)
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        # Only count memory allocated by the handler code, other threads
+        # (e.g. left over from other tests) may allocate meanwhile
+        handler_code = [tracemalloc.Filter(True, "*protocols*")]
+        growth = sum(stat.size_diff for stat in after.filter_traces(handler_code).compare_to(
+            before.filter_traces(handler_code), "filename"))
+
+        stats = handler.queue_stats()
+        self.assertEqual(stats["high_water"], 100)
+        self.assertEqual(stats["dropped"], self.MESSAGES - 100)
+        # 20k queued dicts would take several MB
+        self.assertLess(growth, 1024 * 1024)
+        self.assertEqual(handler.receive(), f"message {self.MESSAGES - 100}")
+
+    def test_block_applies_backpressure(self):
+        handler, sender = self.start_server(queue_size=10, overflow_policy=BLOCK)
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        padding = "x" * 1000
+        payload = b"".join(_frame(i, padding) for i in range(self.MESSAGES))
+
+        # Nobody consumes, so the sender eventually stalls on full socket buffers
+        sender.settimeout(0.5)
+        sent = 0
+        with self.assertRaises(socket.timeout):
+            while sent < len(payload):
+                sent += sender.send(payload[sent:sent + 65536])
+        self.assertLess(sent, len(payload))
+        self.assertEqual(handler.queue_stats()["high_water"], 10)
+
+        # Draining lets the rest through without losing anything
+        sender.settimeout(None)
+        writer = threading.Thread(target=sender.sendall, args=(payload[sent:],))
+        writer.start()
+        received = []
+        deadline = time.monotonic() + 20
+        while len(received) < self.MESSAGES and time.monotonic() < deadline:
+            message = handler.receive()
+            if message == "No messages":
+                time.sleep(0.001)
+            else:
+                received.append(message)
+        writer.join()
+
+        self.assertEqual(received, [f"message {i}{padding}" for i in range(self.MESSAGES)])
+        self.assertEqual(handler.queue_stats()["dropped"], 0)
+
+    def test_spill_to_disk(self):
+        handler, sender = self.start_server(queue_size=50, overflow_policy=SPILL)
+
+        sender.sendall(b"".join(_frame(i) for i in range(self.MESSAGES)))
+        self.wait_until(lambda: handler.message_queue.qsize() == self.MESSAGES)
+
+        stats = handler.queue_stats()
+        self.assertEqual(stats["high_water"], 50)
+        self.assertEqual(stats["spilled"], self.MESSAGES - 50)
+        self.assertEqual(
+            [handler.receive() for _ in range(self.MESSAGES)],
+            [f"message {i}" for i in range(self.MESSAGES)]
+        )
+
+if __name__ == '__main__':
+    unittest.main()
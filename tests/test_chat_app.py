@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import Mock, patch, PropertyMock
-from chatapp import ChatApp, MessageBubble
+from chatapp import ChatApp, MessageBubble, StartupProfile, find_free_port, discover_host_ip
+import socket
 
 class TestChatApp(unittest.TestCase):
     def setUp(self):
@@ -50,6 +51,22 @@ class TestChatApp(unittest.TestCase):
             handler_mock.initialize.assert_called_once()
             self.app.load_chat_history.assert_called_once()
 
+    def test_switching_shows_received_messages_once(self):
+        bus = self.app.message_bus
+        with patch.object(self.app, 'setup_protocol_list'), \
+             patch.object(self.app, 'add_message_bubble') as add_bubble, \
+             patch.object(self.app, 'load_chat_history', return_value=set()):
+            self.app.select_protocol("UART")
+            bus.publish("UART", {"content": "for the old view", "uid": "a"})
+            bus.publish("Ethernet(Master)", {"content": "stored", "uid": "b"})
+            bus.publish("Ethernet(Master)", {"content": "not stored yet", "uid": "c"})
+            self.app.load_chat_history.return_value = {"b"}
+            self.app.select_protocol("Ethernet(Master)")
+
+            shown = [call.args[1] for call in add_bubble.call_args_list if call.args[0] != "System"]
+            self.assertEqual(shown, ["for the old view", "not stored yet"])
+            self.assertEqual(self.app._offscreen, {})
+
     @patch('requests.post')
     def test_send_message_no_protocol(self, mock_post):
         self.app.current_protocol = None
@@ -108,5 +125,54 @@ class TestChatApp(unittest.TestCase):
         # Assert
         chat_history.add_widget.assert_called_once()
 
+    def test_api_url_waits_for_server(self):
+        self.app.base_url = None
+
+        # Server not up yet and the wait times out
+        self.assertIsNone(self.app._api_url(timeout=0.01))
+
+        self.app.base_url = "http://127.0.0.1:5000/messages"
+        self.app._api_ready.set()
+        self.assertEqual(self.app._api_url(), "http://127.0.0.1:5000/messages")
+
+    def test_sync_continues_after_a_failing_peer(self):
+        import sqlite3
+        self.app.message_feed = Mock()
+        broken = Mock(peer_url="http://broken", pull=Mock(side_effect=sqlite3.DatabaseError("bad row")))
+        bad_json = Mock(peer_url="http://garbage", pull=Mock(side_effect=KeyError("changes")))
+        working = Mock(peer_url="http://working", pull=Mock(return_value=3))
+
+        self.app._sync_peers([broken, bad_json, working])
+
+        working.pull.assert_called_once()
+        self.app.message_feed.notify.assert_called_once()
+
+class TestStartupHelpers(unittest.TestCase):
+    def test_find_free_port_skips_busy_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as busy:
+            busy.bind(('127.0.0.1', 0))
+            busy_port = busy.getsockname()[1]
+            port = find_free_port(start_port=busy_port, max_attempts=10)
+        self.assertNotEqual(port, busy_port)
+
+    def test_discover_host_ip(self):
+        ip = discover_host_ip()
+        socket.inet_aton(ip)  # Raises if not an IPv4 address
+
+    def test_startup_profile_report(self):
+        profile = StartupProfile(enabled=True)
+        profile.mark("build")
+        profile.mark("first frame")
+
+        report = profile.report()
+
+        self.assertIn("build", report)
+        self.assertIn("first frame", report)
+
+    def test_startup_profile_disabled(self):
+        profile = StartupProfile(enabled=False)
+        profile.mark("build")
+        self.assertEqual(profile.marks, [])
+
 if __name__ == '__main__':
     unittest.main()
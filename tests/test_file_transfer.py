@@ -0,0 +1,295 @@
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler, JSONStreamDecoder
+from protocols.file_transfer import FairLock, IncomingFile, encode_frame, MAX_CHUNK_SIZE
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+class TestFairLock(unittest.TestCase):
+    def test_waiters_are_served_in_order(self):
+        lock = FairLock()
+        order = []
+        lock.acquire()
+        threads = []
+        for i in range(3):
+            thread = threading.Thread(target=lambda i=i: (lock.acquire(), order.append(i), lock.release()))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.05)  # Make sure the tickets are taken in order
+        lock.release()
+        for thread in threads:
+            thread.join(timeout=1.0)
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_timed_out_waiter_gives_up_its_turn(self):
+        lock = FairLock()
+        lock.acquire()
+        self.assertFalse(lock.acquire(timeout=0.01))
+        lock.release()
+        self.assertTrue(lock.acquire(timeout=0.1))
+
+class TestDecoderPayloads(unittest.TestCase):
+    def test_payload_split_across_reads(self):
+        payload = bytes(range(256)) * 4
+        data = encode_frame({"type": "file_chunk", "payload_length": len(payload)}) + payload
+        data += encode_frame({"type": "message", "content": "after"})
+        decoder = JSONStreamDecoder()
+        messages = []
+        for i in range(0, len(data), 7):
+            received, invalid = decoder.feed(data[i:i + 7])
+            self.assertEqual(invalid, 0)
+            messages.extend(received)
+
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]["payload"], payload)
+        self.assertEqual(messages[1]["content"], "after")
+
+    def test_oversized_payload_is_invalid(self):
+        decoder = JSONStreamDecoder()
+        data = encode_frame({"type": "file_chunk", "payload_length": MAX_CHUNK_SIZE + 1})
+        data += encode_frame({"type": "message", "content": "after"})
+        messages, invalid = decoder.feed(data)
+        self.assertEqual(invalid, 1)
+        self.assertEqual([message["content"] for message in messages], ["after"])
+
+class TestIncomingFile(unittest.TestCase):
+    def setUp(self):
+        self.download_dir = tempfile.mkdtemp()
+        self.data = os.urandom(10000)
+        self.offer = {
+            "transfer_id": "ab" * 16 + f"{10000:016x}",
+            "name": "../../etc/report.bin",
+            "size": len(self.data),
+            "sha256": hashlib.sha256(self.data).hexdigest(),
+            "chunk_size": 4096,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.download_dir)
+
+    def chunk(self, offset, crc32=None):
+        payload = self.data[offset:offset + 4096]
+        return {"offset": offset, "payload": payload,
+                "crc32": zlib.crc32(payload) if crc32 is None else crc32}
+
+    def test_bad_crc_and_wrong_offset_are_not_written(self):
+        incoming = IncomingFile(self.offer, self.download_dir)
+        self.assertFalse(incoming.write_chunk(self.chunk(0, crc32=1)))
+        self.assertIsNone(incoming.write_chunk(self.chunk(4096)))
+        self.assertEqual(incoming.offset, 0)
+        incoming.close()
+
+    def test_unsafe_transfer_id_is_refused(self):
+        for transfer_id in ("/../../x", "../" + "a" * 45, "A" * 48, 12):
+            with self.assertRaises(ValueError):
+                IncomingFile(dict(self.offer, transfer_id=transfer_id), self.download_dir)
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_resumes_from_whole_chunks_and_sanitizes_name(self):
+        incoming = IncomingFile(self.offer, self.download_dir)
+        self.assertTrue(incoming.write_chunk(self.chunk(0)))
+        incoming.close()
+        with open(incoming.part_path, "ab") as f:
+            f.write(self.data[4096:5000])  # Part of a chunk from a dropped connection
+
+        incoming = IncomingFile(self.offer, self.download_dir)
+        self.assertEqual(incoming.offset, 4096)
+        for offset in (4096, 8192):
+            self.assertTrue(incoming.write_chunk(self.chunk(offset)))
+        self.assertTrue(incoming.complete)
+        self.assertIsNone(incoming.finish())
+        self.assertEqual(incoming.path, os.path.join(self.download_dir, "report.bin"))
+        with open(incoming.path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+class TestEthernetFileTransfer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = EthernetMasterHandler("127.0.0.1", 0, download_dir=os.path.join(self.tmp, "server"))
+        self.server.initialize()
+        self.client = EthernetClientHandler("127.0.0.1", self.server.port,
+                                            download_dir=os.path.join(self.tmp, "client"))
+        self.client.initialize()
+        self.assertTrue(wait_for(lambda: self.server.connected_clients))
+        self.path = os.path.join(self.tmp, "photo.jpg")
+        self.data = os.urandom(3 * 1024 * 1024 + 123)
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.client.cleanup()
+        self.server.cleanup()
+        shutil.rmtree(self.tmp)
+
+    def received_messages(self, handler, count, timeout=20.0):
+        messages = []
+        deadline = time.time() + timeout
+        while len(messages) < count and time.time() < deadline:
+            message = handler.receive_message()
+            if message is None:
+                time.sleep(0.01)
+            else:
+                messages.append(message)
+        return messages
+
+    def test_client_to_server_with_chat_in_between(self):
+        self.assertEqual(self.client.send_file(self.path), f"Sending file {self.path}")
+        self.client.send("still chatting")
+
+        messages = self.received_messages(self.server, 2)
+
+        self.assertEqual(messages[0]["content"], "still chatting")
+        self.assertEqual(messages[1]["type"], "file")
+        with open(messages[1]["path"], "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_server_to_client(self):
+        self.server.send_file(self.path)
+
+        messages = self.received_messages(self.client, 1)
+
+        self.assertEqual(messages[0]["type"], "file")
+        self.assertEqual(os.path.basename(messages[0]["path"]), "photo.jpg")
+        with open(messages[0]["path"], "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_both_directions_at_once(self):
+        self.server.send_file(self.path)
+        self.client.send_file(self.path)
+
+        for handler in (self.server, self.client):
+            messages = self.received_messages(handler, 1)
+            self.assertEqual(messages[0]["type"], "file")
+            with open(messages[0]["path"], "rb") as f:
+                self.assertEqual(f.read(), self.data)
+
+    def test_corrupted_chunk_is_resent(self):
+        manager = self.client.file_transfers
+        corrupted = []
+
+        class CorruptingSocket:
+            """Flips a byte of the second chunk once"""
+            def __init__(self, sock):
+                self.sock = sock
+
+            def sendall(self, data):
+                return self.sock.sendall(data)
+
+            def sendfile(self, f, offset, count):
+                if offset == manager.chunk_size and not corrupted:
+                    corrupted.append(offset)
+                    f.seek(offset)
+                    payload = bytearray(f.read(count))
+                    payload[0] ^= 0xFF
+                    return self.sock.sendall(bytes(payload))
+                return self.sock.sendfile(f, offset, count)
+
+        sender = manager.send_file(self.path, None, CorruptingSocket(self.client.client_socket), self.client._lock)
+        self.assertTrue(sender.done.wait(20.0))
+
+        self.assertTrue(sender.result, sender.error)
+        self.assertEqual(corrupted, [manager.chunk_size])
+        message = self.received_messages(self.server, 1)[0]
+        with open(message["path"], "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_resume_after_interrupted_transfer(self):
+        receiver = self.server.file_transfers
+        sender = self.client.file_transfers
+        # Pretend an earlier attempt got the first 40 chunks across
+        transfer = sender.send_file(self.path, None, self.client.client_socket, self.client._lock)
+        self.assertTrue(transfer.done.wait(20.0))
+        received = self.received_messages(self.server, 1)[0]
+        os.rename(received["path"], os.path.join(receiver.download_dir, f".{transfer.transfer_id}.part"))
+        with open(os.path.join(receiver.download_dir, f".{transfer.transfer_id}.part"), "r+b") as f:
+            f.truncate(40 * sender.chunk_size + 100)
+
+        transfer = sender.send_file(self.path, None, self.client.client_socket, self.client._lock)
+        self.assertTrue(transfer.done.wait(20.0))
+
+        self.assertTrue(transfer.result, transfer.error)
+        self.assertEqual(transfer.resumed_from, 40 * sender.chunk_size)
+        self.assertEqual(transfer.bytes_sent, len(self.data) - 40 * sender.chunk_size)
+        received = self.received_messages(self.server, 1)[0]
+        with open(received["path"], "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+class TestStalledClient(unittest.TestCase):
+    """One client takes a file offer and stops reading"""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = EthernetMasterHandler("127.0.0.1", 0, download_dir=os.path.join(self.tmp, "server"))
+        self.server.send_timeout = 1.0
+        self.server.initialize()
+        self.stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.stalled.connect(("127.0.0.1", self.server.port))
+        self.assertTrue(wait_for(lambda: len(self.server.connected_clients) == 1))
+        self.healthy = EthernetClientHandler("127.0.0.1", self.server.port,
+                                             download_dir=os.path.join(self.tmp, "client"))
+        self.healthy.initialize()
+        self.assertTrue(wait_for(lambda: len(self.server.connected_clients) == 2))
+        self.path = os.path.join(self.tmp, "big.bin")
+        with open(self.path, "wb") as f:
+            f.write(os.urandom(32 * 1024 * 1024))
+
+    def tearDown(self):
+        self.stalled.close()
+        self.healthy.cleanup()
+        self.server.cleanup()
+        shutil.rmtree(self.tmp)
+
+    def accept_offer_and_stop_reading(self):
+        decoder = JSONStreamDecoder()
+        while True:
+            messages, _ = decoder.feed(self.stalled.recv(4096))
+            offers = [m for m in messages if m.get("type") == "file_offer"]
+            if offers:
+                self.stalled.sendall(encode_frame({"type": "file_resume",
+                                                   "transfer_id": offers[0]["transfer_id"], "offset": 0}))
+                return
+
+    def test_chat_and_cleanup_are_not_held_up(self):
+        self.server.send_file(self.path)
+        self.accept_offer_and_stop_reading()
+        time.sleep(0.2)  # Let the sender fill the stalled client's buffers
+
+        started = time.monotonic()
+        threading.Thread(target=self.server.send, args=("hello",), daemon=True).start()
+        contents = []
+        while "hello" not in contents and time.monotonic() - started < 0.5:
+            message = self.healthy.receive_message()  # The file may arrive first
+            if message is None:
+                time.sleep(0.01)
+            else:
+                contents.append(message["content"])
+        self.assertIn("hello", contents)
+
+        late = EthernetClientHandler("127.0.0.1", self.server.port)
+        late.initialize()
+        try:
+            self.assertTrue(wait_for(lambda: len(self.server.connected_clients) == 3, timeout=0.5))
+        finally:
+            late.cleanup()
+
+        # The stalled client is dropped once its writes time out
+        self.assertTrue(wait_for(lambda: len(self.server.connected_clients) == 1, timeout=5.0))
+        started = time.monotonic()
+        self.server.cleanup()
+        self.assertLess(time.monotonic() - started, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
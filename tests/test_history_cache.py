@@ -0,0 +1,93 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from database.history_cache import HistoryCache
+from database.storage import SQLiteStore
+
+def message(text, protocol="TCP/IP(Server)", **fields):
+    return dict({"protocol": protocol, "sender": "Client", "recipient": "You", "message": text}, **fields)
+
+class TestHistoryCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = SQLiteStore(os.path.join(self.directory, "chat.db"))
+        self.cache = HistoryCache(self.store, size=3, max_protocols=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def texts(self, protocol=None, limit=3):
+        return [m["message"] for m in self.cache.list(protocol, limit)]
+
+    def insert_synced(self, text, persist_ns):
+        """Store a row the way history sync does, with the peer's persist time"""
+        connection = sqlite3.connect(self.store.database)
+        connection.execute("INSERT INTO messages (protocol, sender, recipient, message, persist_ns) "
+                           "VALUES (?, ?, ?, ?, ?)", ["TCP/IP(Server)", "Pi", "You", text, persist_ns])
+        connection.commit()
+        connection.close()
+
+    def test_matches_store_and_follows_inserts(self):
+        self.store.insert_many([message(str(i)) for i in range(5)])
+        self.assertEqual(self.texts("TCP/IP(Server)"), ["2", "3", "4"])
+
+        self.store.insert(message("5"))
+        self.insert_synced("late", 0)  # Too old for the recent window
+        self.assertEqual(self.texts("TCP/IP(Server)"), ["3", "4", "5"])
+        self.assertEqual(self.texts("TCP/IP(Server)"), [m["message"] for m in self.store.list("TCP/IP(Server)", 3)])
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 2))
+
+    def test_history_ignores_the_sender_clock(self):
+        self.store.insert(message("first", sent_ns=20))
+        self.store.insert(message("second", sent_ns=10))
+        self.assertEqual(self.texts(), ["first", "second"])
+
+    def test_not_yet_full_history_takes_older_messages(self):
+        self.store.insert(message("b"))
+        self.assertEqual(self.texts(), ["b"])
+        self.insert_synced("a", 1)  # e.g. synced from another Pi
+        self.assertEqual(self.texts(), ["a", "b"])
+
+    def test_sees_writes_that_bypass_it(self):
+        self.assertEqual(self.texts("UART/Serial"), [])
+        connection = sqlite3.connect(self.store.database)
+        connection.execute("INSERT INTO messages (protocol, sender, recipient, message) VALUES (?, ?, ?, ?)",
+                           ["UART/Serial", "Pi", "You", "synced"])
+        connection.commit()
+        connection.close()
+        self.assertEqual(self.texts("UART/Serial"), ["synced"])
+
+    def test_least_recently_used_protocol_is_evicted(self):
+        for protocol in ("A", "B", "A", "C"):
+            self.cache.list(protocol, 3)
+        self.cache.list("A", 3)
+        self.cache.list("B", 3)
+        self.assertEqual(self.cache.misses, 4)  # A, B, C, then B again
+
+    def test_large_limit_goes_to_store(self):
+        self.store.insert_many([message(str(i)) for i in range(5)])
+        self.assertEqual(len(self.cache.list(None, 10)), 5)
+        self.assertEqual(len(self.cache.list()), 5)
+        self.assertEqual(self.cache.misses + self.cache.hits, 0)
+
+    def test_version_changes_on_insert_and_render_times(self):
+        version = self.cache.version()
+        self.store.insert(message("hello", uid="abc"))
+        self.assertNotEqual(self.cache.version(), version)
+
+        self.assertEqual(self.texts(), ["hello"])
+        version = self.cache.version()
+        self.cache.record_render_times([{"uid": "abc", "render_ns": 42}])
+        self.assertNotEqual(self.cache.version(), version)
+        self.assertEqual(self.cache.list(None, 3)[0]["render_ns"], 42)
+
+    def test_version_is_the_same_after_restart(self):
+        self.store.insert(message("hello", uid="abc"))
+        self.cache.record_render_times([{"uid": "abc", "render_ns": 42}])
+        restarted = HistoryCache(SQLiteStore(self.store.database))
+        self.assertEqual(restarted.version(), self.cache.version())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import time
+import unittest
+from queue import Empty
+from benchmarks.impairment_proxy import Impairment, ImpairmentProxy
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+
+MESSAGES = ["hello", "héllo wörld ✓", '{"content": "not a frame"}', "}{", "x" * 5000, ""]
+
+class TestImpairedEthernet(unittest.TestCase):
+    """Real Ethernet handlers talking through an ImpairmentProxy"""
+    def start(self, upstream=None, downstream=None):
+        self.master = EthernetMasterHandler("127.0.0.1", 0)
+        self.master.set_status_callback(lambda message: None)
+        self.assertIn("Server listening", self.master.initialize())
+        self.proxy = ImpairmentProxy("127.0.0.1", self.master.port, upstream, downstream, seed=1).start()
+        self.client = EthernetClientHandler("127.0.0.1", self.proxy.port)
+        self.connect()
+
+    def connect(self):
+        self.assertIn("Client connected", self.client.initialize())
+        self.wait_for(lambda: self.master.connected_clients)
+
+    def tearDown(self):
+        self.client.cleanup()
+        self.proxy.stop()
+        self.master.cleanup()
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+
+    def receive(self, handler, count, timeout=5.0):
+        contents = []
+        deadline = time.monotonic() + timeout
+        while len(contents) < count and time.monotonic() < deadline:
+            try:
+                contents.append(handler.message_queue.get(timeout=0.05)["content"])
+            except Empty:
+                pass
+        return contents
+
+    def test_split_messages_are_reassembled(self):
+        self.start(Impairment(split=5))
+        for text in MESSAGES:
+            self.assertIsNone(self.client.send(text))
+            self.master.send(text)
+        self.assertEqual(self.receive(self.master, len(MESSAGES)), MESSAGES)
+        self.assertEqual(self.receive(self.client, len(MESSAGES)), MESSAGES)
+
+    def test_coalesced_writes_are_separated(self):
+        self.start(Impairment(coalesce=0.05))
+        texts = [f"reading {i}" for i in range(50)]
+        for text in texts:
+            self.client.send(text)
+        self.assertEqual(self.receive(self.master, 50), texts)
+
+    def test_latency_and_jitter_keep_order(self):
+        self.start(Impairment(latency=0.05, jitter=0.02))
+        start = time.monotonic()
+        texts = [str(i) for i in range(20)]
+        for text in texts:
+            self.client.send(text)
+        self.assertEqual(self.receive(self.master, 20), texts)
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+
+    def test_bandwidth_limit(self):
+        self.start(Impairment(bandwidth=200_000))
+        start = time.monotonic()
+        for _ in range(20):
+            self.client.send("x" * 5000)
+        self.assertEqual(len(self.receive(self.master, 20)), 20)
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+    def test_reset_and_reconnect(self):
+        self.start()
+        self.client.send("before")
+        self.assertEqual(self.receive(self.master, 1), ["before"])
+
+        self.proxy.reset_connections()
+        self.wait_for(lambda: not self.client.connected)
+        self.wait_for(lambda: not self.master.connected_clients)
+        self.assertIsNotNone(self.client.send("lost"))
+
+        self.client.cleanup()
+        self.connect()
+        self.assertIsNone(self.client.send("after"))
+        self.assertEqual(self.receive(self.master, 1), ["after"])
+
+    def test_reset_mid_message_leaves_no_partial_message(self):
+        self.start(Impairment(reset_after=2000))
+        self.client.send("y" * 5000)
+        self.wait_for(lambda: not self.master.connected_clients)
+
+        self.proxy.upstream = Impairment()  # For the next connection
+        self.client.cleanup()
+        self.connect()
+        self.client.send("after")
+        self.assertEqual(self.receive(self.master, 2, timeout=1.0), ["after"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import time
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+from protocols.message_bus import MessageBus
+from database.setup_db import setup_database
+from database.messages import insert_message, record_render_times
+from database.latency_report import STAGES, format_report, stage_latencies
+
+class TestLatencyTrace(unittest.TestCase):
+    def setUp(self):
+        self.server = EthernetMasterHandler("127.0.0.1", 0)
+        self.server.initialize()
+        self.addCleanup(self.server.cleanup)
+        self.client = EthernetClientHandler("127.0.0.1", self.server.port)
+        self.assertIn("Client connected", self.client.initialize())
+        self.addCleanup(self.client.cleanup)
+
+    def wait_for_message(self, handler):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            message = handler.receive_message()
+            if message:
+                return message
+            time.sleep(0.001)
+        self.fail("No message received")
+
+    def test_wire_message_carries_trace(self):
+        before = time.time_ns()
+        self.client.send("ping")
+
+        message = self.wait_for_message(self.server)
+
+        self.assertEqual(message["content"], "ping")
+        self.assertLessEqual(before, message["sent_ns"])
+        self.assertLessEqual(message["sent_ns"], message["recv_ns"])
+        self.assertLessEqual(message["recv_ns"], message["enqueue_ns"])
+
+    def test_report_covers_every_stage(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, "trace.db")
+        setup_database(database)
+        bus = MessageBus()
+        bus.attach("TCP/IP(Server)", self.server)
+        persisted = bus.subscribe("persistence")
+
+        for i in range(5):
+            self.client.send(f"message {i}")
+        deadline = time.monotonic() + 5
+        while len(persisted) < 5 and time.monotonic() < deadline:
+            bus.poll_once()
+            time.sleep(0.001)
+
+        connection = sqlite3.connect(database)
+        for message in persisted.drain():
+            insert_message(connection, {
+                "protocol": message["protocol"], "sender": "Client", "recipient": "You",
+                "message": message["content"], "uid": message["uid"],
+                **{field: message[field] for field in ("sent_ns", "recv_ns", "enqueue_ns", "dequeue_ns")}
+            })
+            record_render_times(connection, [{"uid": message["uid"], "render_ns": time.time_ns()}])
+        connection.commit()
+
+        latencies = stage_latencies(connection)
+        self.assertIsNone(connection.row_factory)  # Left as the caller set it
+        connection.close()
+
+        for stage, _, _ in STAGES:
+            self.assertEqual(len(latencies[stage]), 5, stage)
+            self.assertTrue(all(value >= 0 for value in latencies[stage]), stage)
+        report = format_report(latencies)
+        self.assertIn("sent -> shown", report)
+
+if __name__ == '__main__':
+    unittest.main()
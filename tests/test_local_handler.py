@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import time
+import unittest
+from protocols.local_handler import LocalMasterHandler, LocalClientHandler, SharedRing, SharedPayloadDecoder
+
+class TestSharedRing(unittest.TestCase):
+    def setUp(self):
+        self.producer = SharedRing.create(16)
+        self.consumer = SharedRing.attach(self.producer.name)
+
+    def tearDown(self):
+        self.consumer.close()
+        self.producer.close()
+
+    def test_wraps_around(self):
+        for i in range(10):
+            position = self.producer.write(bytes([i]) * 7)
+            self.assertEqual(self.consumer.read(position, 7), bytes([i]) * 7)
+
+    def test_full_until_read(self):
+        position = self.producer.write(b"a" * 12)
+        self.assertIsNone(self.producer.write(b"b" * 8, timeout=0.01))
+        self.consumer.read(position, 12)
+        self.assertIsNotNone(self.producer.write(b"b" * 8, timeout=0.01))
+        self.assertIsNone(self.producer.write(b"c" * 17))
+
+    def test_read_out_of_order_or_too_large(self):
+        position = self.producer.write(b"a" * 4)
+        with self.assertRaises(ValueError):
+            self.consumer.read(position + 1, 3)
+        with self.assertRaises(ValueError):
+            self.consumer.read(position, 17)
+        self.assertEqual(self.consumer.read(position, 4), b"a" * 4)
+
+class TestSharedPayloadDecoder(unittest.TestCase):
+    def setUp(self):
+        self.ring = SharedRing.create(64)
+        self.decoder = SharedPayloadDecoder()
+
+    def tearDown(self):
+        del self.decoder
+        self.ring.close()
+
+    def feed(self, *frames):
+        return self.decoder.feed(b"".join(json.dumps(frame).encode() for frame in frames))
+
+    def test_only_the_announced_ring_is_read(self):
+        position = self.ring.write(b"bulk")
+        self.assertEqual(self.feed({"type": "message", "shm": [position, 4]}), ([], 1))
+        other = SharedRing.create(64)
+        try:
+            messages, invalid = self.feed({"type": "shm_ring", "name": self.ring.name},
+                                          {"type": "shm_ring", "name": other.name},
+                                          {"type": "message", "shm": [position, 4]})
+        finally:
+            other.close()
+        self.assertEqual(invalid, 1)
+        self.assertEqual([message["content"] for message in messages], ["bulk"])
+
+    def test_position_and_size_are_checked(self):
+        self.feed({"type": "shm_ring", "name": self.ring.name})
+        position = self.ring.write(b"bulk")
+        self.assertEqual(self.feed({"type": "message", "shm": [position, 1 << 20]}), ([], 1))
+        self.assertEqual(self.feed({"type": "message", "shm": [position + 8, 4]}), ([], 1))
+
+class TestLocalHandlers(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "chat.sock")
+        self.master = LocalMasterHandler(self.path, bulk_threshold=100, ring_size=4096)
+        self.master.set_status_callback(lambda message: None)
+        self.assertIn("Server listening", self.master.initialize())
+        self.client = LocalClientHandler(self.path, bulk_threshold=100, ring_size=4096)
+        self.assertIn("Client connected", self.client.initialize())
+        deadline = time.monotonic() + 2.0
+        while not self.master.connected_clients and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.client.cleanup()
+        self.master.cleanup()
+        shutil.rmtree(self.directory)
+
+    def receive(self, handler):
+        message = handler.message_queue.get(timeout=2.0)
+        return message["content"] if message else None
+
+    def test_small_and_bulk_messages_both_ways(self):
+        for text in ("hello", "x" * 1000, "y" * 10000):  # Inline, ring, too big for the ring
+            self.assertIsNone(self.master.send(text))
+            self.assertEqual(self.receive(self.client), text)
+            self.assertIsNone(self.client.send(text))
+            self.assertEqual(self.receive(self.master), text)
+
+    def test_without_shared_memory(self):
+        self.client.shared_memory = False
+        self.client.send("z" * 1000)
+        self.assertEqual(self.receive(self.master), "z" * 1000)
+        self.assertIsNone(self.client._ring)
+
+    def test_cleanup_removes_socket(self):
+        self.client.cleanup()
+        self.master.cleanup()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_socket_is_private(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def test_running_server_keeps_its_socket(self):
+        second = LocalMasterHandler(self.path)
+        self.assertIn("Failed to start server", second.initialize())
+        second.cleanup()
+        self.assertTrue(os.path.exists(self.path))
+        self.client.send("still here")
+        self.assertEqual(self.receive(self.master), "still here")
+
+    def test_stale_socket_is_replaced(self):
+        path = os.path.join(self.directory, "stale.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()  # Never listened, like a crashed run
+        master = LocalMasterHandler(path)
+        try:
+            self.assertIn("Server listening", master.initialize())
+        finally:
+            master.cleanup()
+
+    def test_no_server(self):
+        client = LocalClientHandler(os.path.join(self.directory, "missing.sock"))
+        self.assertIn("No server found", client.initialize())
+
+if __name__ == '__main__':
+    unittest.main()
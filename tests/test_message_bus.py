@@ -0,0 +1,123 @@
+import unittest
+import time
+from unittest.mock import Mock
+from protocols.message_bus import MessageBus, Subscription, NO_MESSAGES
+from protocols.bounded_queue import BLOCK, SPILL
+import threading
+from protocols.protocol_handler import ProtocolHandler
+
+class FakeHandler(ProtocolHandler):
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.sent = []
+
+    def send(self, message: str):
+        self.sent.append(message)
+
+    def receive(self) -> str:
+        return self.messages.pop(0) if self.messages else NO_MESSAGES
+
+class TestSubscription(unittest.TestCase):
+    def test_drops_oldest_when_full(self):
+        subscription = Subscription("view", maxsize=2)
+        for i in range(3):
+            subscription.put({"content": str(i)})
+
+        self.assertEqual(subscription.dropped, 1)
+        self.assertEqual([m["content"] for m in subscription.drain()], ["1", "2"])
+        self.assertEqual(len(subscription), 0)
+
+    def test_get_timeout(self):
+        subscription = Subscription("view")
+        self.assertIsNone(subscription.get(timeout=0.01))
+
+    def test_spill_keeps_every_message(self):
+        subscription = Subscription("persistence", maxsize=2, policy=SPILL)
+        for i in range(5):
+            subscription.put({"content": str(i)})
+
+        self.assertEqual(subscription.dropped, 0)
+        self.assertEqual(len(subscription), 5)
+        self.assertEqual([m["content"] for m in subscription.drain()], ["0", "1", "2", "3", "4"])
+        subscription.close()
+
+class TestMessageBus(unittest.TestCase):
+    def setUp(self):
+        self.bus = MessageBus(poll_interval=0.01)
+
+    def tearDown(self):
+        self.bus.stop()
+
+    def test_publish_fans_out_to_all_subscribers(self):
+        view = self.bus.subscribe("view")
+        writer = self.bus.subscribe("persistence")
+
+        self.bus.publish("TCP/IP(Server)", {"content": "hello"})
+
+        message = view.get_nowait()
+        self.assertEqual(message["protocol"], "TCP/IP(Server)")
+        self.assertEqual(message["content"], "hello")
+        self.assertTrue(message["uid"])
+        self.assertEqual(writer.get_nowait(), message)
+
+    def test_protocol_filter(self):
+        server_only = self.bus.subscribe("relay", protocols=["TCP/IP(Server)"])
+
+        self.bus.publish("TCP/IP(Client)", {"content": "ignored"})
+        self.bus.publish("TCP/IP(Server)", {"content": "kept"})
+
+        self.assertEqual([m["content"] for m in server_only.drain()], ["kept"])
+
+    def test_unsubscribe_releases_a_blocked_publisher(self):
+        writer = self.bus.subscribe("persistence", maxsize=1, policy=BLOCK)
+        self.bus.publish("TCP/IP(Server)", {"content": "queued"})
+        publisher = threading.Thread(target=self.bus.publish, args=("TCP/IP(Server)", {"content": "waits"}))
+        publisher.start()
+        time.sleep(0.05)
+        self.assertTrue(publisher.is_alive())
+
+        self.bus.unsubscribe(writer)
+        publisher.join(timeout=1.0)
+        self.assertFalse(publisher.is_alive())
+
+    def test_unsubscribe(self):
+        view = self.bus.subscribe("view")
+        self.bus.unsubscribe(view)
+        self.bus.publish("TCP/IP(Server)", {"content": "hello"})
+        self.assertIsNone(view.get_nowait())
+
+    def test_poll_once_drains_every_attached_handler(self):
+        server = FakeHandler(["a", "b"])
+        client = FakeHandler(["c"])
+        self.bus.attach("TCP/IP(Server)", server)
+        self.bus.attach("TCP/IP(Client)", client)
+        view = self.bus.subscribe("view")
+
+        received = self.bus.poll_once()
+
+        self.assertEqual(received, 3)
+        self.assertEqual(
+            [(m["protocol"], m["content"]) for m in view.drain()],
+            [("TCP/IP(Server)", "a"), ("TCP/IP(Server)", "b"), ("TCP/IP(Client)", "c")]
+        )
+
+    def test_background_pump(self):
+        handler = FakeHandler(["hello"])
+        self.bus.attach("TCP/IP(Server)", handler)
+        view = self.bus.subscribe("view")
+
+        self.bus.start()
+        message = view.get(timeout=1.0)
+
+        self.assertEqual(message["content"], "hello")
+        self.assertIn("dequeue_ns", message)
+
+    def test_detach(self):
+        handler = Mock()
+        self.bus.attach("TCP/IP(Server)", handler)
+        self.bus.detach("TCP/IP(Server)")
+        self.assertEqual(self.bus.poll_once(), 0)
+        handler.receive_message.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
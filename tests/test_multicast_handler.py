@@ -0,0 +1,103 @@
+import time
+import unittest
+import socket
+from protocols.multicast_handler import MulticastHandler, HEADER, LENGTH, MAGIC, DATA
+
+class LossyMulticastHandler(MulticastHandler):
+    """Drops the first multicast datagram carrying one of the given sequence numbers"""
+    def __init__(self, drop=(), **options):
+        super().__init__(**options)
+        self.drop = set(drop)
+        self.sizes = []
+
+    def _transmit(self, datagram, address):
+        _, kind, _, seq, count = HEADER.unpack_from(datagram)
+        self.sizes.append(len(datagram))
+        dropped = {s for s in self.drop if seq <= s < seq + count}
+        if kind == DATA and address[0] == self.group and dropped:
+            self.drop -= dropped
+            return
+        super()._transmit(datagram, address)
+
+class TestMulticastHandler(unittest.TestCase):
+    def start(self, sender_options=None, **options):
+        options = dict(group="239.255.42.99", interface="127.0.0.1", nack_interval=0.02, **options)
+        self.receiver = MulticastHandler(port=0, **options)
+        self.assertIn("Joined", self.receiver.initialize())
+        self.sender = LossyMulticastHandler(port=self.receiver.port, **dict(options, **(sender_options or {})))
+        self.assertIn("Joined", self.sender.initialize())
+
+    def tearDown(self):
+        for handler in (getattr(self, "sender", None), getattr(self, "receiver", None)):
+            if handler:
+                handler.cleanup()
+
+    def receive(self, count, timeout=3.0):
+        messages = []
+        deadline = time.monotonic() + timeout
+        while len(messages) < count and time.monotonic() < deadline:
+            message = self.receiver.receive_message()
+            if message is None:
+                time.sleep(0.005)
+            else:
+                messages.append(message["content"])
+        return messages
+
+    def test_batches_small_messages(self):
+        self.start(flush_interval=0.05)
+        for i in range(50):
+            self.assertIsNone(self.sender.send(f"reading {i}"))
+        self.assertEqual(self.receive(50), [f"reading {i}" for i in range(50)])
+        self.assertLess(self.sender.stats()["datagrams_sent"], 10)
+
+    def test_batches_fit_mtu(self):
+        self.start(mtu=200, flush_interval=0.05)
+        for i in range(20):
+            self.sender.send(f"reading {i}")
+        self.assertEqual(len(self.receive(20)), 20)
+        self.assertGreater(self.sender.stats()["datagrams_sent"], 1)
+        self.assertLessEqual(max(self.sender.sizes), 200 - 28)
+
+    def test_gap_is_repaired(self):
+        self.start(flush_interval=0, sender_options={"drop": [1]})
+        for text in ("a", "b", "c"):
+            self.sender.send(text)
+        self.assertEqual(self.receive(3), ["a", "b", "c"])
+        self.assertEqual(self.sender.stats()["retransmitted"], 1)
+        self.assertGreaterEqual(self.receiver.stats()["nacks_sent"], 1)
+
+    def test_lost_tail_found_by_heartbeat(self):
+        self.start(flush_interval=0, heartbeat_interval=0.1, sender_options={"drop": [1]})
+        self.sender.send("a")
+        self.sender.send("b")
+        self.assertEqual(self.receive(2), ["a", "b"])
+
+    def test_gap_older_than_ring_is_skipped(self):
+        self.start(flush_interval=0, retransmit_size=1, sender_options={"drop": [1]})
+        for text in ("a", "b", "c"):
+            self.sender.send(text)
+        self.assertEqual(self.receive(2), ["a", "c"])
+        self.assertEqual(self.receiver.stats()["lost"], 1)
+
+    def test_malformed_datagrams_are_dropped(self):
+        self.start(flush_interval=0)
+        message = b'{"content": "x"}'
+        datagrams = [
+            HEADER.pack(MAGIC, DATA, 7, 0, 3) + LENGTH.pack(len(message)) + message,  # Count too large
+            HEADER.pack(MAGIC, DATA, 7, 0, 1) + LENGTH.pack(500) + message,  # Length too large
+            HEADER.pack(MAGIC, DATA, 7, 0, 1) + b"\x00",  # Length cut in half
+        ]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton("127.0.0.1"))
+            for datagram in datagrams:
+                sock.sendto(datagram, (self.receiver.group, self.receiver.port))
+        time.sleep(0.1)
+        self.assertEqual(self.receiver.stats()["malformed"], 3)
+        self.sender.send("still receiving")
+        self.assertEqual(self.receive(1), ["still receiving"])
+
+    def test_send_before_initialize(self):
+        self.assertEqual(MulticastHandler().send("hello"), "Multicast not started")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import io
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from profiling import Profiler, configure, parse_argv
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_disabled_costs_nothing(self):
+        profiler = Profiler()
+        self.assertIs(profiler.timed("busy")(busy), busy)
+        with profiler.stage("block"):
+            pass
+        self.assertEqual(profiler.stages, {})
+
+    def test_stages_and_summary(self):
+        profiler = Profiler("timers", directory=self.directory)
+        timed_busy = profiler.timed("slow")(busy)
+        self.assertEqual(timed_busy.__name__, "busy")
+        timed_busy(0.02)
+        for _ in range(3):
+            with profiler.stage("fast"):
+                pass
+        self.assertEqual(profiler.stages["fast"].count, 3)
+        self.assertGreaterEqual(profiler.stages["slow"].max_ns, 20_000_000)
+
+        summary = profiler.summary()
+        self.assertLess(summary.index("slow"), summary.index("fast"))
+        profiler.finish()
+        self.assertEqual(len([f for f in os.listdir(self.directory) if f.endswith("-summary.txt")]), 1)
+
+    def test_cprofile_capture(self):
+        profiler = Profiler("cprofile", directory=self.directory)
+        profiler.start_capture()
+        busy(0.01)
+        path = profiler.stop_capture()
+        functions = [function for _, _, function in pstats.Stats(path).stats]
+        self.assertIn("busy", functions)
+
+    def test_stack_samples(self):
+        profiler = Profiler("sample", directory=self.directory)
+        profiler.start_capture()
+        busy(0.2)
+        path = profiler.stop_capture()
+        with open(path) as f:
+            stacks = f.read()
+        self.assertIn("test_profiling.py:busy", stacks)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            Profiler("tracing")
+
+class TestConfigure(unittest.TestCase):
+    def test_flags_are_removed_from_argv(self):
+        argv = ["chatapp.py", "--profile=sample", "--size=800x600", "--profile-seconds=5"]
+        self.assertEqual(parse_argv(argv), ("sample", 5.0))
+        self.assertEqual(argv, ["chatapp.py", "--size=800x600"])
+        self.assertEqual(parse_argv(["chatapp.py", "--profile"]), ("timers", None))
+
+    def test_environment(self):
+        try:
+            self.assertEqual(configure([], {"CHATAPP_PROFILE": "1"}).mode, "timers")
+            self.assertEqual(configure(["chatapp.py", "--profile=cprofile"], {}).mode, "cprofile")
+            self.assertFalse(configure([], {"CHATAPP_PROFILE": "0"}).enabled)
+        finally:
+            configure([], {})
+
+    def test_invalid_settings_turn_profiling_off(self):
+        with redirect_stdout(io.StringIO()) as output:
+            profiler = configure([], {"CHATAPP_PROFILE": "yes", "CHATAPP_PROFILE_SECONDS": "soon"})
+        self.assertFalse(profiler.enabled)
+        self.assertEqual(profiler.seconds, 30.0)
+        self.assertIn("Unknown profiling mode 'yes'", output.getvalue())
+        self.assertEqual(parse_argv(["chatapp.py", "--profile-seconds=abc"]), (None, None))
+
+if __name__ == '__main__':
+    unittest.main()
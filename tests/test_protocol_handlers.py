@@ -1,6 +1,6 @@
 import unittest
 from unittest.mock import Mock, patch
-from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler
+from protocols.ethernet_handler import EthernetMasterHandler, EthernetClientHandler, JSONStreamDecoder
 from protocols.uart_handler import UARTHandler
 import socket
 import json
@@ -11,6 +11,10 @@ class TestEthernetMasterHandler(unittest.TestCase):
         self.status_messages = []
         self.handler.set_status_callback(lambda msg: self.status_messages.append(msg))
 
+    def tearDown(self):
+        # Stop background threads started against mocked sockets
+        self.handler.cleanup()
+
     @patch('socket.socket')
     def test_initialize(self, mock_socket):
         mock_socket_instance = Mock()
@@ -34,13 +38,15 @@ class TestEthernetMasterHandler(unittest.TestCase):
         client_address = ("127.0.0.1", 5000)
         self.handler.connected_clients[client_address] = mock_client
         
-        self.handler.send("test message")
+        with patch('time.time_ns', return_value=1234567890123456789):
+            self.handler.send("test message")
         
         expected_data = json.dumps({
             "content": "test message",
-            "type": "message"
+            "type": "message",
+            "sent_ns": 1234567890123456789
         }).encode()
-        mock_client.send.assert_called_with(expected_data)
+        mock_client.sendall.assert_called_with(expected_data)
 
     def test_cleanup(self):
         mock_client = Mock()
@@ -59,6 +65,10 @@ class TestEthernetClientHandler(unittest.TestCase):
     def setUp(self):
         self.handler = EthernetClientHandler("localhost", 5000)
 
+    def tearDown(self):
+        # Stop background threads started against mocked sockets
+        self.handler.cleanup()
+
     @patch('socket.socket')
     def test_initialize_success(self, mock_socket):
         # Setup mock socket
@@ -112,6 +122,28 @@ class TestEthernetClientHandler(unittest.TestCase):
         mock_socket_instance.close.assert_called()
         self.assertEqual(result, "Client disconnected")
 
+class TestJSONStreamDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = JSONStreamDecoder()
+
+    def test_coalesced_messages(self):
+        data = b'{"content": "a", "type": "message"}{"content": "b", "type": "message"}'
+        messages, invalid = self.decoder.feed(data)
+        self.assertEqual([m["content"] for m in messages], ["a", "b"])
+        self.assertEqual(invalid, 0)
+
+    def test_split_message(self):
+        data = json.dumps({"content": "h\u00e9llo", "type": "message"}, ensure_ascii=False).encode()
+        cut = data.index("\u00e9".encode()) + 1  # Split inside the multi-byte character
+        self.assertEqual(self.decoder.feed(data[:cut]), ([], 0))
+        messages, invalid = self.decoder.feed(data[cut:])
+        self.assertEqual(messages[0]["content"], "h\u00e9llo")
+
+    def test_skips_invalid_data(self):
+        messages, invalid = self.decoder.feed(b'garbage{"content": "ok"}')
+        self.assertEqual([m["content"] for m in messages], ["ok"])
+        self.assertEqual(invalid, 1)
+
 class TestUARTHandler(unittest.TestCase):
     def setUp(self):
         self.handler = UARTHandler("/dev/ttyUSB0", 9600)
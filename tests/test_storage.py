@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+from database.message_log import LogStore
+from database.storage import SQLiteStore, open_store
+
+def message(text, protocol="TCP/IP(Server)", **fields):
+    return dict({"protocol": protocol, "sender": "Client", "recipient": "You", "message": text}, **fields)
+
+class StoreContract:
+    """Tests every MessageStore has to pass, mixed into a TestCase per backend"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = self.open()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_insert_assigns_increasing_ids(self):
+        first = self.store.insert(message("one"))
+        second = self.store.insert(message("two"))
+        self.assertEqual(second, first + 1)
+        self.assertEqual(self.store.max_id(), second)
+
+    def test_duplicate_uid_is_stored_once(self):
+        first = self.store.insert(message("hello", uid="abc"))
+        self.assertEqual(self.store.insert(message("hello", uid="abc")), first)
+        self.assertEqual(len(self.store.list()), 1)
+
+    def test_list_filters_by_protocol_in_stored_order(self):
+        # sent_ns is the sender's clock, history follows ours
+        self.store.insert_many([
+            message("first", sent_ns=200),
+            message("uart", protocol="UART/Serial"),
+            message("second", sent_ns=100),
+        ])
+        self.assertEqual([m["message"] for m in self.store.list("TCP/IP(Server)")], ["first", "second"])
+        row = self.store.list("UART/Serial")[0]
+        self.assertTrue(row["uid"])
+        self.assertIsNotNone(row["persist_ns"])
+
+    def test_fetch_after_and_read_range(self):
+        ids = self.store.insert_many([message(str(i), protocol="UART/Serial" if i % 2 else "TCP/IP(Server)")
+                                      for i in range(10)])
+        self.assertEqual([m["message"] for m in self.store.fetch_after(ids[3], limit=3)], ["4", "5", "6"])
+        self.assertEqual([m["message"] for m in self.store.fetch_after(ids[3], "UART/Serial")], ["5", "7", "9"])
+        self.assertEqual([m["id"] for m in self.store.read_range(ids[2], ids[4])], ids[2:5])
+        self.assertEqual(self.store.read_range(ids[-1] + 1, ids[-1] + 5), [])
+
+    def test_record_render_times(self):
+        self.store.insert(message("hello", uid="abc"))
+        self.assertEqual(self.store.record_render_times([
+            {"uid": "abc", "render_ns": 42},
+            {"uid": "unknown", "render_ns": 43},
+        ]), ["unknown"])
+        self.assertEqual(self.store.list()[0]["render_ns"], 42)
+
+    def test_version_survives_reopen(self):
+        self.store.insert(message("hello", uid="abc"))
+        self.store.record_render_times([{"uid": "abc", "render_ns": 42}])
+        version = self.store.version()
+        self.store.record_render_times([{"uid": "unknown", "render_ns": 43}])
+        self.assertEqual(self.store.version(), version)  # Nothing was stored
+        self.store.close()
+        self.store = self.open()
+        self.assertEqual(self.store.version(), version)
+
+class TestSQLiteStore(StoreContract, unittest.TestCase):
+    def open(self):
+        return SQLiteStore(os.path.join(self.directory, "chat.db"))
+
+class TestLogStore(StoreContract, unittest.TestCase):
+    def open(self, **options):
+        options.setdefault("segment_records", 4)  # Spread tests over several segments
+        return LogStore(self.directory, **options)
+
+    def test_reopen_keeps_messages_and_render_times(self):
+        ids = self.store.insert_many([message(str(i), uid=f"u{i}") for i in range(10)])
+        self.store.record_render_times([{"uid": "u9", "render_ns": 7}])
+        self.store.close()
+
+        self.store = self.open()
+        self.assertEqual(self.store.max_id(), ids[-1])
+        self.assertEqual(self.store.insert(message("9", uid="u9")), ids[-1])
+        self.assertEqual(self.store.insert(message("new")), ids[-1] + 1)
+        self.assertEqual(self.store.read_range(ids[-1], ids[-1])[0]["render_ns"], 7)
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".log")]), 3)
+
+    def test_torn_record_is_dropped_on_open(self):
+        self.store.insert_many([message(str(i)) for i in range(6)])
+        segment = self.store.segments[-1]
+        self.store.close()
+        with open(segment.log_path, "r+b") as f:
+            f.truncate(os.path.getsize(segment.log_path) - 5)
+
+        self.store = self.open()
+        self.assertEqual(self.store.max_id(), 5)
+        self.assertEqual(self.store.insert(message("after crash")), 6)
+        self.assertEqual(self.store.read_range(6, 6)[0]["message"], "after crash")
+
+    def test_unindexed_records_are_indexed_on_open(self):
+        self.store.insert_many([message(str(i)) for i in range(3)])
+        segment = self.store.segments[-1]
+        # Crash after writing a record but before its index entry
+        segment.index[2 * 8:3 * 8] = bytes(8)
+        self.store.close()
+
+        self.store = self.open()
+        self.assertEqual([m["message"] for m in self.store.fetch_after(0)], ["0", "1", "2"])
+
+    def test_large_scan_crosses_read_blocks(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+        self.store = self.open(segment_records=100000)
+        text = "x" * 5000
+        self.store.insert_many([message(text) for _ in range(500)])
+        rows = self.store.fetch_after(0, limit=1000)
+        self.assertEqual(len(rows), 500)
+        self.assertEqual([m["id"] for m in rows], list(range(1, 501)))
+
+class TestOpenStore(unittest.TestCase):
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            open_store("csv")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import threading
+from unittest.mock import patch
+import requests
+from werkzeug.serving import make_server
+from api import app
+from database.setup_db import setup_database
+from database.sync import SyncClient, apply_changes, export_changes, get_high_water_mark, get_node_id
+
+def insert_messages(database, count, start=0, protocol="TCP/IP(Server)"):
+    connection = sqlite3.connect(database)
+    connection.executemany(
+        'INSERT INTO messages (protocol, sender, recipient, message) VALUES (?, ?, ?, ?)',
+        [(protocol, "Client", "You", f"message {i}") for i in range(start, start + count)]
+    )
+    connection.commit()
+    connection.close()
+
+def connect(database):
+    connection = sqlite3.connect(database)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+class TestSyncDatabase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.peer = os.path.join(directory.name, "peer.db")
+        self.local = os.path.join(directory.name, "local.db")
+        setup_database(self.peer)
+        setup_database(self.local)
+
+    def test_rows_get_uid(self):
+        insert_messages(self.peer, 2)
+        uids = [row[0] for row in connect(self.peer).execute('SELECT uid FROM messages')]
+        self.assertEqual(len(set(uids)), 2)
+        self.assertTrue(all(uids))
+
+    def test_migrates_old_schema(self):
+        old = os.path.join(os.path.dirname(self.peer), "old.db")
+        connection = sqlite3.connect(old)
+        connection.execute("""
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            protocol TEXT NOT NULL, sender TEXT NOT NULL, recipient TEXT NOT NULL,
+            message TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )""")
+        connection.execute("INSERT INTO messages (protocol, sender, recipient, message) VALUES ('p', 's', 'r', 'm')")
+        connection.commit()
+        connection.close()
+
+        setup_database(old)
+        setup_database(old)  # Running again is harmless
+
+        self.assertIsNotNone(connect(old).execute('SELECT uid FROM messages').fetchone()[0])
+
+    def test_apply_is_idempotent(self):
+        insert_messages(self.peer, 5)
+        batch = export_changes(connect(self.peer), since=0)
+        local = connect(self.local)
+
+        self.assertEqual(apply_changes(local, batch), 5)
+        self.assertEqual(apply_changes(local, batch), 0)
+        self.assertEqual(local.execute('SELECT COUNT(*) FROM messages').fetchone()[0], 5)
+        self.assertEqual(get_high_water_mark(local, batch['node_id']), 5)
+
+    def test_malformed_batch_is_rejected(self):
+        insert_messages(self.peer, 2)
+        batch = export_changes(connect(self.peer), since=0)
+        uid = batch['fields'].index('uid')
+        without_uid = dict(batch, fields=[f for f in batch['fields'] if f != 'uid'],
+                           changes=[row[:uid] + row[uid + 1:] for row in batch['changes']])
+        unknown_field = dict(batch, fields=batch['fields'][:-1] + ['render_ns) VALUES (1); --'])
+        short_row = dict(batch, changes=[batch['changes'][0][:-1]])
+        null_uid = dict(batch, changes=[row[:uid] + [None] + row[uid + 1:] for row in batch['changes']])
+        local = connect(self.local)
+
+        for malformed in (without_uid, unknown_field, short_row, null_uid):
+            with self.assertRaises(ValueError):
+                apply_changes(local, malformed)
+        self.assertEqual(local.execute('SELECT COUNT(*) FROM messages').fetchone()[0], 0)
+        self.assertEqual(get_high_water_mark(local, batch['node_id']), 0)
+
+    def test_export_skips_rows_from_requesting_node(self):
+        insert_messages(self.local, 3)
+        local = connect(self.local)
+        apply_changes(connect(self.peer), export_changes(local, since=0))
+        insert_messages(self.peer, 2, start=3)
+
+        batch = export_changes(connect(self.peer), since=0, exclude_origin=get_node_id(local))
+
+        self.assertEqual(len(batch['changes']), 2)
+        self.assertEqual(batch['last_id'], 5)
+
+class TestSyncClient(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.peer = os.path.join(directory.name, "peer.db")
+        self.local = os.path.join(directory.name, "local.db")
+        setup_database(self.local)
+
+        app.config['DATABASE'] = self.peer
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+        self.peer_url = f"http://127.0.0.1:{self.server.port}"
+        # Creates the peer schema
+        requests.get(f"{self.peer_url}/messages")
+
+    def local_messages(self):
+        return [row[0] for row in connect(self.local).execute('SELECT message FROM messages ORDER BY id')]
+
+    def test_pull_is_incremental(self):
+        insert_messages(self.peer, 25)
+        client = SyncClient(self.peer_url, self.local, batch_size=10)
+
+        self.assertEqual(client.pull(), 25)
+        self.assertEqual(client.pull(), 0)
+
+        insert_messages(self.peer, 5, start=25)
+        self.assertEqual(client.pull(), 5)
+        self.assertEqual(self.local_messages(), [f"message {i}" for i in range(30)])
+
+    def test_batches_are_compressed(self):
+        insert_messages(self.peer, 10)
+        response = requests.get(f"{self.peer_url}/sync/changes", params={'since': 0})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(len(response.json()['changes']), 10)
+
+    def test_resumes_after_interruption(self):
+        insert_messages(self.peer, 30)
+        client = SyncClient(self.peer_url, self.local, batch_size=10)
+        real_get = client.session.get
+        calls = []
+
+        def flaky_get(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 3:
+                raise requests.exceptions.ConnectionError("link dropped")
+            return real_get(*args, **kwargs)
+
+        with patch.object(client.session, 'get', side_effect=flaky_get):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                client.pull()
+        partial = len(self.local_messages())
+        self.assertGreater(partial, 0)
+        self.assertLess(partial, 30)
+
+        # A fresh client (e.g. after a restart) continues from the high-water mark
+        self.assertEqual(SyncClient(self.peer_url, self.local, batch_size=10).pull(), 30 - partial)
+        self.assertEqual(self.local_messages(), [f"message {i}" for i in range(30)])
+
+    def test_two_way_sync_does_not_duplicate(self):
+        insert_messages(self.peer, 3)
+        insert_messages(self.local, 2, start=100)
+        SyncClient(self.peer_url, self.local).pull()
+
+        # The peer pulls back from us through a second server on the local database
+        local_app_server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.addCleanup(local_app_server.shutdown)
+        threading.Thread(target=local_app_server.serve_forever, daemon=True).start()
+        app.config['DATABASE'] = self.local
+        received = SyncClient(f"http://127.0.0.1:{local_app_server.port}", self.peer).pull()
+
+        self.assertEqual(received, 2)
+        count = connect(self.peer).execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        self.assertEqual(count, 5)
+
+if __name__ == '__main__':
+    unittest.main()